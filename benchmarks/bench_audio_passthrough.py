@@ -0,0 +1,58 @@
+# ./benchmarks/bench_audio_passthrough.py
+"""CPU-seconds per track for the MP3 transcode vs the native (remux only) AUDIO_FORMAT.
+
+Runs the same ffmpeg commands yt-dlp's FFmpegExtractAudio uses on a synthetic
+YouTube-like Opus/WebM stream. Needs ffmpeg with libopus and libmp3lame on PATH.
+
+Usage: python benchmarks/bench_audio_passthrough.py [--seconds 210] [--runs 5]
+"""
+import os
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+def run_ffmpeg(args):
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error", *args], check=True)
+
+def child_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def measure(label, args, runs):
+    cpu_start = child_cpu_seconds()
+    wall_start = time.perf_counter()
+    for _ in range(runs):
+        run_ffmpeg(args)
+    cpu = (child_cpu_seconds() - cpu_start) / runs
+    wall = (time.perf_counter() - wall_start) / runs
+    print(f"{label:<22}: {cpu:.3f} CPU-s/track, {wall:.3f} s wall/track")
+    return cpu
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=int, default=210, help="length of the synthetic track")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    if not shutil.which("ffmpeg"):
+        print("ffmpeg not found on PATH, nothing to benchmark.")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "source.webm")
+        # Roughly what YouTube's bestaudio is: ~130k Opus in WebM
+        run_ffmpeg(["-f", "lavfi", "-i", f"sine=frequency=440:duration={args.seconds}",
+                    "-ac", "2", "-c:a", "libopus", "-b:a", "130k", source])
+
+        transcode = measure("mp3 transcode (192k)", ["-i", source, "-vn", "-acodec", "libmp3lame", "-b:a", "192k",
+                                                     os.path.join(tmp, "out.mp3")], args.runs)
+        passthrough = measure("native remux (.opus)", ["-i", source, "-vn", "-acodec", "copy",
+                                                       os.path.join(tmp, "out.opus")], args.runs)
+        if passthrough > 0:
+            print(f"native mode uses {transcode / passthrough:.0f}x less CPU per track")
+
+if __name__ == "__main__":
+    main()
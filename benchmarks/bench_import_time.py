@@ -0,0 +1,73 @@
+# ./benchmarks/bench_import_time.py
+"""Import time of each AmpsAssist module, and whether importing it touches the network or auth files.
+
+Every import runs in a fresh interpreter with sockets blocked (as if offline) and file opens
+watched, so a module that builds API clients or converts cookies at import shows up here.
+Needs the app's dependencies and a src/config.py, like the app itself.
+
+Usage: python benchmarks/bench_import_time.py [--runs 5] [module ...]
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+DEFAULT_MODULES = ["file_manager", "plex_sync", "jellyfin_sync", "playlist_manager", "downloader", "main"]
+
+PROBE = r"""
+import sys, json, time, socket, builtins
+events = []
+
+def blocked(*args, **kwargs):
+    events.append("network")
+    raise OSError("network blocked by bench_import_time")
+socket.socket.connect = blocked
+socket.getaddrinfo = blocked
+
+real_open = builtins.open
+def watched_open(file, *args, **kwargs):
+    name = str(file)
+    if name.endswith(("cookies.txt", "browser.json")):
+        events.append("auth file " + name)
+    return real_open(file, *args, **kwargs)
+builtins.open = watched_open
+
+start = time.perf_counter()
+error = None
+try:
+    __import__(sys.argv[1])
+except BaseException as e:
+    error = f"{type(e).__name__}: {e}"
+print(json.dumps({"seconds": time.perf_counter() - start, "events": sorted(set(events)), "error": error}))
+"""
+
+def probe(module):
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE, module],
+        cwd=SRC_DIR, capture_output=True, text=True,
+        env={**os.environ, "PYTHONPATH": SRC_DIR, "METRICS_PORT": "0"},
+    )
+    # The module may print on import, the probe's JSON is always the last line
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    args = parser.parse_args()
+
+    for module in args.modules:
+        results = [probe(module) for _ in range(args.runs)]
+        if results[0]["error"]:
+            print(f"{module:<18}: import failed ({results[0]['error']})")
+            continue
+        median = statistics.median(result["seconds"] for result in results) * 1000
+        events = sorted({event for result in results for event in result["events"]})
+        side_effects = ", ".join(events) if events else "no network or auth work"
+        print(f"{module:<18}: {median:7.1f} ms median over {args.runs} runs, {side_effects}")
+
+if __name__ == "__main__":
+    main()
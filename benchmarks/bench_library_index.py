@@ -0,0 +1,72 @@
+# ./benchmarks/bench_library_index.py
+"""Compares the old per-track os.walk lookup with the persistent LibraryIndex.
+
+Usage: python benchmarks/bench_library_index.py [--files 20000] [--lookups 200]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from library_index import LibraryIndex
+
+def build_tree(root, num_files, tracks_per_album=12, albums_per_artist=4):
+    video_ids = []
+    for i in range(num_files):
+        album_no = i // tracks_per_album
+        artist_dir = os.path.join(root, f"Artist {album_no // albums_per_artist}")
+        album_dir = os.path.join(artist_dir, f"Album {album_no}")
+        os.makedirs(album_dir, exist_ok=True)
+        video_id = f"{i:011d}"
+        open(os.path.join(album_dir, f"Song {i} [{video_id}].mp3"), 'w').close()
+        video_ids.append(video_id)
+    return video_ids
+
+def legacy_find_existing_file(root, video_id):
+    """The original downloader.find_existing_file walk."""
+    search_string = f"[{video_id}].mp3"
+    for r, dirs, files in os.walk(root):
+        for filename in files:
+            if filename.endswith(search_string):
+                return os.path.join(r, filename)
+    return None
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = os.path.join(tmp, "All_Songs")
+        print(f"Generating {args.files} files...")
+        video_ids = build_tree(root, args.files)
+        sample = random.sample(video_ids, min(args.lookups, len(video_ids)))
+
+        _, walk_time = timed(lambda: [legacy_find_existing_file(root, v) for v in sample])
+
+        index_path = os.path.join(tmp, "state", "library_index.json")
+        index = LibraryIndex(root, index_path)
+        _, cold_time = timed(index.load)
+        cold_listed = index.stats["dirs_listed"]
+
+        warm = LibraryIndex(root, index_path)
+        _, warm_time = timed(warm.load)
+        _, index_time = timed(lambda: [warm.lookup(v) for v in sample])
+        assert all(warm.lookup(v) == legacy_find_existing_file(root, v) for v in sample[:5])
+
+        print(f"os.walk per lookup : {walk_time:.3f}s for {len(sample)} lookups ({walk_time / len(sample) * 1000:.2f} ms each)")
+        print(f"index cold build   : {cold_time:.3f}s ({cold_listed} folders listed)")
+        print(f"index warm load    : {warm_time:.3f}s ({warm.stats['dirs_listed']} listed, {warm.stats['dirs_reused']} reused)")
+        print(f"index lookups      : {index_time * 1000:.3f} ms for {len(sample)} lookups")
+
+if __name__ == "__main__":
+    main()
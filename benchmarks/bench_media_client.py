@@ -0,0 +1,122 @@
+# ./benchmarks/bench_media_client.py
+"""Exercises MediaServerClient against a local fake Plex/Jellyfin server.
+
+Compares bare requests.get calls (the old plex_sync behaviour) with the pooled client,
+and checks that hung endpoints time out and flaky ones are retried.
+
+Usage: python benchmarks/bench_media_client.py [--calls 200]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from media_client import MediaServerClient
+
+class FakeMediaServer(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True # Headers and body go out separately, don't wait on delayed ACKs
+
+    def _send(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        if self.path.startswith("/playlists"):
+            self._send(200, json.dumps({"MediaContainer": {"Metadata": []}}).encode())
+        elif self.path.startswith("/hang"):
+            time.sleep(5)
+            self._send(200)
+        elif self.path.startswith("/flaky"):
+            with server.lock:
+                server.flaky_calls += 1
+                calls = server.flaky_calls
+            self._send(503 if calls <= 2 else 200, b"{}")
+        else:
+            self._send(404)
+
+    def do_POST(self):
+        if self.path.startswith("/Library/Refresh"):
+            self._send(204)
+        else:
+            self._send(404)
+
+    def log_message(self, *args):
+        pass
+
+class CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.connections = 0
+        self.flaky_calls = 0
+        self.lock = threading.Lock()
+
+    def get_request(self):
+        request = super().get_request()
+        with self.lock:
+            self.connections += 1
+        return request
+
+    def handle_error(self, request, client_address):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    server = CountingServer(("127.0.0.1", 0), FakeMediaServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    try:
+        server.connections = 0
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            requests.get(f"{base_url}/playlists?X-Plex-Token=x", headers={"Accept": "application/json"}).json()
+        bare_time = time.perf_counter() - start
+        bare_connections = server.connections
+
+        client = MediaServerClient("plex", base_url, headers={"Accept": "application/json"},
+                                   params={"X-Plex-Token": "x"}, timeout=1, retries=3, backoff=0.05)
+        server.connections = 0
+        start = time.perf_counter()
+        for _ in range(args.calls):
+            client.get_json("/playlists")
+        pooled_time = time.perf_counter() - start
+        pooled_connections = server.connections
+
+        print(f"bare requests.get : {bare_time / args.calls * 1000:.2f} ms/call, {bare_connections} connections")
+        print(f"pooled client     : {pooled_time / args.calls * 1000:.2f} ms/call, {pooled_connections} connections")
+
+        response = client.get("/flaky")
+        print(f"flaky endpoint    : status {response.status_code} after {server.flaky_calls} attempts")
+
+        start = time.perf_counter()
+        try:
+            MediaServerClient("plex", base_url, timeout=0.5, retries=1, backoff=0.05).get("/hang")
+            print("hung endpoint     : did not time out!")
+        except requests.exceptions.Timeout:
+            print(f"hung endpoint     : timed out after {time.perf_counter() - start:.1f}s (2 attempts)")
+
+        status = client.post("/Library/Refresh").status_code
+        print(f"post              : status {status}")
+        for line in client.latency_summary():
+            print(line)
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
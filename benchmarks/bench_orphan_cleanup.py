@@ -0,0 +1,119 @@
+# ./benchmarks/bench_orphan_cleanup.py
+"""Compares the old nested os.walk orphan cleanup with the single-pass prune_library.
+
+Usage: python benchmarks/bench_orphan_cleanup.py [--files 12000] [--orphan-ratio 0.3]
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from library_cleanup import prune_library
+
+def build_tree(root, num_files, orphan_ratio, seed=1, tracks_per_album=10, albums_per_artist=3):
+    """Builds an Artist/Album tree and returns the set of paths that are still in use."""
+    rng = random.Random(seed)
+    keep = set()
+    album_orphaned = False
+    for i in range(num_files):
+        album_no = i // tracks_per_album
+        album_dir = os.path.join(root, f"Artist {album_no // albums_per_artist}", f"Album {album_no}")
+        if not os.path.isdir(album_dir):
+            os.makedirs(album_dir)
+            open(os.path.join(album_dir, "cover.webp"), 'wb').close()
+            # Whole albums drop out of the mixes, as well as single songs
+            album_orphaned = rng.random() < orphan_ratio
+        path = os.path.join(album_dir, f"Song {i} [{i:011d}].mp3")
+        with open(path, 'wb') as f:
+            f.write(b"\0" * 64)
+        if not album_orphaned and rng.random() >= orphan_ratio / 3:
+            keep.add(path)
+    return keep
+
+def legacy_cleanup(all_songs_dir, in_use_local_paths):
+    """The original two-phase remove_orphaned_songs walk (minus printing)."""
+    for root, dirs, files in os.walk(all_songs_dir):
+        for filename in files:
+            if filename.endswith(".mp3"):
+                file_path = os.path.join(root, filename)
+                if file_path not in in_use_local_paths:
+                    os.remove(file_path)
+
+    for root, dirs, files in os.walk(all_songs_dir, topdown=False):
+        for dir_name in dirs:
+            dir_path = os.path.join(root, dir_name)
+            has_mp3 = False
+            for r, d, f in os.walk(dir_path):
+                if any(file.endswith(".mp3") for file in f):
+                    has_mp3 = True
+                    break
+            if not has_mp3:
+                try:
+                    shutil.rmtree(dir_path)
+                except Exception:
+                    pass
+
+class ListingCounter:
+    """Counts os.scandir calls (os.walk uses it too); each one is an SMB round trip on the share."""
+
+    def __init__(self):
+        self.calls = 0
+        self._scandir = os.scandir
+
+    def __enter__(self):
+        def counting_scandir(*args, **kwargs):
+            self.calls += 1
+            return self._scandir(*args, **kwargs)
+        os.scandir = counting_scandir
+        return self
+
+    def __exit__(self, *exc):
+        os.scandir = self._scandir
+
+def count_files(root):
+    return sum(len(files) for _, _, files in os.walk(root))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=12000)
+    parser.add_argument("--orphan-ratio", type=float, default=0.3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_root = os.path.join(tmp, "legacy")
+        new_root = os.path.join(tmp, "new")
+        print(f"Generating two trees of {args.files} files...")
+        legacy_keep = build_tree(legacy_root, args.files, args.orphan_ratio)
+        new_keep = build_tree(new_root, args.files, args.orphan_ratio)
+
+        devnull = open(os.devnull, 'w')
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            with ListingCounter() as legacy_listings:
+                start = time.perf_counter()
+                legacy_cleanup(legacy_root, legacy_keep)
+                legacy_time = time.perf_counter() - start
+
+            dry_stats = prune_library(new_root, new_keep, dry_run=True)
+            with ListingCounter() as new_listings:
+                start = time.perf_counter()
+                stats = prune_library(new_root, new_keep)
+                new_time = time.perf_counter() - start
+        finally:
+            sys.stdout = stdout
+            devnull.close()
+
+        assert count_files(legacy_root) == count_files(new_root), "cleanup results differ"
+
+        print(f"legacy nested walk : {legacy_time:.3f}s, {legacy_listings.calls} directory listings")
+        print(f"single-pass prune  : {new_time:.3f}s, {new_listings.calls} directory listings ({stats['files_scanned']} files scanned)")
+        print(f"dry run            : {dry_stats['timings']['prune']:.3f}s, would reclaim {dry_stats['bytes_reclaimed']} bytes")
+        print(f"removed            : {stats['orphans_deleted']} songs, {stats['dirs_removed']} folders, {stats['bytes_reclaimed']} bytes")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# ./benchmarks/bench_ytdlp_sessions.py
+"""Per-track overhead and TCP connections: a new YoutubeDL per track vs one reused instance.
+
+Serves small fake audio files from a local keep-alive HTTP server and downloads them through
+yt-dlp's generic extractor, the same way download_raw_audio drives yt-dlp for YouTube.
+
+Usage: python benchmarks/bench_ytdlp_sessions.py [--tracks 50]
+"""
+import os
+import time
+import argparse
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import yt_dlp
+
+PAYLOAD = b"\x1aE\xdf\xa3" + b"\0" * 32 * 1024
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, so connection reuse is visible
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/webm")
+        self.send_header("Content-Length", str(len(PAYLOAD)))
+        self.end_headers()
+        self.wfile.write(PAYLOAD)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "audio/webm")
+        self.send_header("Content-Length", str(len(PAYLOAD)))
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    connections = 0
+
+    def get_request(self):
+        request = super().get_request()
+        self.connections += 1
+        return request
+
+    def handle_error(self, request, client_address):
+        pass # Clients dropping idle keep-alive connections is expected here
+
+def ydl_opts(out_dir):
+    return {
+        'outtmpl': os.path.join(out_dir, "%(amps_title)s [%(amps_video_id)s].%(ext)s"),
+        'quiet': True,
+        'no_warnings': True,
+        'noprogress': True,
+    }
+
+def run(label, server, urls, out_dir, reuse):
+    server.connections = 0
+    start = time.perf_counter()
+    if reuse:
+        with yt_dlp.YoutubeDL(ydl_opts(out_dir)) as ydl:
+            for i, url in enumerate(urls):
+                ydl.extract_info(url, download=True, extra_info={'amps_title': f"{label} {i}", 'amps_video_id': str(i)})
+    else:
+        for i, url in enumerate(urls):
+            with yt_dlp.YoutubeDL(ydl_opts(out_dir)) as ydl:
+                ydl.extract_info(url, download=True, extra_info={'amps_title': f"{label} {i}", 'amps_video_id': str(i)})
+    elapsed = time.perf_counter() - start
+    print(f"{label:<22}: {elapsed / len(urls) * 1000:.1f} ms/track, {server.connections} TCP connections for {len(urls)} tracks")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tracks", type=int, default=50)
+    args = parser.parse_args()
+
+    server = CountingServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    urls = [f"{base_url}/track{i}.webm" for i in range(args.tracks)]
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            run("new YoutubeDL/track", server, urls, os.path.join(tmp, "fresh"), reuse=False)
+            run("reused YoutubeDL", server, urls, os.path.join(tmp, "reused"), reuse=True)
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
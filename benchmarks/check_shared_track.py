@@ -0,0 +1,74 @@
+# ./benchmarks/check_shared_track.py
+"""Runs process_downloads on a song shared by two playlists and checks both playlists get it.
+
+Downloads and postprocessing are replaced by fakes that only touch a temp folder, and all
+state files and .m3u files go to a temp folder too, so the real library is never touched.
+Needs the app's dependencies and a src/config.py, like the app itself.
+
+Usage: python benchmarks/check_shared_track.py
+"""
+import os
+import sys
+import tempfile
+
+TMP_DIR = tempfile.mkdtemp(prefix="amps-check-")
+os.environ["AMPS_STATE_DIR"] = os.path.join(TMP_DIR, "state")
+os.environ["AMPS_STAGING_DIR"] = os.path.join(TMP_DIR, "staging")
+os.environ["METRICS_PORT"] = "0"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import file_manager
+import downloader
+from file_manager import playlist_snapshots
+
+def main():
+    file_manager.PLAYLISTS_DIR = os.path.join(TMP_DIR, "playlists")
+    os.makedirs(file_manager.PLAYLISTS_DIR)
+    calls = []
+
+    def fake_download(track, sessions=None):
+        calls.append(track['video_id'])
+        return {'raw_path': None, 'thumbnail_url': None}
+
+    def fake_postprocess(download, track):
+        path = os.path.join(TMP_DIR, "songs", f"{track['title']} [{track['video_id']}].mp3")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'wb').close()
+        return path
+
+    downloader.download_raw_audio = fake_download
+    downloader.postprocess_track = fake_postprocess
+    downloader.find_existing_file = lambda video_id: None
+
+    shared = {'video_id': "shared00001", 'title': "Shared", 'artist': "A", 'album': "B"}
+    only_feed = {'video_id': "feedonly001", 'title': "Feed only", 'artist': "A", 'album': "B"}
+    playlists = {
+        "My Supermix": [dict(only_feed, playlist_class="feed"), dict(shared, playlist_class="feed")],
+        "Saved": [dict(shared, playlist_class="library")],
+    }
+    playlist_snapshots.begin_run()
+    tracks = []
+    for name, entries in playlists.items():
+        entries = [dict(track, playlist_name=name, position=position) for position, track in enumerate(entries)]
+        playlist_snapshots.observe(name, entries)
+        tracks.extend(entries)
+
+    result = downloader.process_downloads(tracks)
+
+    failures = []
+    if sorted(calls) != sorted({track['video_id'] for track in tracks}):
+        failures.append(f"expected one download per song, got {calls}")
+    for name, entries in playlists.items():
+        paths = result["playlists"].get_paths(name)
+        if len(paths) != len(entries):
+            failures.append(f"'{name}' has {len(paths)} songs, expected {len(entries)}")
+    if sorted(result["written"]) != sorted(playlists):
+        failures.append(f"playlists written: {result['written']}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    print("OK" if not failures else f"{len(failures)} checks failed")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+# ./src/artwork_cache.py
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import requests
+from postprocessor import compress_cover
+from atomic_file import write_atomic
+
+ARTWORK_CACHE_VERSION = 1
+
+# Longest side of stored covers in pixels, plenty for any player UI
+ARTWORK_SIZE = int(os.getenv("ARTWORK_SIZE", "600"))
+ARTWORK_CACHE_MAX_MB = int(os.getenv("ARTWORK_CACHE_MAX_MB", "200"))
+ARTWORK_FETCH_TIMEOUT = 15
+
+# YouTube Music serves album art from googleusercontent with the size in the URL, so we can ask
+# for the size we store instead of downloading the full resolution image
+SIZED_URL_PATTERN = re.compile(r"=w\d+-h\d+")
+
+def sized_url(url, size=ARTWORK_SIZE):
+    if "googleusercontent.com" in url and SIZED_URL_PATTERN.search(url):
+        return SIZED_URL_PATTERN.sub(f"=w{size}-h{size}", url, count=1)
+    return url
+
+def album_key(track):
+    """artist + album, or None for tracks without a real album (those are only cached by URL)."""
+    album = track.get('album')
+    if not album or album == "Unknown Album":
+        return None
+    return f"{str(track.get('artist', '')).lower()}\x1f{str(album).lower()}"
+
+class ArtworkCache:
+    """Content-addressed store of resized JPEG covers, shared by every track of an album.
+
+    Images live in root as <sha1>.jpg. The index maps album keys and source URLs to those
+    hashes, so an album's cover is fetched and compressed once and then reused by all of
+    its tracks, in this run and later ones. Least recently used images are evicted once the
+    cache grows past max_bytes.
+    """
+
+    def __init__(self, root, max_bytes, size=ARTWORK_SIZE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.size = size
+        self.index_path = os.path.join(root, "index.json")
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+        self._albums = {}
+        self._urls = {}
+        self._entries = {}
+        self.stats = {"hits": 0, "misses": 0, "failed": 0, "bytes_fetched": 0, "evicted": 0}
+
+    def load(self):
+        albums, urls, entries = {}, {}, {}
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") == ARTWORK_CACHE_VERSION:
+                albums, urls, entries = data.get("albums", {}), data.get("urls", {}), data.get("entries", {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Artwork cache index is unreadable, starting fresh: {e}")
+        with self._lock:
+            self._albums, self._urls, self._entries = albums, urls, entries
+            self._fetch_locks = {}
+            self.stats = {"hits": 0, "misses": 0, "failed": 0, "bytes_fetched": 0, "evicted": 0}
+
+    def _image_path(self, digest):
+        return os.path.join(self.root, f"{digest}.jpg")
+
+    def _lookup(self, key, url):
+        # Caller holds self._lock
+        for digest in (self._albums.get(key) if key else None, self._urls.get(url) if url else None):
+            if digest and digest in self._entries:
+                return digest
+        return None
+
+    def _read(self, digest):
+        try:
+            with open(self._image_path(digest), 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self._entries.pop(digest, None) # Deleted behind our back, fetch it again
+            return None
+        with self._lock:
+            if digest in self._entries:
+                self._entries[digest]["last_used"] = time.time()
+        return data
+
+    def get(self, track, url):
+        """JPEG bytes of the track's cover, or None. Fetches and compresses it on a miss."""
+        key = album_key(track)
+        with self._lock:
+            digest = self._lookup(key, url)
+        data = self._read(digest) if digest else None
+        if data is not None:
+            self._remember(key, url, digest, hit=True)
+            return data
+        if not url:
+            return None
+
+        # One fetch per album/URL even when several of its tracks finish at the same time
+        fetch_key = key or url
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(fetch_key, threading.Lock())
+        with fetch_lock:
+            with self._lock:
+                digest = self._lookup(key, url)
+            data = self._read(digest) if digest else None
+            if data is not None:
+                self._remember(key, url, digest, hit=True)
+                return data
+            return self._fetch(key, url)
+
+    def _fetch(self, key, url):
+        os.makedirs(self.root, exist_ok=True)
+        source_path = os.path.join(self.root, f".{threading.get_ident()}.source")
+        jpeg_path = os.path.join(self.root, f".{threading.get_ident()}.jpg")
+        try:
+            response = requests.get(sized_url(url, self.size), timeout=ARTWORK_FETCH_TIMEOUT)
+            response.raise_for_status()
+            with open(source_path, 'wb') as f:
+                f.write(response.content)
+            compress_cover(source_path, jpeg_path, self.size)
+            with open(jpeg_path, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha1(data).hexdigest()
+            os.replace(jpeg_path, self._image_path(digest))
+        except Exception:
+            with self._lock:
+                self.stats["failed"] += 1
+            return None
+        finally:
+            for path in (source_path, jpeg_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        with self._lock:
+            self._entries[digest] = {"bytes": len(data), "last_used": time.time()}
+            self.stats["bytes_fetched"] += len(response.content)
+        self._remember(key, url, digest, hit=False)
+        return data
+
+    def _remember(self, key, url, digest, hit):
+        with self._lock:
+            if key:
+                self._albums[key] = digest
+            if url:
+                self._urls[url] = digest
+            self.stats["hits" if hit else "misses"] += 1
+
+    def evict(self):
+        """Deletes least recently used images until the cache fits in max_bytes."""
+        with self._lock:
+            total = sum(entry["bytes"] for entry in self._entries.values())
+            if not self.max_bytes or total <= self.max_bytes:
+                return 0
+            evicted = []
+            for digest, entry in sorted(self._entries.items(), key=lambda item: item[1]["last_used"]):
+                if total <= self.max_bytes:
+                    break
+                total -= entry["bytes"]
+                evicted.append(digest)
+            for digest in evicted:
+                del self._entries[digest]
+            gone = set(evicted)
+            self._albums = {key: digest for key, digest in self._albums.items() if digest not in gone}
+            self._urls = {url: digest for url, digest in self._urls.items() if digest not in gone}
+            self.stats["evicted"] += len(evicted)
+        for digest in evicted:
+            try:
+                os.remove(self._image_path(digest))
+            except OSError:
+                pass
+        return len(evicted)
+
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+            cached = len(self._entries)
+            cached_bytes = sum(entry["bytes"] for entry in self._entries.values())
+        return (f"artwork: {stats['hits']} cache hits, {stats['misses']} fetched ({stats['bytes_fetched'] / 1024:.0f} KB), "
+                f"{stats['failed']} failed, {stats['evicted']} evicted, {cached} covers cached ({cached_bytes / (1024 * 1024):.1f} MB)")
+
+    def save(self):
+        self.evict()
+        with self._lock:
+            data = {"version": ARTWORK_CACHE_VERSION, "albums": self._albums, "urls": self._urls, "entries": self._entries}
+            content = json.dumps(data)
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            write_atomic(self.index_path, content)
+        except Exception as e:
+            print(f"Could not save the artwork cache index: {e}")
+
+def write_folder_cover(album_dir, data, filename="cover.jpg"):
+    """Writes the album folder's cover.jpg unless it already has one. Returns True if written."""
+    path = os.path.join(album_dir, filename)
+    if os.path.exists(path):
+        return False
+    os.makedirs(album_dir, exist_ok=True)
+    tmp_path = os.path.join(album_dir, f".{filename}.amps-tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return True
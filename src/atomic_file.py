@@ -0,0 +1,16 @@
+# ./src/atomic_file.py
+import os
+
+def write_atomic(path, content, fsync=False):
+    """Writes a file via temp file + rename so readers never see a half-written file.
+
+    With fsync the data reaches the disk before the rename, for files something else is
+    truncated against right afterwards.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,114 @@
+# ./src/download_queue.py
+import time
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
+
+# Home feed mixes change every run and are what gets played first, saved playlists barely change
+PLAYLIST_CLASS_PRIORITY = {"feed": 0, "community": 1, "library": 2}
+LOWEST_CLASS_PRIORITY = max(PLAYLIST_CLASS_PRIORITY.values()) + 1
+
+def membership_rank(playlist_class, position):
+    return PLAYLIST_CLASS_PRIORITY.get(playlist_class, LOWEST_CLASS_PRIORITY), position
+
+class PriorityDownloadQueue:
+    """Holds download jobs in priority order in front of the download pool.
+
+    A dispatcher thread hands the best-ranked waiting job (lowest job.priority) to the stage
+    whenever it has room, so a feed mix track that turns up late still overtakes hundreds
+    of queued library tracks. A job that joins more playlists can move up until it starts.
+    At most max_waiting jobs wait here; submit() blocks beyond that, so memory stays flat on
+    huge libraries and only jobs inside that window can be overtaken.
+    """
+
+    def __init__(self, stage, max_waiting):
+        self._stage = stage
+        self._max_waiting = max_waiting
+        self._cond = threading.Condition()
+        self._heap = []
+        self._keys = {}
+        self._seq = itertools.count()
+        self._closed = False
+        self._dispatcher = threading.Thread(target=self._dispatch, name="download-dispatcher", daemon=True)
+        self._dispatcher.start()
+        self.stats = {"submitted": 0, "reprioritized": 0, "peak_waiting": 0, "blocked_seconds": 0.0}
+
+    def __len__(self):
+        with self._cond:
+            return len(self._keys)
+
+    def submit(self, fn, job):
+        """Queues fn(job) by job.priority, blocking while max_waiting jobs are already waiting."""
+        future = Future()
+        blocked_at = time.perf_counter()
+        with self._cond:
+            while len(self._keys) >= self._max_waiting and not self._closed:
+                self._cond.wait()
+            self.stats["blocked_seconds"] += time.perf_counter() - blocked_at
+            self.stats["submitted"] += 1
+            self._push(job, (fn, future))
+        return future
+
+    def reprioritize(self, job):
+        """Moves a still waiting job up if its priority improved (e.g. another playlist wants it)."""
+        with self._cond:
+            entry = self._keys.get(id(job))
+            if entry and job.priority < entry[0]:
+                self.stats["reprioritized"] += 1
+                self._push(job, entry[1])
+
+    def _push(self, job, task):
+        # Caller holds self._cond. Older heap entries of the job go stale and are skipped on pop.
+        key = job.priority
+        self._keys[id(job)] = (key, task)
+        heapq.heappush(self._heap, (key, next(self._seq), job))
+        self.stats["peak_waiting"] = max(self.stats["peak_waiting"], len(self._keys))
+        # Blocked submitters wait on the same condition, so the dispatcher must not miss this
+        self._cond.notify_all()
+
+    def _pop(self):
+        with self._cond:
+            while True:
+                while self._heap:
+                    key, _, job = heapq.heappop(self._heap)
+                    entry = self._keys.get(id(job))
+                    if entry and entry[0] == key:
+                        del self._keys[id(job)]
+                        # Room for a blocked submit()
+                        self._cond.notify_all()
+                        return job, entry[1]
+                if self._closed:
+                    return None, None
+                self._cond.wait()
+
+    def _dispatch(self):
+        while True:
+            job, task = self._pop()
+            if job is None:
+                return
+            fn, future = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            # Blocks while the stage is full, which is what keeps the waiting jobs in priority order here
+            self._stage.submit(self._run, fn, job, future)
+
+    @staticmethod
+    def _run(fn, job, future):
+        try:
+            future.set_result(fn(job))
+        except Exception as e:
+            future.set_exception(e)
+
+    def close(self):
+        """Hands every waiting job to the stage, then stops the dispatcher."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._dispatcher.join()
+
+    def summary(self):
+        with self._cond:
+            stats = dict(self.stats)
+        return (f"download queue: {stats['submitted']} jobs by priority, {stats['reprioritized']} moved up "
+                f"by later playlists, peak {stats['peak_waiting']} waiting, producers blocked {stats['blocked_seconds']:.1f}s")
@@ -0,0 +1,167 @@
+# ./src/download_scheduler.py
+import time
+import threading
+from contextlib import contextmanager
+
+# A window's throughput has to beat the previous one by this much for another worker to be worth it
+GROWTH_THRESHOLD = 0.05
+
+class TokenBucket:
+    """Bytes-per-second budget shared by every download. A falsy rate means unlimited.
+
+    consume() books the bytes straight away and sleeps off any debt, so concurrent callers
+    queue up behind each other instead of all bursting at once.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited_seconds = 0.0
+
+    def consume(self, amount):
+        if not self.rate or amount <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.waited_seconds += wait
+        if wait:
+            time.sleep(wait)
+
+class AdaptiveScheduler:
+    """AIMD concurrency limit for downloads, plus the shared TokenBucket bandwidth cap.
+
+    Every window the observed throughput is compared with the previous one. While the limit is
+    saturated and the last step up still paid off, the limit grows by one worker. A throttling
+    signal (bot check, "Sign in" prompt, HTTP 429) halves it at once and pauses growth for
+    the cooldown.
+    """
+
+    def __init__(self, min_workers=1, max_workers=8, start_workers=None, bandwidth=None, window=10.0, cooldown=60.0):
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.limit = min(self.max_workers, max(self.min_workers, start_workers or self.min_workers))
+        self.window = window
+        self.cooldown = cooldown
+        self.bucket = TokenBucket(bandwidth)
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._active = 0
+        self._window_started = time.monotonic()
+        self._window_bytes = 0
+        self._last_throughput = None
+        self._cooldown_until = 0.0
+        self._last_decrease = None
+        self._started = None
+        self._stopped = None
+        self.stats = {
+            "bytes": 0,
+            "downloads": 0,
+            "throttle_events": 0,
+            "increases": 0,
+            "decreases": 0,
+            "peak_limit": self.limit,
+        }
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+            if self._started is None:
+                self._started = time.monotonic()
+                self._window_started = self._started
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self.stats["downloads"] += 1
+            self._stopped = time.monotonic()
+            self._maybe_adjust(self._stopped)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def progress_hook(self, status):
+        """yt-dlp progress hook: charges downloaded bytes to the bucket (blocking if over the cap)."""
+        filename = status.get("filename") or status.get("tmpfilename")
+        seen = getattr(self._local, "seen", None)
+        if seen is None:
+            seen = self._local.seen = {}
+        downloaded = status.get("downloaded_bytes") or 0
+        delta = downloaded - seen.get(filename, 0)
+        if status.get("status") == "downloading":
+            seen[filename] = downloaded
+        else:
+            seen.pop(filename, None)
+        if delta <= 0:
+            return
+
+        self.bucket.consume(delta)
+        with self._cond:
+            self.stats["bytes"] += delta
+            self._window_bytes += delta
+            self._maybe_adjust(time.monotonic())
+
+    def record_throttle(self):
+        """Called on a throttling signal from yt-dlp. Halves the limit at most once per window."""
+        with self._cond:
+            self.stats["throttle_events"] += 1
+            now = time.monotonic()
+            if self._last_decrease is not None and now - self._last_decrease < self.window:
+                return # Already backed off for this burst of errors
+            self._last_decrease = now
+            self.limit = max(self.min_workers, self.limit // 2)
+            self.stats["decreases"] += 1
+            self._cooldown_until = now + self.cooldown
+            self._window_started = now
+            self._window_bytes = 0
+            self._last_throughput = None
+
+    def _maybe_adjust(self, now):
+        # Caller holds self._cond
+        elapsed = now - self._window_started
+        if elapsed < self.window:
+            return
+        throughput = self._window_bytes / elapsed
+        previous, self._last_throughput = self._last_throughput, throughput
+        self._window_started = now
+        self._window_bytes = 0
+
+        if now < self._cooldown_until or self._active < self.limit or self.limit >= self.max_workers:
+            return # Throttled recently, or the current limit isn't even in full use
+        if previous is None or throughput > previous * (1 + GROWTH_THRESHOLD):
+            self.limit += 1
+            self.stats["increases"] += 1
+            self.stats["peak_limit"] = max(self.stats["peak_limit"], self.limit)
+            self._cond.notify_all()
+
+    def throughput(self):
+        """Effective bytes per second from the first download slot taken to the last one released."""
+        with self._cond:
+            if self._started is None:
+                return 0.0
+            elapsed = (self._stopped or time.monotonic()) - self._started
+            return self.stats["bytes"] / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        with self._cond:
+            stats = dict(self.stats)
+            limit = self.limit
+        cap = f"{self.bucket.rate / (1024 * 1024):.1f} MB/s cap" if self.bucket.rate else "no bandwidth cap"
+        return (f"download scheduler: {stats['bytes'] / (1024 * 1024):.1f} MB in {stats['downloads']} downloads, "
+                f"{self.throughput() / (1024 * 1024):.2f} MB/s effective ({cap}, waited {self.bucket.waited_seconds:.0f}s), "
+                f"concurrency now {limit} (peak {stats['peak_limit']}, +{stats['increases']}/-{stats['decreases']}), "
+                f"{stats['throttle_events']} throttling signals")
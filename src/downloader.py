@@ -1,128 +1,626 @@
 # ./src/downloader.py
 import os
+import time
+import base64
+import queue
 import yt_dlp
+import threading
+import mutagen
 from concurrent.futures import ThreadPoolExecutor
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, TIT2, TPE1, TALB, TPE2
+from mutagen.mp4 import MP4, MP4Cover
+from mutagen.flac import Picture
+from mutagen.id3 import ID3, ID3NoHeaderError, TIT2, TPE1, TALB, TPE2, APIC
 from config import ALL_SONGS_DIR, RATE_LIMIT_BYTES, NUM_WORKERS
-from file_manager import add_to_m3u_playlist
+from file_manager import PlaylistBuilder, library_index, playlist_snapshots, failure_cache, staging, artwork_cache, m3u_playlist_exists
+from postprocessor import convert_audio
+from artwork_cache import write_folder_cover
+from pipeline import Stage
+from download_scheduler import AdaptiveScheduler
+from download_queue import PriorityDownloadQueue, membership_rank
+from metrics import metrics
 
-def apply_metadata(file_path, track):
-    """Forcefully embeds ytmusicapi metadata and Jellyfin required tags directly into the MP3."""
-    try:
-        audio = MP3(file_path, ID3=ID3)
+# "mp3" transcodes everything to 192k MP3. "native" keeps YouTube's own stream
+# (opus -> .opus, aac -> .m4a) and only remuxes it, which is far cheaper on CPU.
+AUDIO_FORMAT = os.getenv("AUDIO_FORMAT", "mp3").lower()
+
+# "embed" puts the album cover into every file, "folder" writes one cover.jpg per album folder instead
+COVER_ART_MODE = os.getenv("COVER_ART_MODE", "embed").lower()
+
+# Transcoding/tagging is CPU bound, so it gets its own pool sized to the machine rather than NUM_WORKERS
+POSTPROCESS_WORKERS = int(os.getenv("POSTPROCESS_WORKERS", str(os.cpu_count() or 2)))
+
+# All downloads share one bandwidth cap (bytes/s, 0 = unlimited). It defaults to what NUM_WORKERS
+# instances each throttled to RATE_LIMIT_BYTES used to add up to. Concurrency starts at
+# NUM_WORKERS and adapts between 1 and DOWNLOAD_MAX_WORKERS.
+DOWNLOAD_BANDWIDTH_LIMIT = int(os.getenv("DOWNLOAD_BANDWIDTH_LIMIT", str(int(RATE_LIMIT_BYTES or 0) * NUM_WORKERS)))
+DOWNLOAD_MAX_WORKERS = int(os.getenv("DOWNLOAD_MAX_WORKERS", str(NUM_WORKERS * 2)))
+
+def get_expected_tags(track):
+    """The tags every library file should carry for a track (Jellyfin needs the album artist)."""
+    return {
+        "title": str(track['title']),
+        "artist": str(track['artist']),
+        "albumartist": str(track['artist']),
+        "album": str(track['album']),
+    }
+
+# Where each tag lives per container: (ID3 frame, MP4 atom, Vorbis comment)
+TAG_FIELDS = {
+    "title": (TIT2, "\xa9nam", "title"),
+    "artist": (TPE1, "\xa9ART", "artist"),
+    "albumartist": (TPE2, "aART", "albumartist"),
+    "album": (TALB, "\xa9alb", "album"),
+}
+
+def _open_tags(file_path):
+    """Opens just the tag block of a file, without parsing the audio stream."""
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == ".mp3":
         try:
-            audio.add_tags()
-        except Exception:
-            pass # Tags already exist
-        
-        audio.tags.add(TIT2(encoding=3, text=track['title']))
-        audio.tags.add(TPE1(encoding=3, text=track['artist']))
-        audio.tags.add(TPE2(encoding=3, text=track['artist'])) # Jellyfin Album Artist
-        audio.tags.add(TALB(encoding=3, text=track['album']))
+            return ext, ID3(file_path)
+        except ID3NoHeaderError:
+            return ext, ID3()
+    if ext == ".m4a":
+        return ext, MP4(file_path)
+    # Opus/Ogg use Vorbis comments
+    return ext, mutagen.File(file_path)
+
+def _tag_value(ext, audio, field):
+    frame, atom, comment = TAG_FIELDS[field]
+    if ext == ".mp3":
+        values = audio.getall(frame.__name__)
+        return str(values[0].text[0]) if values and values[0].text else None
+    tags = audio.tags if ext == ".m4a" else audio
+    key = atom if ext == ".m4a" else comment
+    values = tags.get(key) if tags is not None else None
+    return str(values[0]) if values else None
+
+def read_tags(file_path):
+    """Returns the file's current {title, artist, albumartist, album} (None for missing tags)."""
+    ext, audio = _open_tags(file_path)
+    return {field: _tag_value(ext, audio, field) for field in TAG_FIELDS}
+
+def _current_cover(ext, audio):
+    if ext == ".mp3":
+        pictures = audio.getall("APIC")
+        return pictures[0].data if pictures else None
+    if ext == ".m4a":
+        covers = audio.tags.get("covr") if audio.tags is not None else None
+        return bytes(covers[0]) if covers else None
+    pictures = audio.get("metadata_block_picture")
+    return Picture(base64.b64decode(pictures[0])).data if pictures else None
+
+def apply_metadata(file_path, track, cover_data=None):
+    """Forcefully embeds ytmusicapi metadata, Jellyfin required tags and cover art (JPEG bytes) into the file.
+
+    Tags and cover are compared with what the file already has first, and the file is only
+    saved if something differs. Returns True if it was rewritten.
+    """
+    try:
+        ext, audio = _open_tags(file_path)
+        expected = get_expected_tags(track)
+        changed = [field for field, value in expected.items() if _tag_value(ext, audio, field) != value]
+        cover_changed = bool(cover_data) and _current_cover(ext, audio) != cover_data
+        if not changed and not cover_changed:
+            return False
+
+        if ext == ".mp3":
+            for field in changed:
+                audio.add(TAG_FIELDS[field][0](encoding=3, text=expected[field]))
+            if cover_changed:
+                audio.delall("APIC")
+                audio.add(APIC(encoding=3, mime="image/jpeg", type=3, desc="Cover", data=cover_data))
+            audio.save(file_path)
+            return True
+
+        if ext == ".m4a":
+            if audio.tags is None:
+                audio.add_tags()
+            for field in changed:
+                audio[TAG_FIELDS[field][1]] = expected[field]
+            if cover_changed:
+                audio["covr"] = [MP4Cover(cover_data, imageformat=MP4Cover.FORMAT_JPEG)]
+        else:
+            for field in changed:
+                audio[TAG_FIELDS[field][2]] = expected[field]
+            if cover_changed:
+                picture = Picture()
+                picture.type = 3
+                picture.mime = "image/jpeg"
+                picture.desc = "Cover"
+                picture.data = cover_data
+                audio["metadata_block_picture"] = [base64.b64encode(picture.write()).decode("ascii")]
         audio.save()
-    except Exception as e:
-        pass
+        return True
+    except Exception:
+        return False
+
+def get_downloaded_file(info, expected_filename):
+    """Returns the path of the raw audio yt-dlp wrote to disk, or None."""
+    for download in info.get('requested_downloads') or []:
+        if download.get('filepath') and os.path.exists(download['filepath']):
+            return download['filepath']
+    if os.path.exists(expected_filename):
+        return expected_filename
+    return None
 
 def get_safe_filename(name):
     return "".join(x for x in str(name) if x.isalnum() or x in " -_") or "Unknown"
 
 def find_existing_file(video_id):
-    if not os.path.exists(ALL_SONGS_DIR):
-        return None
-    search_string = f"[{video_id}].mp3"
-    
-    for root, dirs, files in os.walk(ALL_SONGS_DIR):
-        for filename in files:
-            if filename.endswith(search_string):
-                return os.path.join(root, filename)
-    return None
+    # O(1) lookup in the persistent library index instead of walking All_Songs every time
+    return library_index.lookup(video_id)
 
-def download_track(track):
-    """Downloads a single track and routes it to the correct Jellyfin folder."""
-    
-    # Remove noisy print statements so they don't break the progress bar display.
-    if not track.get('video_id'):
-        return
-        
-    existing_file = find_existing_file(track['video_id'])
-    if existing_file:
-        add_to_m3u_playlist(existing_file, track['playlist_name'])
-        return
+COOKIES_FILE = '/app/cookies.txt'
 
-    video_url = f"https://www.youtube.com/watch?v={track['video_id']}"
-    
-    safe_artist = get_safe_filename(track['artist'])
-    safe_album = get_safe_filename(track['album'])
-    safe_title = get_safe_filename(track['title'])
-    
-    plex_dir = os.path.join(ALL_SONGS_DIR, safe_artist, safe_album)
-    os.makedirs(plex_dir, exist_ok=True)
-    
-    out_path = os.path.join(plex_dir, f"{safe_title} [{track['video_id']}].%(ext)s")
-    
+def build_ydl_opts(scheduler=None):
+    """yt-dlp options shared by every download of a sync job.
+
+    With a scheduler, bandwidth is metered through its shared token bucket and throttling
+    errors are reported to it, instead of every instance getting its own ratelimit.
+    """
+    # Everything lands in the track's local staging folder, the library path is only used when publishing
+    out_template = os.path.join(staging.root, "%(amps_video_id)s", "%(amps_video_id)s.%(ext)s")
+
+    # No postprocessors and no thumbnail, transcoding, tagging and cover art happen in the postprocess stage
     ydl_opts = {
         'format': 'bestaudio/best',
-        'outtmpl': out_path,
-        'ratelimit': RATE_LIMIT_BYTES,
-        'writethumbnail': True,
-        'postprocessors': [
-            {'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '192'},
-            {'key': 'EmbedThumbnail'}
-        ],
+        'outtmpl': out_template,
         'extractor_args': {
             'youtube': {'player_client': ['default', 'web_safari', 'web_embedded']}
         },
         'quiet': True,
         'no_warnings': True,
-        'logger': YtLogger(),
+        'logger': YtLogger(scheduler.record_throttle if scheduler else None),
     }
+    if scheduler:
+        ydl_opts['progress_hooks'] = [scheduler.progress_hook]
+    else:
+        ydl_opts['ratelimit'] = RATE_LIMIT_BYTES
+
+    if os.path.exists(COOKIES_FILE) and os.path.getsize(COOKIES_FILE) > 0:
+        ydl_opts['cookiefile'] = COOKIES_FILE
+    return ydl_opts
+
+class YtDlpSessions:
+    """Keeps one warm YoutubeDL per download worker thread for the life of a sync job.
+
+    Building a YoutubeDL re-reads the cookie file and sets up extractors, and each instance
+    owns its own HTTP connection pool and player/signature caches, so reusing them saves
+    that work on every track after a worker's first.
+    """
+
+    def __init__(self, scheduler=None):
+        # Options (and the cookie file check) are worked out once per job
+        self._opts = build_ydl_opts(scheduler)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._instances = []
+
+    def get(self):
+        ydl = getattr(self._local, 'ydl', None)
+        if ydl is None:
+            ydl = yt_dlp.YoutubeDL(self._opts)
+            self._local.ydl = ydl
+            with self._lock:
+                self._instances.append(ydl)
+        return ydl
+
+    def __len__(self):
+        return len(self._instances)
 
-    if os.path.exists('/app/cookies.txt') and os.path.getsize('/app/cookies.txt') > 0:
-        ydl_opts['cookiefile'] = '/app/cookies.txt'
+    def close(self):
+        with self._lock:
+            instances, self._instances = self._instances, []
+        for ydl in instances:
+            try:
+                ydl.close()
+            except Exception:
+                pass
 
+def get_library_path(track, ext):
+    """Where a finished track lives in the library: All_Songs/Artist/Album/Title [video_id].ext"""
+    safe_artist = get_safe_filename(track['artist'])
+    safe_album = get_safe_filename(track['album'])
+    safe_title = get_safe_filename(track['title'])
+    return os.path.join(ALL_SONGS_DIR, safe_artist, safe_album, f"{safe_title} [{track['video_id']}]{ext}")
+
+def download_raw_audio(track, sessions=None):
+    """Network stage: downloads the untouched bestaudio stream into local staging.
+
+    Uses the calling worker's YoutubeDL from sessions, or a one-off instance without it.
+    Returns {'raw_path', 'thumbnail_url'} or None if the download failed, in which case the
+    failure is filed in the failure cache and the staging folder is released.
+    """
+    video_url = f"https://www.youtube.com/watch?v={track['video_id']}"
+    extra_info = {'amps_video_id': track['video_id']}
+
+    # Blocks while the staging area is over its size cap
+    staging.claim(track['video_id'])
+    start = time.perf_counter()
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=True)
+        if sessions is not None:
+            ydl = sessions.get()
+            info = ydl.extract_info(video_url, download=True, extra_info=extra_info)
+        else:
+            with yt_dlp.YoutubeDL(build_ydl_opts()) as ydl:
+                info = ydl.extract_info(video_url, download=True, extra_info=extra_info)
             
-            if info:
-                expected_filename = ydl.prepare_filename(info)
-                base, _ = os.path.splitext(expected_filename)
-                final_filename = base + ".mp3"
-                
-                if os.path.exists(final_filename):
-                    apply_metadata(final_filename, track)
-                    add_to_m3u_playlist(final_filename, track['playlist_name'])
+        if info:
+            raw_path = get_downloaded_file(info, ydl.prepare_filename(info))
+            if raw_path:
+                failure_cache.record_success(track['video_id'])
+                metrics.observe("stage_seconds", time.perf_counter() - start, stage="download")
+                # YouTube Music's album art if we have it, the video thumbnail otherwise
+                return {'raw_path': raw_path, 'thumbnail_url': track.get('thumbnail_url') or info.get('thumbnail')}
+        reason = failure_cache.record_failure(track, "yt-dlp finished without an audio file")
+    except Exception as e:
+        reason = failure_cache.record_failure(track, str(e))
+    metrics.observe("stage_seconds", time.perf_counter() - start, stage="download")
+    metrics.inc("failures_total", reason=reason)
+    staging.release(track['video_id'])
+    return None
+
+def postprocess_track(download, track):
+    """CPU stage: transcodes/remuxes, tags and embeds the cover in staging, then publishes the file.
+
+    The library share only sees the finished file, copied once and renamed into place.
+    The cover comes from the album-level artwork cache and goes into the same tag save, or
+    into the album folder's cover.jpg with COVER_ART_MODE=folder.
+    Returns the final library path, or None if processing failed.
+    """
+    try:
+        with metrics.timer("stage_seconds", stage="transcode"):
+            staged_filename = convert_audio(download['raw_path'], AUDIO_FORMAT)
+        with metrics.timer("stage_seconds", stage="thumbnail"):
+            cover_data = artwork_cache.get(track, download.get('thumbnail_url'))
+        with metrics.timer("stage_seconds", stage="tag"):
+            apply_metadata(staged_filename, track, cover_data if COVER_ART_MODE != "folder" else None)
+    except Exception:
+        metrics.inc("failures_total", reason="transcode")
+        staging.release(track['video_id'])
+        return None
+
+    try:
+        # Inside the try so the staging slot is released even if the library path can't be built
+        final_filename = get_library_path(track, os.path.splitext(staged_filename)[1])
+        with metrics.timer("stage_seconds", stage="publish"):
+            size = staging.publish(staged_filename, final_filename)
     except Exception as e:
-        pass
+        console.print(f"[red]Could not copy {os.path.basename(staged_filename)} to the library: {e}[/red]")
+        metrics.inc("failures_total", reason="publish")
+        return None
+    finally:
+        staging.release(track['video_id'])
+    metrics.inc("library_bytes_written_total", size)
+    if cover_data and COVER_ART_MODE == "folder":
+        try:
+            write_folder_cover(os.path.dirname(final_filename), cover_data)
+        except Exception as e:
+            console.print(f"[yellow]Could not write cover.jpg for {track['album']}: {e}[/yellow]")
+    library_index.add(track['video_id'], final_filename)
+    return final_filename
 
 from rich.console import Console
 from rich.progress import Progress, SpinnerColumn, BarColumn, TextColumn, TimeElapsedColumn
 
 console = Console()
 
+# How many discovered tracks can wait between playlist fetching and the download pool
+TRACK_QUEUE_SIZE = 500
+# How many unique downloads can wait in priority order in front of the download pool
+DOWNLOAD_QUEUE_SIZE = 1000
+_END_OF_TRACKS = object()
+
+# yt-dlp errors that mean YouTube is pushing back on us rather than a single video failing
+THROTTLE_MARKERS = ("bot", "Sign in", "HTTP Error 429", "Too Many Requests")
+
 class YtLogger:
+    def __init__(self, on_throttle=None):
+        self.on_throttle = on_throttle
+
     def debug(self, msg): pass
     def warning(self, msg): pass
     def error(self, msg): 
+        throttled = any(marker in msg for marker in THROTTLE_MARKERS)
+        if throttled and self.on_throttle:
+            self.on_throttle()
         # Ignore normal errors like "Video unavailable" to avoid spam, but show critical ones
-        if "reloaded" in msg or "DRM" in msg or "bot" in msg or "Sign in" in msg:
+        if "reloaded" in msg or "DRM" in msg or throttled:
             console.print(f"[bold red]yt-dlp Error:[/bold red] {msg}")
 
-def process_downloads(tracks):
-    total = len(tracks)
+class DownloadJob:
+    """One download per video_id, shared by every playlist that contains the song.
+
+    priority orders waiting jobs (lowest first): the best (playlist class, position) of any
+    playlist containing the song, then the number of playlists that contain it.
+    """
+
+    def __init__(self, track):
+        self.track = track
+        self.memberships = []
+        self.future = None
+        self.file_path = None
+        self.done = False
+        # The failure cache said not to try it this run
+        self.skipped = False
+        self.priority = None
+        self._best_rank = None
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def on_ready(self, callback):
+        """Registers callback(file_path, playlist_name, position, skipped) for every playlist membership.
+
+        file_path is None when the song could not be downloaded, so callers can still tell
+        when every song of a playlist has been dealt with. skipped tells a song the failure
+        cache skipped on purpose apart from one that failed this run.
+        """
+        self._listeners.append(callback)
+
+    def add_membership(self, playlist_name, position, playlist_class=None):
+        rank = membership_rank(playlist_class, position)
+        with self._lock:
+            self.memberships.append((playlist_name, position))
+            self._best_rank = min(self._best_rank, rank) if self._best_rank else rank
+            self.priority = (*self._best_rank, -len(self.memberships))
+            if not self.done:
+                return
+        # Download already finished, so fan this playlist out straight away
+        self._notify([(playlist_name, position)])
+
+    def finish(self, file_path):
+        with self._lock:
+            self.file_path = file_path
+            self.done = True
+            memberships = list(self.memberships)
+        self._notify(memberships)
+
+    def _notify(self, memberships):
+        for playlist_name, position in memberships:
+            for callback in self._listeners:
+                callback(self.file_path, playlist_name, position, self.skipped)
+
+class DownloadJobs:
+    """Collapses tracks by video_id so the same song is only ever downloaded once per run."""
+
+    def __init__(self, download_queue, worker):
+        # New jobs wait in download_queue (a PriorityDownloadQueue) until the pool has room
+        self._queue = download_queue
+        self._worker = worker
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, video_id):
+        return video_id in self._jobs
+
+    def submit(self, track, on_ready=None):
+        """Queues a track, or joins the existing job if its video_id is already queued/in flight."""
+        video_id = track.get('video_id')
+        if not video_id:
+            return None
+        with self._lock:
+            job = self._jobs.get(video_id)
+            is_new = job is None
+            if is_new:
+                job = self._jobs[video_id] = DownloadJob(track)
+                if on_ready:
+                    job.on_ready(on_ready)
+            else:
+                self.duplicates += 1
+        job.add_membership(track['playlist_name'], track.get('position', 0), track.get('playlist_class'))
+        if is_new:
+            job.future = self._queue.submit(self._worker, job)
+        else:
+            # Wanted by one more playlist, which may move it up the queue
+            self._queue.reprioritize(job)
+        return job.future
+
+def process_downloads(tracks, started_at=None, on_playlist_published=None):
+    """Downloads every track and writes each playlist's .m3u once all of its songs are known.
+
+    Downloads run in priority order (feed mixes first, see PriorityDownloadQueue), and a
+    playlist is published the moment its last song is dealt with rather than at the end of
+    the job. on_playlist_published(playlist_name, file_paths) is then called for every
+    playlist written early, one at a time on a publisher thread.
+    Playlists whose tracks match the last completed run (see PlaylistSnapshots) keep their
+    existing .m3u. Returns a summary dict with the PlaylistBuilder, the playlists written
+    and skipped, and how many songs were newly downloaded.
+
+    tracks can be any iterable (e.g. the iter_playlist_tracks generator). It is drained on
+    a producer thread into a bounded queue, so downloads start while playlists are still
+    being fetched. started_at is the time.perf_counter() that time-to-first-download is
+    measured from (defaults to now).
+    """
+    if started_at is None:
+        started_at = time.perf_counter()
     completed = 0
-    
-    def track_wrapper(track):
-        nonlocal completed
+    downloaded = 0
+    completed_lock = threading.Lock()
+    first_download = {}
+    playlists = PlaylistBuilder()
+    failure_cache.load(cookies_path=COOKIES_FILE)
+    artwork_cache.load()
+    leftover_bytes = staging.cleanup_leftovers()
+    if leftover_bytes:
+        console.print(f"[yellow]Cleaned {leftover_bytes / (1024 * 1024):.1f} MB of leftovers from an interrupted run out of staging.[/yellow]")
+    track_queue = queue.Queue(maxsize=TRACK_QUEUE_SIZE)
+    seen_tracks = 0
+
+    # Network-bound downloads and CPU-bound transcode/tag run in separately sized pools,
+    # each with its own bounded queue so a slow side pushes back instead of piling up
+    # The download stage has threads for the most workers the scheduler may allow, the
+    # scheduler decides how many of them actually download at once
+    scheduler = AdaptiveScheduler(min_workers=1, max_workers=DOWNLOAD_MAX_WORKERS,
+                                  start_workers=NUM_WORKERS, bandwidth=DOWNLOAD_BANDWIDTH_LIMIT)
+    # No extra queue in the stage itself: waiting jobs stay in the priority queue in front of it
+    download_stage = Stage("download", scheduler.max_workers, 0)
+    download_queue = PriorityDownloadQueue(download_stage, DOWNLOAD_QUEUE_SIZE)
+    postprocess_stage = Stage("postprocess", POSTPROCESS_WORKERS, POSTPROCESS_WORKERS * 2)
+    sessions = YtDlpSessions(scheduler)
+
+    # Playlists are published on their own thread as soon as every one of their songs is resolved
+    publisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="publish")
+    resolved_counts = {}
+    skipped_counts = {}
+    published = set()
+    written = []
+    unchanged = set()
+
+    def publish_playlist(playlist_name):
+        if playlist_snapshots.is_unchanged(playlist_name, len(playlists.get_paths(playlist_name))) and m3u_playlist_exists(playlist_name):
+            unchanged.add(playlist_name)
+        else:
+            file_paths = playlists.write(playlist_name)
+            playlist_snapshots.commit(playlist_name, len(file_paths), skipped_counts.get(playlist_name, 0))
+            written.append(playlist_name)
+            console.print(f"[green]Published '{playlist_name}' ({len(file_paths)} songs) after {time.perf_counter() - started_at:.0f}s.[/green]")
+            if on_playlist_published:
+                try:
+                    on_playlist_published(playlist_name, file_paths)
+                except Exception as e:
+                    console.print(f"[red]Early media server update of '{playlist_name}' failed: {e}[/red]")
+        published.add(playlist_name)
+
+    def on_resolved(file_path, playlist_name, position, skipped):
+        if file_path:
+            playlists.add(file_path, playlist_name, position)
+        with completed_lock:
+            resolved_counts[playlist_name] = resolved_counts.get(playlist_name, 0) + 1
+            if skipped:
+                skipped_counts[playlist_name] = skipped_counts.get(playlist_name, 0) + 1
+            is_complete = resolved_counts[playlist_name] == playlist_snapshots.expected_tracks(playlist_name)
+        # Nothing to publish if none of its songs could be downloaded
+        if is_complete and playlists.get_paths(playlist_name):
+            publisher.submit(publish_playlist, playlist_name)
+
+    def complete(job, file_path, is_new):
+        nonlocal completed, downloaded
+        job.finish(file_path)
+        if file_path:
+            metrics.inc("tracks_total", result="downloaded" if is_new else "existing")
+        else:
+            metrics.inc("tracks_total", result="failed" if is_new else "skipped")
+        with completed_lock:
+            completed += 1
+            if file_path and is_new:
+                downloaded += 1
+            done_count = completed
+            if file_path and "finished" not in first_download:
+                first_download["finished"] = time.perf_counter() - started_at
+        if done_count % 10 == 0:
+            console.print(f"[cyan]Progress:[/cyan] {done_count}/{len(jobs)} unique tracks processed...")
+
+    def postprocess_job(job, download):
+        file_path = None
         try:
-            download_track(track)
+            file_path = postprocess_track(download, job.track)
         except Exception:
             pass
         finally:
-            completed += 1
-            if completed % 10 == 0 or completed == total:
-                console.print(f"[cyan]Progress:[/cyan] {completed}/{total} tracks processed...")
+            complete(job, file_path, True)
+
+    def download_job(job):
+        try:
+            existing_file = find_existing_file(job.track['video_id'])
+            metrics.inc("cache_requests_total", cache="library_index", result="hit" if existing_file else "miss")
+            if existing_file:
+                complete(job, existing_file, False)
+                return
+            # Known dead or still backing off from a recent failure
+            skip = failure_cache.should_skip(job.track['video_id'])
+            metrics.inc("cache_requests_total", cache="failure_cache", result="hit" if skip else "miss")
+            if skip:
+                job.skipped = True
+                complete(job, None, False)
+                return
+            with scheduler.slot():
+                download = download_raw_audio(job.track, sessions)
+        except Exception:
+            download = None
+        if download:
+            # Blocks while the postprocess queue is full
+            postprocess_stage.submit(postprocess_job, job, download)
+        else:
+            complete(job, None, True)
+
+    def producer():
+        try:
+            for track in tracks:
+                track_queue.put(track)
+        except Exception as e:
+            console.print(f"[red]Playlist discovery failed: {e}[/red]")
+        finally:
+            track_queue.put(_END_OF_TRACKS)
+
+    threading.Thread(target=producer, name="playlist-producer", daemon=True).start()
 
-    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
-        executor.map(track_wrapper, tracks)
\ No newline at end of file
+    jobs = DownloadJobs(download_queue, download_job)
+    try:
+        while True:
+            track = track_queue.get()
+            if track is _END_OF_TRACKS:
+                break
+            seen_tracks += 1
+            if "queued" not in first_download and track.get('video_id'):
+                first_download["queued"] = time.perf_counter() - started_at
+            jobs.submit(track, on_ready=on_resolved)
+    finally:
+        # Downloads feed the postprocess stage, so they have to drain first
+        download_queue.close()
+        download_stage.shutdown()
+        postprocess_stage.shutdown()
+        sessions_used = len(sessions)
+        sessions.close()
+
+    console.print(f"[cyan]Progress:[/cyan] {completed}/{len(jobs)} unique tracks processed ({seen_tracks} playlist entries).")
+    if jobs.duplicates:
+        console.print(f"[dim]Collapsed {jobs.duplicates} duplicate playlist entries into shared downloads.[/dim]")
+    console.print(f"[dim]{download_queue.summary()}[/dim]")
+    console.print(f"[dim]{download_stage.summary()} ({sessions_used} yt-dlp sessions reused)[/dim]")
+    console.print(f"[dim]{postprocess_stage.summary()}[/dim]")
+    console.print(f"[dim]{scheduler.summary()}[/dim]")
+    console.print(f"[dim]{staging.summary()}[/dim]")
+    console.print(f"[dim]{artwork_cache.summary()}[/dim]")
+    metrics.inc("cache_requests_total", artwork_cache.stats["hits"], cache="artwork", result="hit")
+    metrics.inc("cache_requests_total", artwork_cache.stats["misses"], cache="artwork", result="miss")
+    metrics.inc("downloaded_bytes_total", scheduler.stats["bytes"])
+    if "queued" in first_download:
+        finished = first_download.get("finished")
+        finished_text = f"{finished:.1f}s" if finished is not None else "never"
+        console.print(f"[dim]Time to first download: queued after {first_download['queued']:.1f}s, first file ready after {finished_text}.[/dim]")
+
+    if failure_cache.skipped or len(failure_cache):
+        console.print(f"[dim]Skipped {failure_cache.skipped} tracks that failed before, {len(failure_cache)} failures cached:[/dim]")
+        for line in failure_cache.report_lines():
+            console.print(f"[dim]  {line}[/dim]")
+
+    # Fold this run's journal entries back into the index snapshot
+    library_index.save()
+    failure_cache.save()
+    artwork_cache.save()
+
+    # Whatever wasn't published early (e.g. the song count didn't add up) is written now.
+    # Only playlists that changed since the last complete run get rewritten.
+    publisher.shutdown(wait=True)
+    published_early = len(written)
+    remaining = [name for name in playlists.playlist_names() if name not in published]
+    unchanged |= {name for name in remaining
+                  if playlist_snapshots.is_unchanged(name, len(playlists.get_paths(name))) and m3u_playlist_exists(name)}
+    with metrics.timer("stage_seconds", stage="m3u_write"):
+        written_late = playlists.write_all(skip=published | unchanged)
+    for playlist_name in written_late:
+        playlist_snapshots.commit(playlist_name, len(playlists.get_paths(playlist_name)), skipped_counts.get(playlist_name, 0))
+    written.extend(written_late)
+    console.print(f"[green]Wrote {len(written)} playlist files ({published_early} published as soon as they were complete), "
+                  f"{len(unchanged)} unchanged. {downloaded} new songs downloaded.[/green]")
+    return {
+        "playlists": playlists,
+        "written": written,
+        "unchanged": unchanged,
+        "downloaded": downloaded,
+    }
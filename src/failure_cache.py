@@ -0,0 +1,154 @@
+# ./src/failure_cache.py
+import os
+import json
+import time
+import threading
+from atomic_file import write_atomic
+
+FAILURE_CACHE_VERSION = 1
+
+# Transient failures are retried after base * 2^(attempts - 1), capped. Runs are twice a day,
+# so the first retry still happens on the next run.
+FAILURE_RETRY_BASE_HOURS = float(os.getenv("FAILURE_RETRY_BASE_HOURS", "6"))
+FAILURE_RETRY_MAX_HOURS = 14 * 24
+# Even "permanent" failures get one more try after this long (videos do get un-privated)
+FAILURE_PERMANENT_RECHECK_DAYS = float(os.getenv("FAILURE_PERMANENT_RECHECK_DAYS", "30"))
+
+# (reason, permanent, markers), first match wins. Matched against yt-dlp's error message.
+FAILURE_REASONS = (
+    ("throttled", False, ("not a bot", "HTTP Error 429", "Too Many Requests")),
+    ("drm", True, ("DRM",)),
+    ("region_locked", True, ("in your country", "geo restrict", "geo-restrict")),
+    ("private", True, ("Private video",)),
+    ("members_only", True, ("members-only", "Join this channel")),
+    ("removed", True, ("removed by the uploader", "account associated with this video has been terminated",
+                       "no longer available")),
+    ("age_restricted", False, ("confirm your age", "age-restricted")),
+    ("unavailable", True, ("Video unavailable", "video is not available", "This video is unavailable")),
+)
+# Failures that depend on the account in cookies.txt rather than the video, forgotten when it changes
+AUTH_FAILURE_REASONS = {"private", "members_only", "age_restricted"}
+
+def classify_failure(message):
+    """Returns (reason, permanent) for a yt-dlp error message."""
+    for reason, permanent, markers in FAILURE_REASONS:
+        if any(marker.lower() in message.lower() for marker in markers):
+            return reason, permanent
+    return "error", False
+
+class FailureCache:
+    """Negative cache of video_ids that failed to download, so they aren't retried in full every run.
+
+    Permanent failures (removed, private, region locked, DRM...) are skipped until the recheck
+    period runs out, everything else backs off exponentially. Throttling is YouTube's problem
+    with us rather than with the video, so it is never cached. Failures another account could
+    get past (private, members-only, age check) are dropped when cookies.txt changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._cookies_mtime = None
+        self.skipped = 0
+
+    def load(self, cookies_path=None):
+        failures = {}
+        cookies_mtime = None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") == FAILURE_CACHE_VERSION:
+                failures = data.get("failures", {})
+                cookies_mtime = data.get("cookies_mtime")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Download failure cache is unreadable, starting fresh: {e}")
+        if cookies_path:
+            try:
+                current_mtime = os.path.getmtime(cookies_path)
+            except OSError:
+                current_mtime = None
+            if current_mtime != cookies_mtime:
+                auth_failures = [video_id for video_id, entry in failures.items() if entry.get("reason") in AUTH_FAILURE_REASONS]
+                for video_id in auth_failures:
+                    del failures[video_id]
+                if auth_failures:
+                    print(f"cookies.txt changed, retrying {len(auth_failures)} private/members-only/age-restricted tracks.")
+                cookies_mtime = current_mtime
+        with self._lock:
+            self._failures = failures
+            self._cookies_mtime = cookies_mtime
+            self.skipped = 0
+
+    def should_skip(self, video_id, now=None):
+        """True if video_id failed before and isn't due for another attempt yet."""
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._failures.get(video_id)
+            if not entry or now >= entry["retry_at"]:
+                return False
+            self.skipped += 1
+            return True
+
+    def record_failure(self, track, message, now=None):
+        """Caches a failed download. Returns the reason it was filed under."""
+        now = time.time() if now is None else now
+        reason, permanent = classify_failure(message)
+        if reason == "throttled":
+            return reason
+        with self._lock:
+            entry = self._failures.get(track['video_id'], {})
+            attempts = entry.get("attempts", 0) + 1
+            if permanent:
+                delay = FAILURE_PERMANENT_RECHECK_DAYS * 24 * 3600
+            else:
+                delay = min(FAILURE_RETRY_BASE_HOURS * 2 ** (attempts - 1), FAILURE_RETRY_MAX_HOURS) * 3600
+            self._failures[track['video_id']] = {
+                "reason": reason,
+                "permanent": permanent,
+                "message": message[-300:],
+                "title": f"{track.get('artist', '')} - {track.get('title', '')}",
+                "attempts": attempts,
+                "first_failed": entry.get("first_failed", now),
+                "last_failed": now,
+                "retry_at": now + delay,
+            }
+        return reason
+
+    def record_success(self, video_id):
+        with self._lock:
+            self._failures.pop(video_id, None)
+
+    def report(self):
+        """Cached failures grouped by reason: {reason: [entry, ...]}, oldest first."""
+        with self._lock:
+            entries = [dict(entry, video_id=video_id) for video_id, entry in self._failures.items()]
+        grouped = {}
+        for entry in sorted(entries, key=lambda entry: entry["first_failed"]):
+            grouped.setdefault(entry["reason"], []).append(entry)
+        return grouped
+
+    def report_lines(self, examples=3):
+        lines = []
+        for reason, entries in sorted(self.report().items(), key=lambda item: -len(item[1])):
+            kind = "skipped" if entries[0]["permanent"] else "backing off"
+            sample = ", ".join(f"{entry['title']} [{entry['video_id']}]" for entry in entries[:examples])
+            more = f" and {len(entries) - examples} more" if len(entries) > examples else ""
+            lines.append(f"{reason} ({kind}): {len(entries)} tracks, e.g. {sample}{more}")
+        return lines
+
+    def __len__(self):
+        with self._lock:
+            return len(self._failures)
+
+    def save(self):
+        with self._lock:
+            data = {"version": FAILURE_CACHE_VERSION, "failures": self._failures, "cookies_mtime": self._cookies_mtime}
+            content = json.dumps(data)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_atomic(self.path, content)
+        except Exception as e:
+            print(f"Could not save the download failure cache: {e}")
@@ -1,122 +1,213 @@
 # ./src/file_manager.py
 import os
 import glob
-import shutil
+import time
+import threading
 from config import ALL_SONGS_DIR, PLAYLISTS_DIR, DELETE_ORPHANED_SONGS
+from atomic_file import write_atomic
+from library_index import LibraryIndex
+from playlist_snapshots import PlaylistSnapshots
+from failure_cache import FailureCache
+from staging import StagingArea
+from artwork_cache import ArtworkCache, ARTWORK_CACHE_MAX_MB
+from library_cleanup import prune_library, new_cleanup_stats
 
 # Path constants for Docker environment
 DOCKER_DOWNLOADS_PATH = "/app/downloads"
 JELLYFIN_MUSIC_PATH = os.getenv("JELLYFIN_MUSIC_PATH", "/media/music")
 PLEX_MUSIC_PATH = os.getenv("PLEX_MUSIC_PATH", "/media/music")
 
+# Set to "true" to only report what the orphan cleanup would delete
+ORPHAN_CLEANUP_DRY_RUN = os.getenv("ORPHAN_CLEANUP_DRY_RUN", "false").lower() == "true"
+
+# Jellyfin imports every .m3u in its library as a file-backed playlist. With an API key its playlists
+# are created through the API instead, so the playlist folder is hidden from it with a .ignore file
+JELLYFIN_API_PLAYLISTS = bool(os.getenv("JELLYFIN_API_KEY"))
+
+# Hidden folder on the downloads volume for AmpsAssist's own bookkeeping files
+STATE_DIR = os.getenv("AMPS_STATE_DIR", os.path.join(DOCKER_DOWNLOADS_PATH, ".ampsassist"))
+
+# Shared video_id -> path index so we never have to walk All_Songs per track
+library_index = LibraryIndex(ALL_SONGS_DIR, os.path.join(STATE_DIR, "library_index.json"))
+
+# Last written version of every playlist, so unchanged ones can be left alone
+playlist_snapshots = PlaylistSnapshots(os.path.join(STATE_DIR, "playlist_snapshots.json"))
+
+# Videos that failed to download, so dead ones aren't retried in full every run
+failure_cache = FailureCache(os.path.join(STATE_DIR, "download_failures.json"))
+
+# Local (non-SMB) scratch space where tracks are downloaded and processed before one copy to the share
+STAGING_DIR = os.getenv("AMPS_STAGING_DIR", "/tmp/ampsassist-staging")
+STAGING_MAX_MB = int(os.getenv("STAGING_MAX_MB", "2048"))
+staging = StagingArea(STAGING_DIR, STAGING_MAX_MB * 1024 * 1024)
+
+# Resized album covers, fetched once per album instead of once per track
+artwork_cache = ArtworkCache(os.getenv("ARTWORK_CACHE_DIR", os.path.join(STATE_DIR, "artwork")), ARTWORK_CACHE_MAX_MB * 1024 * 1024)
+
 def setup_directories():
     """Ensure base directories exist."""
     os.makedirs(ALL_SONGS_DIR, exist_ok=True)
     os.makedirs(PLAYLISTS_DIR, exist_ok=True)
+    os.makedirs(STATE_DIR, exist_ok=True)
+    ignore_path = os.path.join(PLAYLISTS_DIR, ".ignore")
+    if JELLYFIN_API_PLAYLISTS and not os.path.exists(ignore_path):
+        # Empty means the whole folder (Jellyfin 10.9+)
+        open(ignore_path, 'w').close()
+
+def get_safe_playlist_name(playlist_name):
+    return "".join(x for x in playlist_name if x.isalnum() or x in " -_")
 
-def clear_old_playlists():
-    """Deletes old .m3u files before a fresh sync so mixes stay perfectly up-to-date."""
+def get_m3u_playlist_key(m3u_name):
+    """Maps an .m3u filename (or Plex playlist title) back to its safe playlist name."""
+    title = m3u_name[:-4] if m3u_name.endswith(".m3u") else m3u_name
+    for suffix in ("_jellyfin", "_plex"):
+        if JELLYFIN_MUSIC_PATH != PLEX_MUSIC_PATH and title.endswith(suffix):
+            return title[:-len(suffix)]
+    return title
+
+def to_local_path(media_path, media_root):
+    """Maps a path as a media server sees it to the normalised path inside this container."""
+    media_root = media_root.rstrip("/")
+    if media_path == media_root or media_path.startswith(media_root + "/"):
+        media_path = DOCKER_DOWNLOADS_PATH + media_path[len(media_root):]
+    return os.path.normpath(media_path)
+
+def read_m3u_paths(m3u_file):
+    with open(m3u_file, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+def clear_old_playlists(keep_playlists=None):
+    """Deletes old .m3u files so mixes stay perfectly up-to-date.
+
+    With keep_playlists, only the files of playlists that are no longer synced get removed.
+    Returns the safe names of the playlists that were removed.
+    """
     print("Clearing old playlist files...")
+    keep = None if keep_playlists is None else {get_safe_playlist_name(name) for name in keep_playlists}
+    removed = set()
     m3u_files = glob.glob(os.path.join(PLAYLISTS_DIR, "*.m3u"))
     for f in m3u_files:
+        key = get_m3u_playlist_key(os.path.basename(f))
+        if keep is not None and key in keep:
+            continue
         try:
             os.remove(f)
+            removed.add(key)
         except Exception as e:
             print(f"Could not remove old playlist {f}: {e}")
+    return removed
 
-def add_to_m3u_playlist(file_path, playlist_name):
-    """Appends the song's absolute path to .m3u playlist files."""
-    safe_playlist_name = "".join(x for x in playlist_name if x.isalnum() or x in " -_")
-    
-    jellyfin_absolute_path = file_path.replace(DOCKER_DOWNLOADS_PATH, JELLYFIN_MUSIC_PATH)
-    plex_absolute_path = file_path.replace(DOCKER_DOWNLOADS_PATH, PLEX_MUSIC_PATH)
-    
-    try:
-        # If both systems use the same internal mount path, we only need ONE file!
-        if JELLYFIN_MUSIC_PATH == PLEX_MUSIC_PATH:
-            single_m3u_path = os.path.join(PLAYLISTS_DIR, f"{safe_playlist_name}.m3u")
-            with open(single_m3u_path, 'a', encoding='utf-8') as f:
-                f.write(f"{jellyfin_absolute_path}\n")
-        else:
-            jellyfin_m3u_path = os.path.join(PLAYLISTS_DIR, f"{safe_playlist_name}_jellyfin.m3u")
-            plex_m3u_path = os.path.join(PLAYLISTS_DIR, f"{safe_playlist_name}_plex.m3u")
-            
-            with open(jellyfin_m3u_path, 'a', encoding='utf-8') as f:
-                f.write(f"{jellyfin_absolute_path}\n")
-                
-            with open(plex_m3u_path, 'a', encoding='utf-8') as f:
-                f.write(f"{plex_absolute_path}\n")
-            
-    except Exception as e:
-        print(f"Failed to add to M3U: {e}")
-
-def remove_orphaned_songs(protected_jellyfin_paths=None):
-    if not DELETE_ORPHANED_SONGS:
-        return
-
-    if protected_jellyfin_paths is None:
-        protected_jellyfin_paths = []
-
-    print("\nScanning for orphaned songs to free up storage...")
-    
-    # Gather all 'in-use' songs from the current M3U files
-    in_use_local_paths = set()
+def m3u_playlist_exists(playlist_name):
+    return all(os.path.exists(m3u_path) for m3u_path, _ in get_m3u_targets(playlist_name))
 
-    for jellyfin_path in protected_jellyfin_paths:
-        local_path = jellyfin_path.replace(JELLYFIN_MUSIC_PATH, DOCKER_DOWNLOADS_PATH)
-        in_use_local_paths.add(local_path)
+def get_m3u_targets(playlist_name):
+    """Returns [(m3u_path, media_server_path_prefix)] for every .m3u this playlist needs."""
+    safe_playlist_name = get_safe_playlist_name(playlist_name)
+
+    # If both systems use the same internal mount path, we only need ONE file!
+    if JELLYFIN_MUSIC_PATH == PLEX_MUSIC_PATH:
+        return [(os.path.join(PLAYLISTS_DIR, f"{safe_playlist_name}.m3u"), JELLYFIN_MUSIC_PATH)]
+    return [
+        (os.path.join(PLAYLISTS_DIR, f"{safe_playlist_name}_jellyfin.m3u"), JELLYFIN_MUSIC_PATH),
+        (os.path.join(PLAYLISTS_DIR, f"{safe_playlist_name}_plex.m3u"), PLEX_MUSIC_PATH),
+    ]
+
+def write_m3u_playlist(playlist_name, file_paths):
+    """Writes the song paths of one playlist to its .m3u file(s) in a single pass."""
+    for m3u_path, media_path in get_m3u_targets(playlist_name):
+        lines = [file_path.replace(DOCKER_DOWNLOADS_PATH, media_path) for file_path in file_paths]
+        try:
+            write_atomic(m3u_path, "".join(f"{line}\n" for line in lines))
+        except Exception as e:
+            print(f"Failed to write M3U {m3u_path}: {e}")
+
+class PlaylistBuilder:
+    """Collects playlist entries in memory while downloads finish in any order.
+
+    Each entry keeps its original YouTube Music position, so the .m3u files come out in
+    playlist order and are written exactly once per playlist.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._playlists = {}
+
+    def add(self, file_path, playlist_name, position=0):
+        with self._lock:
+            self._playlists.setdefault(playlist_name, []).append((position, file_path))
+
+    def get_paths(self, playlist_name):
+        with self._lock:
+            entries = sorted(self._playlists.get(playlist_name, []), key=lambda entry: entry[0])
+        return [file_path for _, file_path in entries]
+
+    def playlist_names(self):
+        with self._lock:
+            return list(self._playlists)
+
+    def write(self, playlist_name):
+        """Writes one playlist's .m3u file(s). Returns the song paths written."""
+        file_paths = self.get_paths(playlist_name)
+        write_m3u_playlist(playlist_name, file_paths)
+        return file_paths
+
+    def write_all(self, skip=None):
+        """Writes every collected playlist to disk, except those in skip. Returns the names written."""
+        written = []
+        for playlist_name in self.playlist_names():
+            if skip and playlist_name in skip:
+                continue
+            self.write(playlist_name)
+            written.append(playlist_name)
+        return written
+
+def remove_orphaned_songs(protected_paths=None, dry_run=None):
+    """Deletes songs that are no longer in any playlist, plus the folders they leave behind.
+
+    protected_paths is a set of already normalised local paths (see to_local_path) that must
+    survive, e.g. the songs of playlists saved in Plex. With dry_run (or
+    ORPHAN_CLEANUP_DRY_RUN=true) nothing is deleted and the report shows what would have
+    been reclaimed. Returns the cleanup stats.
+    """
+    if dry_run is None:
+        dry_run = ORPHAN_CLEANUP_DRY_RUN
+    if not DELETE_ORPHANED_SONGS and not dry_run:
+        return None
+
+    print("\nScanning for orphaned songs to free up storage..." + (" (dry run)" if dry_run else ""))
+    stats = new_cleanup_stats()
+    start = time.perf_counter()
+    
+    # Gather all 'in-use' songs: the protected ones plus everything in the current M3U files
+    in_use_local_paths = set(protected_paths or ())
 
-    # Protect the current active M3U files
     m3u_files = glob.glob(os.path.join(PLAYLISTS_DIR, "*.m3u"))
     
     for m3u in m3u_files:
+        # Only the _plex copy uses Plex's mount path, everything else is written with Jellyfin's
+        media_root = PLEX_MUSIC_PATH if m3u.endswith("_plex.m3u") else JELLYFIN_MUSIC_PATH
         try:
             with open(m3u, 'r', encoding='utf-8') as f:
                 for line in f:
                     media_path = line.strip()
                     if media_path:
-                        # Since JELLYFIN_MUSIC_PATH and PLEX_MUSIC_PATH are the same, 
-                        # replacing either will work. If they differ, check suffix.
-                        if "_plex" in m3u:
-                            local_path = media_path.replace(PLEX_MUSIC_PATH, DOCKER_DOWNLOADS_PATH)
-                        else:
-                            local_path = media_path.replace(JELLYFIN_MUSIC_PATH, DOCKER_DOWNLOADS_PATH)
-                        in_use_local_paths.add(local_path)
+                        in_use_local_paths.add(to_local_path(media_path, media_root))
         except Exception as e:
             print(f"Error reading {m3u}: {e}")
+    stats["timings"]["collect_in_use"] = time.perf_counter() - start
 
-    # 3. Walk through All_Songs and delete anything not in use
-    deleted_count = 0
-    for root, dirs, files in os.walk(ALL_SONGS_DIR):
-        for filename in files:
-            if filename.endswith(".mp3"):
-                file_path = os.path.join(root, filename)
-                if file_path not in in_use_local_paths:
-                    try:
-                        os.remove(file_path)
-                        print(f" -> Deleted orphaned song: {filename}")
-                        deleted_count += 1
-                    except Exception as e:
-                        print(f"Failed to delete {filename}: {e}")
-
-    # 4. Aggressive folder cleanup
-    for root, dirs, files in os.walk(ALL_SONGS_DIR, topdown=False):
-        for dir_name in dirs:
-            dir_path = os.path.join(root, dir_name)
-            
-            # Check if there are any mp3 files in this directory or its subdirectories
-            has_mp3 = False
-            for r, d, f in os.walk(dir_path):
-                if any(file.endswith(".mp3") for file in f):
-                    has_mp3 = True
-                    break
-            
-            # If no MP3s exist, forcefully delete the entire folder and any leftover thumbnails
-            if not has_mp3:
-                try:
-                    shutil.rmtree(dir_path)
-                    print(f" -> Removed empty/ghost folder: {dir_name}")
-                except Exception:
-                    pass
-    
-    print(f"Storage cleanup complete. Removed {deleted_count} unused tracks.")
\ No newline at end of file
+    # Single bottom-up pass: delete unused songs, then any folder left without an mp3
+    on_delete = None if dry_run else library_index.remove
+    prune_library(os.path.normpath(ALL_SONGS_DIR), in_use_local_paths, dry_run=dry_run, on_delete=on_delete, stats=stats)
+
+    if not dry_run:
+        library_index.save()
+
+    timings = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in stats["timings"].items())
+    megabytes = stats["bytes_reclaimed"] / (1024 * 1024)
+    if dry_run:
+        print(f"Dry run complete. Would remove {stats['orphans_deleted']} unused tracks, {stats['temp_files_deleted']} unfinished copies and {stats['dirs_removed']} folders, reclaiming {megabytes:.1f} MB.")
+    else:
+        print(f"Storage cleanup complete. Removed {stats['orphans_deleted']} unused tracks, {stats['temp_files_deleted']} unfinished copies and {stats['dirs_removed']} folders, reclaiming {megabytes:.1f} MB.")
+    print(f"Scanned {stats['files_scanned']} files in {stats['dirs_scanned']} folders ({timings}).")
+    return stats
@@ -1,41 +1,379 @@
 # ./src/jellyfin_sync.py
 import os
-import requests
+import json
+import glob
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import PLAYLISTS_DIR
+from atomic_file import write_atomic
+from file_manager import (get_m3u_playlist_key, read_m3u_paths, to_local_path,
+                          DOCKER_DOWNLOADS_PATH, JELLYFIN_MUSIC_PATH, PLEX_MUSIC_PATH, STATE_DIR)
+from media_client import MediaServerClient
+from playlist_diff import plan_membership_changes, plan_moves, moves_to_indices
 
 JELLYFIN_URL = os.getenv("JELLYFIN_URL", "http://192.168.1.230:8096")
 JELLYFIN_API_KEY = os.getenv("JELLYFIN_API_KEY")
+JELLYFIN_LIBRARY_NAME = os.getenv("JELLYFIN_LIBRARY", "Music")
+# Playlists belong to a user, defaults to the first administrator
+JELLYFIN_USER_ID = os.getenv("JELLYFIN_USER_ID")
 
-def trigger_library_scan():
-    """Tells Jellyfin to scan the library for the newly downloaded MP3s and M3Us."""
+# Refresh polling: give up after JELLYFIN_SCAN_TIMEOUT, Jellyfin debounces path updates so allow a slow start
+JELLYFIN_SCAN_TIMEOUT = int(os.getenv("JELLYFIN_SCAN_TIMEOUT", "600"))
+JELLYFIN_SCAN_POLL_CEILING = 15
+JELLYFIN_SCAN_START_GRACE = 10
+# More changed folders than this and refreshing the whole music library is cheaper
+JELLYFIN_MAX_PARTIAL_SCANS = int(os.getenv("JELLYFIN_MAX_PARTIAL_SCANS", "50"))
+
+# Playlist sync: concurrent playlists, items per listing page, ids per add/remove request
+JELLYFIN_SYNC_WORKERS = int(os.getenv("JELLYFIN_SYNC_WORKERS", "4"))
+JELLYFIN_PAGE_SIZE = 1000
+JELLYFIN_ID_BATCH = 100
+
+# Jellyfin path -> ItemId, the Ids of the playlists we created, and the playlists that still
+# miss songs Jellyfin hadn't ingested yet
+JELLYFIN_CACHE_PATH = os.path.join(STATE_DIR, "jellyfin_items.json")
+
+jellyfin_client = MediaServerClient(
+    "jellyfin", JELLYFIN_URL,
+    headers={"X-Emby-Token": JELLYFIN_API_KEY or "", "Accept": "application/json"},
+)
+
+def get_music_library():
+    """Finds the Jellyfin music library by name, falling back to the first music library."""
+    folders = jellyfin_client.get_json("/Library/VirtualFolders")
+    for folder in folders:
+        if folder.get("Name") == JELLYFIN_LIBRARY_NAME:
+            return folder
+    for folder in folders:
+        if folder.get("CollectionType") == "music":
+            return folder
+    return None
+
+def get_user_id():
+    if JELLYFIN_USER_ID:
+        return JELLYFIN_USER_ID
+    for user in jellyfin_client.get_json("/Users"):
+        if user.get("Policy", {}).get("IsAdministrator"):
+            return user["Id"]
+    return None
+
+def get_refresh_paths(changed_dirs):
+    """Maps changed local Artist/Album folders to {Jellyfin path: update type}. Returns None when a full refresh is cheaper."""
+    if len(changed_dirs) > JELLYFIN_MAX_PARTIAL_SCANS:
+        return None
+    paths = {}
+    for local_dir in changed_dirs:
+        # A folder the orphan cleanup removed is reported as deleted, Jellyfin drops its songs
+        update_type = "Modified" if os.path.isdir(local_dir) else "Deleted"
+        paths[local_dir.replace(DOCKER_DOWNLOADS_PATH, JELLYFIN_MUSIC_PATH)] = update_type
+    return dict(sorted(paths.items()))
+
+def trigger_refresh(library, paths=None):
+    """Refreshes only the given folders ({path: update type}), or the music library, instead of every library on the server."""
+    if paths:
+        updates = [{"Path": path, "UpdateType": update_type} for path, update_type in paths.items()]
+        response = jellyfin_client.post("/Library/Media/Updated", json={"Updates": updates})
+    elif library:
+        response = jellyfin_client.post(f"/Items/{library['ItemId']}/Refresh", params={
+            "Recursive": "true", "MetadataRefreshMode": "Default", "ImageRefreshMode": "Default",
+        })
+    else:
+        response = jellyfin_client.post("/Library/Refresh")
+    response.raise_for_status()
+
+def is_library_refreshing(library_id):
+    for folder in jellyfin_client.get_json("/Library/VirtualFolders"):
+        if folder.get("ItemId") == library_id:
+            return folder.get("RefreshStatus") == "Active"
+    return False
+
+def wait_for_refresh(library_id):
+    """Polls the library's refresh status with exponential backoff until Jellyfin is done, like Plex's wait_for_scan."""
+    start = time.perf_counter()
+    delay = 1
+    seen_running = False
+    while True:
+        elapsed = time.perf_counter() - start
+        try:
+            refreshing = is_library_refreshing(library_id)
+        except Exception as e:
+            print(f"Could not check Jellyfin refresh status: {e}")
+            refreshing = True
+        if refreshing:
+            seen_running = True
+        elif seen_running or elapsed >= JELLYFIN_SCAN_START_GRACE:
+            print(f"Jellyfin finished refreshing after {elapsed:.0f}s.")
+            return True
+        if elapsed >= JELLYFIN_SCAN_TIMEOUT:
+            print(f"Jellyfin is still refreshing after {elapsed:.0f}s, carrying on anyway.")
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, JELLYFIN_SCAN_POLL_CEILING)
+
+def get_paged_items(path, params=None):
+    """Yields every item of a Jellyfin listing, fetching it a page at a time."""
+    start = 0
+    while True:
+        page = jellyfin_client.get_json(path, params={**(params or {}), "StartIndex": start, "Limit": JELLYFIN_PAGE_SIZE})
+        items = page.get("Items", [])
+        yield from items
+        start += len(items)
+        total = page.get("TotalRecordCount")
+        if len(items) < JELLYFIN_PAGE_SIZE or (total is not None and start >= int(total)):
+            return
+
+def get_library_item_ids(library_id=None):
+    """Maps every audio file in the library (as Jellyfin sees the path) to its ItemId."""
+    params = {"Recursive": "true", "IncludeItemTypes": "Audio", "Fields": "Path"}
+    if library_id:
+        params["ParentId"] = library_id
+    return {item["Path"]: item["Id"] for item in get_paged_items("/Items", params) if item.get("Path")}
+
+def get_jellyfin_playlists(user_id):
+    """Fetches the user's playlists keyed by Id, flagging the ones with "save" in their description."""
+    playlists = {}
+    params = {"Recursive": "true", "IncludeItemTypes": "Playlist", "Fields": "Overview,Path", "UserId": user_id}
+    for item in get_paged_items("/Items", params):
+        playlists[item["Id"]] = {
+            "Name": item.get("Name"),
+            "is_saved": "save" in (item.get("Overview") or "").lower(),
+            # Playlists Jellyfin imported from an .m3u in the library follow that file, not the API
+            "file_backed": (item.get("Path") or "").lower().endswith(".m3u"),
+            "Path": item.get("Path"),
+        }
+    return playlists
+
+def get_playlist_entries(playlist_id, user_id):
+    """Returns [(PlaylistItemId, ItemId, Path)] for a playlist, in playlist order."""
+    params = {"UserId": user_id, "Fields": "Path"}
+    return [
+        (item["PlaylistItemId"], item["Id"], item.get("Path"))
+        for item in get_paged_items(f"/Playlists/{playlist_id}/Items", params)
+        if "PlaylistItemId" in item
+    ]
+
+def get_protected_jellyfin_data():
+    """Finds all Jellyfin playlists marked "save" and bundles their local file paths, like get_protected_plex_data."""
+    if not JELLYFIN_API_KEY:
+        return {}
+    print("Checking Jellyfin for 'saved' playlists...")
+    try:
+        user_id = get_user_id()
+        if not user_id:
+            return {}
+        saved = [(playlist_id, info) for playlist_id, info in get_jellyfin_playlists(user_id).items() if info["is_saved"]]
+
+        def fetch(item):
+            playlist_id, info = item
+            paths = {to_local_path(path, JELLYFIN_MUSIC_PATH) for _, _, path in get_playlist_entries(playlist_id, user_id) if path}
+            return info["Name"], {"Id": playlist_id, "paths": paths}
+
+        with ThreadPoolExecutor(max_workers=JELLYFIN_SYNC_WORKERS) as executor:
+            protected_data = dict(executor.map(fetch, saved))
+        for title in protected_data:
+            print(f" ✓ Found saved playlist in Jellyfin: '{title}'")
+        return protected_data
+    except Exception as e:
+        print(f"Could not fetch protected Jellyfin playlists: {e}")
+        return {}
+
+def get_jellyfin_m3u_files():
+    """The .m3u files written with Jellyfin's paths, keyed by playlist name."""
+    pattern = "*.m3u" if JELLYFIN_MUSIC_PATH == PLEX_MUSIC_PATH else "*_jellyfin.m3u"
+    return {get_m3u_playlist_key(os.path.basename(m3u_file)): m3u_file
+            for m3u_file in glob.glob(os.path.join(PLAYLISTS_DIR, pattern))}
+
+def load_item_cache():
+    try:
+        with open(JELLYFIN_CACHE_PATH, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return {"items": data.get("items", {}), "playlists": data.get("playlists", {}),
+                "incomplete": set(data.get("incomplete", []))}
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Jellyfin item cache is unreadable, rebuilding it: {e}")
+    return {"items": {}, "playlists": {}, "incomplete": set()}
+
+def save_item_cache(cache):
+    try:
+        os.makedirs(os.path.dirname(JELLYFIN_CACHE_PATH), exist_ok=True)
+        write_atomic(JELLYFIN_CACHE_PATH, json.dumps({"items": cache["items"], "playlists": cache["playlists"],
+                                                      "incomplete": sorted(cache["incomplete"])}))
+    except Exception as e:
+        print(f"Could not save the Jellyfin item cache: {e}")
+
+def has_pending_jellyfin_work():
+    """True when playlists are still waiting for songs Jellyfin hadn't ingested, so a sync is due."""
+    return bool(JELLYFIN_API_KEY) and bool(load_item_cache()["incomplete"])
+
+def create_playlist(title, item_ids, user_id):
+    response = jellyfin_client.post("/Playlists", json={"Name": title, "Ids": item_ids, "UserId": user_id, "MediaType": "Audio"})
+    response.raise_for_status()
+    return response.json().get("Id")
+
+def delete_playlist(playlist_id):
+    jellyfin_client.delete(f"/Items/{playlist_id}")
+
+def reconcile_playlist(playlist_id, desired_ids, user_id):
+    """Applies only the adds, removes and reorders needed to make a Jellyfin playlist match desired_ids."""
+    entries = [(entry_id, item_id) for entry_id, item_id, _ in get_playlist_entries(playlist_id, user_id)]
+    removes, adds = plan_membership_changes(entries, desired_ids)
+
+    for i in range(0, len(removes), JELLYFIN_ID_BATCH):
+        jellyfin_client.delete(f"/Playlists/{playlist_id}/Items",
+                               params={"EntryIds": ",".join(removes[i:i + JELLYFIN_ID_BATCH])}).raise_for_status()
+    for i in range(0, len(adds), JELLYFIN_ID_BATCH):
+        jellyfin_client.post(f"/Playlists/{playlist_id}/Items",
+                             params={"Ids": ",".join(adds[i:i + JELLYFIN_ID_BATCH]), "UserId": user_id}).raise_for_status()
+
+    if removes or adds:
+        entries = [(entry_id, item_id) for entry_id, item_id, _ in get_playlist_entries(playlist_id, user_id)]
+    moves = moves_to_indices([entry_id for entry_id, _ in entries], plan_moves(entries, desired_ids))
+    for entry_id, index in moves:
+        jellyfin_client.post(f"/Playlists/{playlist_id}/Items/{entry_id}/Move/{index}").raise_for_status()
+
+    return {"added": len(adds), "removed": len(removes), "moved": len(moves)}
+
+def sync_playlists(library, protected_data, changed_playlists):
+    """Creates, updates in place and deletes the Jellyfin playlists to match the current .m3u files."""
+    user_id = get_user_id()
+    if not user_id:
+        print("No Jellyfin administrator found (set JELLYFIN_USER_ID), skipping playlist sync.")
+        return
+
+    # Playlists Jellyfin imported from an .m3u in the library follow that file, not the API, so
+    # they are neither ours to update nor to delete
+    playlists = get_jellyfin_playlists(user_id)
+    existing = {playlist_id: info for playlist_id, info in playlists.items() if not info["file_backed"]}
+
+    # Copies imported from our own .m3u files before their folder got its .ignore disappear once
+    # Jellyfin looks at the folder again
+    playlists_dir = os.path.normpath(PLAYLISTS_DIR.replace(DOCKER_DOWNLOADS_PATH, JELLYFIN_MUSIC_PATH))
+    imported = {info["Path"] for info in playlists.values() if info["file_backed"] and os.path.dirname(info["Path"]) == playlists_dir}
+    if imported:
+        print(f" -> Asking Jellyfin to drop {len(imported)} playlists it imported from .m3u files")
+        trigger_refresh(library, {playlists_dir: "Modified"})
+    m3u_files = get_jellyfin_m3u_files()
+    cache = load_item_cache()
+    saved_titles = set(protected_data) | {info["Name"] for info in existing.values() if info["is_saved"]}
+
+    # Our playlists are tracked by the Id we got when creating them, names are not unique. An
+    # unclaimed API playlist with a synced name is adopted (e.g. one created before Ids were stored).
+    owned = {title: playlist_id for title, playlist_id in cache["playlists"].items()
+             if title in m3u_files and playlist_id in existing}
+    for playlist_id, info in existing.items():
+        title = info["Name"]
+        if title in m3u_files and title not in owned and not info["is_saved"] and playlist_id not in owned.values():
+            owned[title] = playlist_id
+    cache["playlists"] = owned
+
+    # 1. Delete unprotected playlists that are no longer synced, including duplicates of synced ones
+    kept = set(owned.values())
+    for playlist_id, info in existing.items():
+        if info["is_saved"]:
+            print(f" -> Preserving saved Jellyfin playlist: '{info['Name']}'")
+        elif playlist_id not in kept:
+            print(f" -> Deleting old Jellyfin playlist: '{info['Name']}'")
+            delete_playlist(playlist_id)
+
+    # 2. Work out which playlists need touching at all
+    to_sync = {}
+    for title, m3u_file in m3u_files.items():
+        if title in saved_titles:
+            print(f" -> Skipping '{title}' because it is marked as 'save' in Jellyfin.")
+            continue
+        unchanged = changed_playlists is not None and title not in changed_playlists and title not in cache["incomplete"]
+        if unchanged and title in owned:
+            continue
+        to_sync[title] = read_m3u_paths(m3u_file)
+
+    # Resolve every wanted path to an ItemId, listing the library only if the cache is missing some
+    item_ids = cache["items"]
+    wanted = {path for paths in to_sync.values() for path in paths}
+    if wanted - item_ids.keys():
+        item_ids = get_library_item_ids(library["ItemId"] if library else None)
+        cache["items"] = item_ids
+
+    def sync_playlist(title):
+        paths = to_sync[title]
+        desired_ids = [item_ids[path] for path in paths if path in item_ids]
+        missing = len(paths) - len(desired_ids)
+        playlist_id = owned.get(title)
+
+        if playlist_id:
+            changes = reconcile_playlist(playlist_id, desired_ids, user_id)
+            if any(changes.values()):
+                print(f" -> Updated Jellyfin playlist '{title}': +{changes['added']} -{changes['removed']} moved {changes['moved']}")
+        else:
+            print(f" -> Creating Jellyfin playlist: '{title}'")
+            playlist_id = create_playlist(title, desired_ids, user_id)
+            if playlist_id:
+                owned[title] = playlist_id
+        if missing:
+            print(f"    {missing} songs of '{title}' are not in Jellyfin yet and were left out.")
+        return title, missing
+
+    # 3. Independent playlists are synced concurrently
+    with ThreadPoolExecutor(max_workers=JELLYFIN_SYNC_WORKERS) as executor:
+        futures = {executor.submit(sync_playlist, title): title for title in to_sync}
+        for future, title in futures.items():
+            try:
+                _, missing = future.result()
+            except Exception as e:
+                print(f"Failed to sync Jellyfin playlist '{title}': {e}")
+                # Possibly a stale ItemId, re-list the library and retry this playlist next run
+                cache["items"] = {}
+                cache["incomplete"].add(title)
+                continue
+            if missing:
+                cache["incomplete"].add(title)
+            else:
+                cache["incomplete"].discard(title)
+
+    cache["incomplete"] &= set(m3u_files)
+    save_item_cache(cache)
+
+def sync_to_jellyfin(protected_data=None, changed_playlists=None, changed_dirs=None):
+    """Refreshes the music library and brings Jellyfin's playlists in line with the .m3u files.
+
+    changed_dirs is the set of local song folders that changed: only those get refreshed, an
+    empty set skips the refresh, and None refreshes the whole music library.
+    changed_playlists is the set of safe playlist names whose .m3u changed this run, None
+    syncs every playlist. Playlists marked "save" in protected_data are left alone.
+    """
     if not JELLYFIN_API_KEY:
         print("JELLYFIN_API_KEY not found in .env. Skipping Jellyfin API sync.")
         return
-        
-    print(f"\n--- Starting Jellyfin Library Scan ---")
+    if protected_data is None:
+        protected_data = {}
+
+    print(f"\n--- Starting Jellyfin Sync ---")
     print(f"Connecting to Jellyfin at {JELLYFIN_URL}...")
-    
-    url = f"{JELLYFIN_URL}/Library/Refresh"
-    headers = {
-        "X-Emby-Token": JELLYFIN_API_KEY,
-        "Accept": "application/json"
-    }
-    
+
     try:
-        response = requests.post(url, headers=headers)
-        if response.status_code == 204 or response.status_code == 200:
-            print("Successfully triggered Jellyfin library scan.")
-        else:
-            print(f"Failed to trigger scan. Status code: {response.status_code}")
-            print(f"Response: {response.text}")
+        library = get_music_library()
+        if not library:
+            print(f"Could not find a music library named '{JELLYFIN_LIBRARY_NAME}', refreshing everything instead.")
+
+        if changed_dirs is None or changed_dirs:
+            refresh_paths = get_refresh_paths(changed_dirs) if changed_dirs else None
+            if refresh_paths:
+                print(f"Refreshing {len(refresh_paths)} changed folders in Jellyfin...")
+            else:
+                print(f"Refreshing the '{library['Name'] if library else 'whole'}' library in Jellyfin...")
+            trigger_refresh(library, refresh_paths)
+            # Playlists can only reference songs Jellyfin has ingested
+            if library:
+                wait_for_refresh(library["ItemId"])
+
+        sync_playlists(library, protected_data, changed_playlists)
     except Exception as e:
         print(f"Error communicating with Jellyfin: {e}")
-        
-    print("Jellyfin API Sync Complete!\n")
 
-def sync_to_jellyfin(protected_data=None):
-    # For now, just trigger a scan. Jellyfin will pick up the M3Us.
-    # In the future we could manage playlists directly via API.
-    trigger_library_scan()
+    print("Jellyfin API Sync Complete!\n")
+    for line in jellyfin_client.latency_summary():
+        print(line)
 
 if __name__ == "__main__":
-    sync_to_jellyfin()
\ No newline at end of file
+    sync_to_jellyfin()
@@ -0,0 +1,129 @@
+# ./src/job_journal.py
+import os
+import json
+import time
+import threading
+
+# A journal older than this belongs to a run too stale to resume (its playlists have moved on)
+JOB_RESUME_MAX_AGE_HOURS = float(os.getenv("JOB_RESUME_MAX_AGE_HOURS", "6"))
+
+class JobJournal:
+    """Append-only checkpoint log of the running sync job, so a restarted job can resume.
+
+    Records the job's playlist plan, every playlist's fetched track list and each finished
+    phase, one JSON line at a time and fsynced. When the same job starts again before the
+    journal is complete (container restart, OOM kill, host reboot), begin() replays it and
+    the job skips whatever already finished. complete() compacts the journal back to nothing.
+    Finished downloads need no entry here, the library index journals them as they land,
+    but the song folders they changed are recorded so the media servers still scan them.
+    """
+
+    def __init__(self, path, max_age_hours=JOB_RESUME_MAX_AGE_HOURS):
+        self.path = path
+        self.max_age = max_age_hours * 3600
+        self._lock = threading.Lock()
+        self.resumed = False
+        self.plan = None
+        self.plan_classes = {}
+        self.playlists = {}
+        self.phases = {}
+        self.changed_dirs = set()
+
+    def _read(self):
+        entries = []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue # Torn write from the crash we're recovering from
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Job journal is unreadable, starting the job from scratch: {e}")
+        return entries
+
+    def _append(self, entry):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            print(f"Could not update the job journal: {e}")
+
+    def begin(self, job_name, now=None):
+        """Starts job_name, resuming an unfinished journal of the same job. Returns True when resuming."""
+        now = time.time() if now is None else now
+        entries = self._read()
+        start = entries[0] if entries and entries[0].get("op") == "start" else None
+        with self._lock:
+            self.plan, self.plan_classes, self.playlists, self.phases = None, {}, {}, {}
+            self.changed_dirs = set()
+            self.resumed = bool(start and start.get("job") == job_name and now - start.get("time", 0) < self.max_age)
+            if self.resumed:
+                for entry in entries[1:]:
+                    if entry.get("op") == "plan":
+                        self.plan = entry["playlists"]
+                        self.plan_classes = entry.get("classes", {})
+                    elif entry.get("op") == "playlist":
+                        self.playlists[entry["pid"]] = (entry["name"], entry["tracks"])
+                    elif entry.get("op") == "phase":
+                        self.phases[entry["phase"]] = entry.get("data", {})
+                    elif entry.get("op") == "changed_dir":
+                        self.changed_dirs.add(entry["path"])
+        if self.resumed:
+            self._append({"op": "resume", "time": now})
+        else:
+            self.compact()
+            self._append({"op": "start", "job": job_name, "time": now})
+        return self.resumed
+
+    def record_plan(self, playlists_map, playlist_classes=None):
+        """The playlists (pid -> known title, and pid -> class) this job is going to fetch."""
+        with self._lock:
+            self.plan = dict(playlists_map)
+            self.plan_classes = dict(playlist_classes or {})
+        self._append({"op": "plan", "playlists": playlists_map, "classes": playlist_classes or {}})
+
+    def record_playlist(self, pid, playlist_name, tracks):
+        with self._lock:
+            self.playlists[pid] = (playlist_name, tracks)
+        self._append({"op": "playlist", "pid": pid, "name": playlist_name, "tracks": tracks})
+
+    def record_changed_dir(self, folder):
+        """A song folder that gained or lost files, which the media servers will have to scan."""
+        with self._lock:
+            if folder in self.changed_dirs:
+                return
+            self.changed_dirs.add(folder)
+        self._append({"op": "changed_dir", "path": folder})
+
+    def phase(self, name):
+        """The data checkpointed when phase `name` finished, or None if it hasn't yet."""
+        with self._lock:
+            return self.phases.get(name)
+
+    def checkpoint(self, name, **data):
+        with self._lock:
+            self.phases[name] = data
+        self._append({"op": "phase", "phase": name, "data": data})
+        return data
+
+    def compact(self):
+        """The job finished (or is being abandoned), so none of the journal is needed any more."""
+        try:
+            open(self.path, 'w').close()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Could not compact the job journal: {e}")
+
+    def complete(self):
+        self.compact()
+        with self._lock:
+            self.resumed = False
+            self.plan, self.plan_classes, self.playlists, self.phases = None, {}, {}, {}
+            self.changed_dirs = set()
@@ -0,0 +1,122 @@
+# ./src/library_cleanup.py
+import os
+import time
+import shutil
+from library_index import AUDIO_EXTENSIONS
+
+# Suffix of the temp files staging and the artwork cache publish through
+TEMP_SUFFIX = ".amps-tmp"
+
+def new_cleanup_stats():
+    return {
+        "dirs_scanned": 0,
+        "files_scanned": 0,
+        "orphans_deleted": 0,
+        "temp_files_deleted": 0,
+        "dirs_removed": 0,
+        "bytes_reclaimed": 0,
+        "timings": {},
+    }
+
+def _entry_size(entry):
+    try:
+        return entry.stat(follow_symlinks=False).st_size
+    except OSError:
+        return 0
+
+def _prune_dir(path, keep_paths, dry_run, stats, on_delete):
+    """Prunes one folder bottom-up. Returns (contains_song, bytes_left_in_folder)."""
+    stats["dirs_scanned"] += 1
+    has_song = False
+    leftover_bytes = 0
+    subdirs = []
+
+    with os.scandir(path) as it:
+        entries = list(it)
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry)
+            continue
+
+        stats["files_scanned"] += 1
+        if entry.name.endswith(TEMP_SUFFIX):
+            # A copy a killed run never renamed into place, nothing is writing it now
+            size = _entry_size(entry)
+            if dry_run:
+                print(f" -> Would delete unfinished copy: {entry.name}")
+            else:
+                try:
+                    os.remove(entry.path)
+                except OSError as e:
+                    print(f"Failed to delete {entry.name}: {e}")
+                    leftover_bytes += size
+                    continue
+            stats["temp_files_deleted"] += 1
+            stats["bytes_reclaimed"] += size
+            continue
+        if not entry.name.lower().endswith(AUDIO_EXTENSIONS):
+            # Leftover thumbnails etc. only matter if the whole folder goes away
+            leftover_bytes += _entry_size(entry)
+            continue
+        if entry.path in keep_paths:
+            has_song = True
+            continue
+
+        size = _entry_size(entry)
+        if dry_run:
+            print(f" -> Would delete orphaned song: {entry.name}")
+        else:
+            try:
+                os.remove(entry.path)
+                print(f" -> Deleted orphaned song: {entry.name}")
+            except Exception as e:
+                print(f"Failed to delete {entry.name}: {e}")
+                has_song = True # It's still there, so the folder has to stay too
+                continue
+        if on_delete:
+            on_delete(entry.path)
+        stats["orphans_deleted"] += 1
+        stats["bytes_reclaimed"] += size
+
+    for entry in subdirs:
+        try:
+            child_has_song, child_bytes = _prune_dir(entry.path, keep_paths, dry_run, stats, on_delete)
+        except OSError:
+            has_song = True # Could not read it, so never delete it
+            continue
+        if child_has_song:
+            has_song = True
+            continue
+
+        # If no songs exist, forcefully delete the entire folder and any leftover thumbnails
+        if dry_run:
+            print(f" -> Would remove empty/ghost folder: {entry.name}")
+        else:
+            try:
+                shutil.rmtree(entry.path)
+                print(f" -> Removed empty/ghost folder: {entry.name}")
+            except Exception:
+                has_song = True
+                continue
+        stats["dirs_removed"] += 1
+        stats["bytes_reclaimed"] += child_bytes
+
+    return has_song, leftover_bytes
+
+def prune_library(root, keep_paths, dry_run=False, on_delete=None, stats=None):
+    """Deletes every song under root that isn't in keep_paths, plus any folder left without one.
+
+    Unfinished *.amps-tmp copies left by a killed run are deleted as well; this runs under
+    the sync lock, so no publish can still be writing them.
+
+    Done in a single bottom-up os.scandir pass, so every folder is listed exactly once.
+    In dry-run mode nothing is touched and the stats report what would be reclaimed.
+    """
+    if stats is None:
+        stats = new_cleanup_stats()
+    start = time.perf_counter()
+    if os.path.isdir(root):
+        _prune_dir(root, keep_paths, dry_run, stats, on_delete)
+    stats["timings"]["prune"] = time.perf_counter() - start
+    return stats
@@ -0,0 +1,226 @@
+# ./src/library_index.py
+import os
+import re
+import json
+import threading
+from atomic_file import write_atomic
+
+# Every audio container we download into (.mp3 when transcoding, the others in native mode)
+AUDIO_EXTENSIONS = (".mp3", ".opus", ".m4a", ".ogg")
+
+# Downloaded files are always named "<Title> [<video_id>].<ext>"
+TRACK_FILE_PATTERN = re.compile(r"\[([A-Za-z0-9_-]+)\]\.(?:mp3|opus|m4a|ogg)$", re.IGNORECASE)
+
+INDEX_VERSION = 1
+
+def parse_video_id(filename):
+    """Returns the video_id embedded in a library filename, or None."""
+    match = TRACK_FILE_PATTERN.search(filename)
+    return match.group(1) if match else None
+
+class LibraryIndex:
+    """Persistent video_id -> file path index for the All_Songs library.
+
+    The index lives in a JSON snapshot plus an append-only journal. Every change made
+    during a run is appended to the journal, and the snapshot is rewritten (temp file +
+    rename) when the index is saved. On load the tree is reconciled against the stored
+    directory mtimes, so only folders that actually changed get listed again.
+    """
+
+    def __init__(self, root, index_path):
+        self.root = root
+        self.index_path = index_path
+        self.journal_path = index_path + ".log"
+        self._lock = threading.RLock()
+        self._loaded = False
+        # Relative dir -> {"mtime": float, "subdirs": [names], "tracks": {video_id: filename}}
+        self._dirs = {}
+        # video_id -> absolute path, this is what lookups hit
+        self._tracks = {}
+        # Folders that gained or lost a song since the last take_changed_dirs()
+        self._changed_dirs = set()
+        # Optional callback(folder) for every newly changed folder, e.g. to persist them as they happen
+        self.on_dir_changed = None
+        self.stats = {"dirs_listed": 0, "dirs_reused": 0}
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def _abs(self, rel_dir, filename=None):
+        path = self.root if rel_dir == "." else os.path.join(self.root, rel_dir)
+        return os.path.join(path, filename) if filename else path
+
+    def _rel_dir(self, path):
+        return os.path.relpath(os.path.dirname(path), self.root)
+
+    # --- Persistence ---
+
+    def _read_snapshot(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") == INDEX_VERSION and data.get("root") == self.root:
+                return data.get("dirs", {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Library index is unreadable, rebuilding it: {e}")
+        return {}
+
+    def _replay_journal(self):
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue # Torn write from a crash, the reconcile pass covers it
+                    if entry.get("op") == "add":
+                        self._apply_add(entry["id"], entry["path"])
+                    elif entry.get("op") == "remove":
+                        self._apply_remove(entry["path"])
+        except FileNotFoundError:
+            pass
+
+    def _append_journal(self, entry):
+        try:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + "\n")
+        except Exception as e:
+            print(f"Could not update library index journal: {e}")
+
+    def save(self):
+        """Compacts the journal into a fresh snapshot."""
+        with self._lock:
+            if not self._loaded:
+                return
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            try:
+                # The journal is emptied next, so the snapshot has to be on disk first
+                write_atomic(self.index_path, json.dumps({"version": INDEX_VERSION, "root": self.root, "dirs": self._dirs}), fsync=True)
+                # Snapshot now holds everything the journal did
+                open(self.journal_path, 'w').close()
+            except Exception as e:
+                print(f"Could not save library index: {e}")
+
+    # --- Reconcile ---
+
+    def _scan_dir(self, rel_dir, mtime):
+        subdirs = []
+        tracks = {}
+        with os.scandir(self._abs(rel_dir)) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    video_id = parse_video_id(entry.name)
+                    if video_id:
+                        tracks[video_id] = entry.name
+        self.stats["dirs_listed"] += 1
+        return {"mtime": mtime, "subdirs": subdirs, "tracks": tracks}
+
+    def reconcile(self):
+        """Brings the index in line with the filesystem, listing only folders whose mtime changed."""
+        with self._lock:
+            old_dirs = self._dirs
+            new_dirs = {}
+            stack = ["."]
+            while stack:
+                rel_dir = stack.pop()
+                try:
+                    mtime = os.stat(self._abs(rel_dir)).st_mtime
+                except OSError:
+                    continue # Folder vanished since the last run
+
+                record = old_dirs.get(rel_dir)
+                if record and record.get("mtime") == mtime:
+                    self.stats["dirs_reused"] += 1
+                else:
+                    try:
+                        record = self._scan_dir(rel_dir, mtime)
+                    except OSError:
+                        continue
+                new_dirs[rel_dir] = record
+                for name in record["subdirs"]:
+                    stack.append(name if rel_dir == "." else os.path.join(rel_dir, name))
+
+            self._dirs = new_dirs
+            self._tracks = {}
+            for rel_dir, record in new_dirs.items():
+                for video_id, filename in record["tracks"].items():
+                    self._tracks[video_id] = self._abs(rel_dir, filename)
+
+    def load(self):
+        """Loads the stored index and reconciles it with the library on disk."""
+        with self._lock:
+            self.stats = {"dirs_listed": 0, "dirs_reused": 0}
+            self._dirs = self._read_snapshot()
+            self._loaded = True
+            self._replay_journal()
+            if os.path.exists(self.root):
+                self.reconcile()
+            self.save()
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    # --- Updates / lookups ---
+
+    def _apply_add(self, video_id, path):
+        rel_dir = self._rel_dir(path)
+        # mtime None forces the next reconcile to re-list this folder
+        record = self._dirs.setdefault(rel_dir, {"mtime": None, "subdirs": [], "tracks": {}})
+        record["mtime"] = None
+        record["tracks"][video_id] = os.path.basename(path)
+        self._tracks[video_id] = path
+
+    def _apply_remove(self, path):
+        record = self._dirs.get(self._rel_dir(path))
+        video_id = parse_video_id(os.path.basename(path))
+        if record and video_id:
+            record["mtime"] = None
+            record["tracks"].pop(video_id, None)
+        if video_id and self._tracks.get(video_id) == path:
+            del self._tracks[video_id]
+
+    def add(self, video_id, path):
+        """Records a newly downloaded track."""
+        with self._lock:
+            self.ensure_loaded()
+            self._apply_add(video_id, path)
+            self._mark_changed(os.path.dirname(path))
+            self._append_journal({"op": "add", "id": video_id, "path": path})
+
+    def remove(self, path):
+        """Forgets a track that was deleted from the library."""
+        with self._lock:
+            self.ensure_loaded()
+            self._apply_remove(path)
+            self._mark_changed(os.path.dirname(path))
+            self._append_journal({"op": "remove", "path": path})
+
+    def _mark_changed(self, folder):
+        # Caller holds self._lock
+        if folder not in self._changed_dirs:
+            self._changed_dirs.add(folder)
+            if self.on_dir_changed:
+                self.on_dir_changed(folder)
+
+    def changed_dirs(self):
+        """The folders whose songs changed so far, without resetting them."""
+        with self._lock:
+            return set(self._changed_dirs)
+
+    def take_changed_dirs(self):
+        """Returns (and resets) the folders whose songs changed, so media servers can scan just those."""
+        with self._lock:
+            changed, self._changed_dirs = self._changed_dirs, set()
+        return changed
+
+    def lookup(self, video_id):
+        """Returns the library path for a video_id, or None if it hasn't been downloaded."""
+        if not self._loaded:
+            with self._lock:
+                self.ensure_loaded()
+        return self._tracks.get(video_id)
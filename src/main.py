@@ -1,53 +1,265 @@
+import os
+import sys
 import time
-import schedule
-from file_manager import setup_directories, clear_old_playlists, remove_orphaned_songs
-from playlist_manager import get_playlist_tracks
-from downloader import process_downloads, console
-from jellyfin_sync import sync_to_jellyfin
+from file_manager import (setup_directories, clear_old_playlists, remove_orphaned_songs, library_index,
+                          playlist_snapshots, get_safe_playlist_name, PlaylistBuilder, STATE_DIR)
+from metrics import metrics, start_metrics_server
+from job_journal import JobJournal
+from jellyfin_sync import sync_to_jellyfin, get_protected_jellyfin_data, has_pending_jellyfin_work
 from plex_sync import sync_to_plex, get_protected_plex_data
+from playlist_manager import COOKIES_FILE
+from scheduler import SyncLock, SyncService, parse_times
+from rich.console import Console
 
-import yt_dlp
+console = Console()
 
-def sync_job():
-    console.rule("[bold cyan]AmpsAssist Sync Job Started")
+# Metrics of the last sync_job, rewritten at the end of every run
+RUN_SUMMARY_PATH = os.path.join(STATE_DIR, "run_summary.json")
+# Metrics of the last retag_job, kept apart so a retag doesn't hide the last sync's summary
+RETAG_SUMMARY_PATH = os.path.join(STATE_DIR, "retag_summary.json")
+
+# "full" syncs everything, "feed" only refreshes the Home feed mixes and is cheap enough to run more often
+FULL_SYNC_TIMES = os.getenv("FULL_SYNC_TIMES", "04:00,16:00")
+FEED_SYNC_TIMES = os.getenv("FEED_SYNC_TIMES", "")
+# When to re-check the tags and folders of every downloaded song against YouTube Music (empty = only on demand)
+RETAG_SYNC_TIMES = os.getenv("RETAG_SYNC_TIMES", "")
+# Every scheduled run starts up to this many seconds after its slot
+SCHEDULE_JITTER_SECONDS = int(os.getenv("SCHEDULE_JITTER_SECONDS", "300"))
+# "coalesce" catches up on missed slots with one run, "skip" drops slots more than 15 minutes late
+MISSED_RUN_POLICY = os.getenv("MISSED_RUN_POLICY", "coalesce").lower()
+# Local trigger/status endpoint: POST /trigger/full, POST /trigger/feed, GET /status (port 0 disables it)
+CONTROL_HOST = os.getenv("CONTROL_HOST", "127.0.0.1")
+CONTROL_PORT = int(os.getenv("CONTROL_PORT", "9465"))
+# Also push each playlist to Jellyfin/Plex as soon as its songs are all in, not just at the end of the run
+EARLY_MEDIA_SERVER_SYNC = os.getenv("EARLY_MEDIA_SERVER_SYNC", "false").lower() == "true"
+
+SYNC_LOCK_PATH = os.path.join(STATE_DIR, "sync.lock")
+SCHEDULE_STATE_PATH = os.path.join(STATE_DIR, "schedule_state.json")
+TRIGGER_DIR = os.path.join(STATE_DIR, "triggers")
+
+# Checkpoints of the running job, so a restarted container picks up where it was killed
+job_journal = JobJournal(os.path.join(STATE_DIR, "job_journal.log"))
+
+def make_early_publisher():
+    """Returns on_playlist_published for process_downloads, which syncs one finished playlist to the media servers."""
+    protected = {}
+
+    def publish_to_media_servers(playlist_name, file_paths):
+        # Fetched on first use, the playlists marked "save" don't change during a run
+        if not protected:
+            protected["plex"] = get_protected_plex_data()
+            protected["jellyfin"] = get_protected_jellyfin_data()
+        # Only this playlist's folders that gained songs this run need scanning
+        new_dirs = {os.path.dirname(path) for path in file_paths} & library_index.changed_dirs()
+        changed_playlists = {get_safe_playlist_name(playlist_name)}
+        sync_to_jellyfin(protected["jellyfin"], changed_playlists=changed_playlists, changed_dirs=new_dirs)
+        sync_to_plex(protected["plex"], changed_playlists=changed_playlists, changed_dirs=new_dirs)
+
+    return publish_to_media_servers
+
+def get_protected_paths(protected_data, jellyfin_protected_data):
+    """Local paths of every song in a playlist saved in Plex or Jellyfin."""
+    protected_paths = set()
+    for pl_info in list(protected_data.values()) + list(jellyfin_protected_data.values()):
+        protected_paths |= pl_info["paths"]
+    return protected_paths
+
+def sync_job(feed_only=False):
+    """One sync run. feed_only refreshes just the Home feed mixes and leaves every other playlist as it is."""
+    # The YouTube side (ytmusicapi, yt-dlp, mutagen) only gets loaded once a job actually runs
+    import yt_dlp
+    from playlist_manager import iter_playlist_tracks
+    from downloader import process_downloads
+
+    metrics.begin_run()
+    job_started = time.perf_counter()
+    job_name = "feed" if feed_only else "full"
+    console.rule(f"[bold cyan]AmpsAssist {'Feed' if feed_only else 'Full'} Sync Job Started")
     console.print(f"[dim]yt-dlp version: {yt_dlp.version.__version__}[/dim]")
+    if job_journal.begin(job_name):
+        console.print(f"[yellow]Resuming the interrupted {job_name} sync from its last checkpoint.[/yellow]")
     setup_directories()
+
+    # Pick up anything added/removed on the share since the last run (only changed folders are re-listed)
+    library_index.load()
+    # Folders are journaled as they change, songs that landed before a crash are index hits after it
+    library_index.on_dir_changed = job_journal.record_changed_dir
+    try:
+        console.print(f"[dim]Library index: {len(library_index)} tracks ({library_index.stats['dirs_listed']} folders re-listed, {library_index.stats['dirs_reused']} unchanged)[/dim]")
+
+        playlists_done = job_journal.phase("playlists")
+        if playlists_done is None:
+            # Tracks stream straight from playlist discovery into the download pool
+            discovery_started = time.perf_counter()
+            tracks = iter_playlist_tracks(feed_only=feed_only, journal=job_journal)
+
+            # Download the tracks and (re)generate the .m3u files of playlists that changed.
+            # Songs that finished before an interruption are library index hits by now.
+            result = process_downloads(tracks, started_at=discovery_started,
+                                       on_playlist_published=make_early_publisher() if EARLY_MEDIA_SERVER_SYNC else None)
+
+            # Drop .m3u files (and snapshots) of playlists that are no longer synced. A feed run only
+            # saw a few playlists, so it can't tell which of the others are gone.
+            current_playlists = playlist_snapshots.seen_names()
+            removed_playlists = set()
+            if current_playlists and not feed_only:
+                console.print("[yellow]Clearing old playlist files...[/yellow]")
+                removed_playlists = clear_old_playlists(keep_playlists=current_playlists)
+                playlist_snapshots.evict_missing()
+            elif not current_playlists:
+                console.print("[red]No playlists could be fetched, keeping the existing playlist files.[/red]")
+            playlist_snapshots.save()
+            changed_playlists = {get_safe_playlist_name(name) for name in result["written"]} | removed_playlists
+            playlists_done = job_journal.checkpoint(
+                "playlists", changed_playlists=sorted(changed_playlists), changed_dirs=sorted(library_index.take_changed_dirs()),
+                downloaded=result["downloaded"], playlists_written=len(result["written"]),
+            )
+        else:
+            console.print("[dim]Playlists and downloads already finished before the interruption, skipping them.[/dim]")
+        changed_playlists = set(playlists_done["changed_playlists"])
+
+        # Check Plex and Jellyfin for playlists manually marked with "save"
+        protected_data = get_protected_plex_data()
+        jellyfin_protected_data = get_protected_jellyfin_data()
+        protected_paths = get_protected_paths(protected_data, jellyfin_protected_data)
+
+        # Clean up (pass the protected paths so they survive!)
+        cleanup_done = job_journal.phase("orphan_cleanup")
+        if cleanup_done is None:
+            console.print("\n[yellow]Removing orphaned songs...[/yellow]")
+            with metrics.timer("stage_seconds", stage="orphan_cleanup"):
+                remove_orphaned_songs(protected_paths)
+            cleanup_done = job_journal.checkpoint("orphan_cleanup", changed_dirs=sorted(library_index.take_changed_dirs()))
+    finally:
+        # A failed run must not leave the index journaling into the next job
+        library_index.on_dir_changed = None
+
+    # Song folders that gained or lost files this run (downloads and orphan cleanup), including
+    # those changed before an interruption
+    changed_dirs = set(playlists_done["changed_dirs"]) | set(cleanup_done["changed_dirs"]) | job_journal.changed_dirs
     
-    # Wipe the old .m3u files so we get a fresh mix generated
-    console.print("[yellow]Clearing old playlist files...[/yellow]")
-    clear_old_playlists()
-    
-    tracks = get_playlist_tracks()
-    console.print(f"\n[bold green]Found {len(tracks)} tracks across playlists.[/bold green] Processing...")
-    
-    # Download the tracks and generate the .m3u files
-    process_downloads(tracks)
-    
-    # Check Plex for playlists manually marked with "save"
-    protected_data = get_protected_plex_data()
-    protected_paths = []
-    for pl_info in protected_data.values():
-        protected_paths.extend(pl_info.get("paths", []))
-    
-    # Clean up (pass the protected paths so they survive!)
-    console.print("\n[yellow]Removing orphaned songs...[/yellow]")
-    remove_orphaned_songs(protected_paths)
-    
-    # Talk to Media Servers to trigger a library scan
-    console.print("\n[cyan]Triggering Library Scans...[/cyan]")
-    sync_to_jellyfin()
-    sync_to_plex(protected_data)
+    # Talk to Media Servers to trigger a library scan, but only if something actually changed or
+    # Jellyfin playlists are still waiting for songs it hadn't ingested last time
+    if not changed_dirs and not changed_playlists and not has_pending_jellyfin_work():
+        console.print("\n[green]Nothing changed since the last sync, skipping media server updates.[/green]")
+    else:
+        console.print("\n[cyan]Triggering Library Scans...[/cyan]")
+        if job_journal.phase("jellyfin_sync") is None:
+            with metrics.timer("stage_seconds", stage="jellyfin_sync"):
+                sync_to_jellyfin(jellyfin_protected_data, changed_playlists=changed_playlists, changed_dirs=changed_dirs)
+            job_journal.checkpoint("jellyfin_sync")
+        if job_journal.phase("plex_sync") is None:
+            with metrics.timer("stage_seconds", stage="plex_sync"):
+                sync_to_plex(protected_data, changed_playlists=changed_playlists, changed_dirs=changed_dirs)
+            job_journal.checkpoint("plex_sync")
     
+    duration = time.perf_counter() - job_started
+    metrics.observe("stage_seconds", duration, stage="feed_sync_job" if feed_only else "sync_job")
+    metrics.set_gauge("last_run_duration_seconds", round(duration, 3))
+    metrics.set_gauge("last_run_timestamp_seconds", int(time.time()))
+    metrics.write_run_summary(RUN_SUMMARY_PATH, duration=round(duration, 3),
+                              downloaded=playlists_done["downloaded"], playlists_written=playlists_done["playlists_written"])
+    console.print(f"[dim]Run summary written to {RUN_SUMMARY_PATH}[/dim]")
+    # Everything is done, so the checkpoints can go
+    job_journal.complete()
     console.rule("[bold green]Sync Complete! Waiting for next interval...")
 
+def retag_job():
+    """Fixes the tags and Artist/Album folders of downloaded songs whose YouTube Music metadata changed."""
+    from playlist_manager import iter_playlist_tracks
+    from retag import retag_library
+
+    metrics.begin_run()
+    job_started = time.perf_counter()
+    console.rule("[bold cyan]AmpsAssist Re-tag Job Started")
+    setup_directories()
+    library_index.load()
+
+    # Read-only discovery: the snapshots are only touched for the playlists rewritten below
+    tracks = list(iter_playlist_tracks(snapshots=False))
+    # Songs of playlists saved in Plex/Jellyfin stay where they are, moving them would break those playlists
+    protected_data = get_protected_plex_data()
+    jellyfin_protected_data = get_protected_jellyfin_data()
+    protected_paths = get_protected_paths(protected_data, jellyfin_protected_data)
+    with metrics.timer("stage_seconds", stage="retag"):
+        stats = retag_library(tracks, protected_paths)
+    library_index.save()
+
+    # Moved songs have new paths, so the playlists containing them need their .m3u rewritten
+    builder = PlaylistBuilder()
+    playlist_tracks = {}
+    moved_playlists = set()
+    for track in tracks:
+        playlist_tracks.setdefault(track['playlist_name'], []).append(track)
+        path = library_index.lookup(track['video_id']) if track.get('video_id') else None
+        if path:
+            builder.add(path, track['playlist_name'], track.get('position', 0))
+        if track.get('video_id') in stats["moved_ids"]:
+            moved_playlists.add(track['playlist_name'])
+    if moved_playlists:
+        # A rewritten .m3u matches the current track list, so the next sync can skip it again
+        playlist_snapshots.begin_run()
+        for playlist_name in moved_playlists:
+            playlist_snapshots.observe(playlist_name, playlist_tracks[playlist_name])
+            playlist_snapshots.commit(playlist_name, len(builder.write(playlist_name)))
+        playlist_snapshots.save()
+    changed_playlists = {get_safe_playlist_name(name) for name in moved_playlists}
+
+    if stats["changed_dirs"] or changed_playlists:
+        console.print("\n[cyan]Triggering Library Scans...[/cyan]")
+        with metrics.timer("stage_seconds", stage="jellyfin_sync"):
+            sync_to_jellyfin(jellyfin_protected_data, changed_playlists=changed_playlists, changed_dirs=stats["changed_dirs"])
+        with metrics.timer("stage_seconds", stage="plex_sync"):
+            sync_to_plex(protected_data, changed_playlists=changed_playlists, changed_dirs=stats["changed_dirs"])
+
+    duration = time.perf_counter() - job_started
+    metrics.observe("stage_seconds", duration, stage="retag_job")
+    metrics.write_run_summary(RETAG_SUMMARY_PATH, duration=round(duration, 3), retagged=stats["retagged"], moved=stats["moved"],
+                              kept_in_place=stats["kept_in_place"])
+    console.print(f"[dim]Re-tag summary written to {RETAG_SUMMARY_PATH}[/dim]")
+    console.rule("[bold green]Re-tag Complete!")
+
+def build_service():
+    os.makedirs(TRIGGER_DIR, exist_ok=True)
+    service = SyncService(SyncLock(SYNC_LOCK_PATH), SCHEDULE_STATE_PATH, TRIGGER_DIR,
+                          jitter=SCHEDULE_JITTER_SECONDS, missed_policy=MISSED_RUN_POLICY)
+    # Broadest job first, a full run also counts as a feed run
+    service.add_job("full", sync_job, parse_times(FULL_SYNC_TIMES))
+    service.add_job("feed", lambda: sync_job(feed_only=True), parse_times(FEED_SYNC_TIMES))
+    # Re-tagging is neither part of nor covered by the syncs
+    service.add_job("retag", retag_job, parse_times(RETAG_SYNC_TIMES), standalone=True)
+    return service
+
+def main(args):
+    """python src/main.py               run the scheduler service
+       python src/main.py once [job]    run one job now (waits for nothing, skips if one is running)
+       python src/main.py trigger [job] ask the running service to run a job as soon as it can"""
+    command = args[0] if args else "serve"
+    job = args[1] if len(args) > 1 else "full"
+    service = build_service()
+    if job not in service.jobs:
+        print(f"Unknown job '{job}', use one of: {', '.join(service.jobs)}")
+        return 2
+
+    if command == "trigger":
+        # Picked up by the service's watcher, works from `docker exec` or another container
+        open(os.path.join(TRIGGER_DIR, f"{job}.trigger"), "w").close()
+        print(f"Requested a '{job}' sync.")
+        return 0
+    if command == "once":
+        return 0 if service.run_job(job) else 1
+    if command != "serve":
+        print(main.__doc__)
+        return 2
+
+    # Prometheus can scrape http://<host>:METRICS_PORT/metrics
+    start_metrics_server()
+    service.start_control_server(CONTROL_HOST, CONTROL_PORT)
+    # New cookies usually mean the last run failed on auth, so sync straight away (that run also
+    # retries the tracks the failure cache had filed as private/members-only)
+    service.watch(COOKIES_FILE, "full")
+    # Run immediately on startup, then on schedule
+    service.run_forever(startup_job="full")
+
 if __name__ == "__main__":
-    # Run immediately on startup
-    sync_job()
-    
-    # Schedule to run at 4am and 4pm every day
-    schedule.every().day.at("04:00").do(sync_job)
-    schedule.every().day.at("16:00").do(sync_job)
-    
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
\ No newline at end of file
+    sys.exit(main(sys.argv[1:]))
\ No newline at end of file
@@ -0,0 +1,112 @@
+# ./src/media_client.py
+import os
+import re
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+MEDIA_SERVER_TIMEOUT = float(os.getenv("MEDIA_SERVER_TIMEOUT", "30"))
+MEDIA_SERVER_RETRIES = int(os.getenv("MEDIA_SERVER_RETRIES", "3"))
+
+# Safe to resend even if the server might already have acted on the first attempt
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def endpoint_name(method, path):
+    """Groups requests per endpoint for the latency stats, e.g. 'GET /playlists/{id}/items'."""
+    return f"{method} {re.sub(r'/[0-9a-fA-F-]{32,36}(?=/|$)|/[0-9]+(?=/|$)', '/{id}', path)}"
+
+def can_retry(method, error):
+    if method in IDEMPOTENT_METHODS:
+        return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+    # Only resend a POST if it provably never reached the server
+    return isinstance(error, requests.exceptions.ConnectTimeout) or "NewConnectionError" in repr(error)
+
+class MediaServerClient:
+    """Pooled keep-alive HTTP client for the Plex and Jellyfin APIs.
+
+    Every request gets a timeout so a hung server can't stall the schedule loop, and
+    connection errors, timeouts and 429/5xx answers are retried a bounded number of times
+    with jittered exponential backoff. POSTs are only retried on 429 or if the connection
+    never got established. Latency is recorded per endpoint.
+    """
+
+    def __init__(self, name, base_url, headers=None, params=None, timeout=MEDIA_SERVER_TIMEOUT,
+                 retries=MEDIA_SERVER_RETRIES, backoff=0.5, pool_size=10):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        self.session.params = dict(params or {})
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self.latency = {}
+
+    def _record(self, endpoint, seconds, failed):
+        with self._lock:
+            stats = self.latency.setdefault(endpoint, {"count": 0, "errors": 0, "total": 0.0, "max": 0.0})
+            stats["count"] += 1
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            if failed:
+                stats["errors"] += 1
+
+    def _sleep_before_retry(self, attempt):
+        time.sleep(self.backoff * (2 ** attempt) + random.uniform(0, self.backoff))
+
+    def request(self, method, path, **kwargs):
+        """Sends a request to base_url + path and returns the response (of the last attempt)."""
+        method = method.upper()
+        endpoint = endpoint_name(method, path)
+        kwargs.setdefault("timeout", self.timeout)
+        url = f"{self.base_url}{path}"
+
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                self._record(endpoint, time.perf_counter() - start, True)
+                if attempt == self.retries or not can_retry(method, e):
+                    raise
+            else:
+                failed = response.status_code >= 400
+                self._record(endpoint, time.perf_counter() - start, failed)
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.retries:
+                    return response
+                if method not in IDEMPOTENT_METHODS and response.status_code != 429:
+                    return response
+            self._sleep_before_retry(attempt)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def get_json(self, path, **kwargs):
+        response = self.get(path, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    def latency_summary(self):
+        with self._lock:
+            items = sorted(self.latency.items(), key=lambda item: item[1]["total"], reverse=True)
+        return [
+            f"{self.name} {endpoint}: {stats['count']} calls, avg {stats['total'] / stats['count'] * 1000:.0f} ms, "
+            f"max {stats['max'] * 1000:.0f} ms, {stats['errors']} errors"
+            for endpoint, stats in items
+        ]
@@ -0,0 +1,202 @@
+# ./src/metrics.py
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from atomic_file import write_atomic
+
+# Port of the local Prometheus /metrics endpoint, 0 turns it off
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+METRIC_PREFIX = "amps_"
+# Seconds, wide enough for a 10ms tag write and a 30 minute sync job alike
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+def _series_key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (Prometheus-style estimate)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 4),
+            "avg": round(self.sum / self.count, 4) if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": round(self.max, 4),
+        }
+
+class MetricsRegistry:
+    """Thread-safe counters, gauges and histograms for the sync job.
+
+    Everything is kept twice: cumulative for the /metrics endpoint (Prometheus expects
+    counters that only go up), and for the current run, which becomes the JSON run summary.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._total = {"counter": {}, "gauge": {}, "histogram": {}}
+        self._run = {"counter": {}, "gauge": {}, "histogram": {}}
+        self._run_started = None
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def begin_run(self):
+        with self._lock:
+            self._run = {"counter": {}, "gauge": {}, "histogram": {}}
+            self._run_started = time.time()
+
+    def inc(self, name, amount=1, **labels):
+        key = _series_key(name, labels)
+        with self._lock:
+            for store in (self._total, self._run):
+                store["counter"][key] = store["counter"].get(key, 0) + amount
+
+    def set_gauge(self, name, value, **labels):
+        key = _series_key(name, labels)
+        with self._lock:
+            for store in (self._total, self._run):
+                store["gauge"][key] = value
+
+    def observe(self, name, value, **labels):
+        key = _series_key(name, labels)
+        with self._lock:
+            for store in (self._total, self._run):
+                histogram = store["histogram"].get(key)
+                if histogram is None:
+                    histogram = store["histogram"][key] = Histogram()
+                histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes how long the with-block took, also when it raised."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render_prometheus(self):
+        """The cumulative metrics in Prometheus' text exposition format."""
+        lines = []
+        with self._lock:
+            for kind in ("counter", "gauge", "histogram"):
+                by_name = {}
+                for (name, labels), value in self._total[kind].items():
+                    by_name.setdefault(name, []).append((labels, value))
+                for name in sorted(by_name):
+                    full_name = METRIC_PREFIX + name
+                    if name in self._help:
+                        lines.append(f"# HELP {full_name} {self._help[name]}")
+                    lines.append(f"# TYPE {full_name} {kind}")
+                    for labels, value in sorted(by_name[name]):
+                        if kind != "histogram":
+                            lines.append(f"{full_name}{_format_labels(labels)} {value}")
+                            continue
+                        cumulative = 0
+                        for bound, count in zip(value.buckets, value.counts):
+                            cumulative += count
+                            lines.append(f"{full_name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+                        lines.append(f"{full_name}_bucket{_format_labels(labels, [('le', '+Inf')])} {value.count}")
+                        lines.append(f"{full_name}_sum{_format_labels(labels)} {value.sum}")
+                        lines.append(f"{full_name}_count{_format_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    def run_summary(self):
+        """This run's metrics as plain JSON-able data."""
+        def label_text(name, labels):
+            return name + _format_labels(labels)
+
+        with self._lock:
+            return {
+                "started": self._run_started,
+                "counters": {label_text(name, labels): value for (name, labels), value in sorted(self._run["counter"].items())},
+                "gauges": {label_text(name, labels): value for (name, labels), value in sorted(self._run["gauge"].items())},
+                "histograms": {label_text(name, labels): value.to_dict() for (name, labels), value in sorted(self._run["histogram"].items())},
+            }
+
+    def write_run_summary(self, path, **extra):
+        summary = {**self.run_summary(), "finished": time.time(), **extra}
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_atomic(path, json.dumps(summary, indent=2))
+        except Exception as e:
+            print(f"Could not write the run summary: {e}")
+        return summary
+
+metrics = MetricsRegistry()
+metrics.describe("stage_seconds", "Time spent per sync stage (per track for download, transcode and tag).")
+metrics.describe("playlist_fetch_seconds", "Time to fetch one playlist from YouTube Music.")
+metrics.describe("downloaded_bytes_total", "Audio bytes downloaded from YouTube.")
+metrics.describe("library_bytes_written_total", "Bytes of finished tracks copied from staging into the library.")
+metrics.describe("cache_requests_total", "Lookups in AmpsAssist's caches by result.")
+metrics.describe("failures_total", "Failures by reason.")
+metrics.describe("tracks_total", "Unique tracks processed by outcome.")
+metrics.describe("retag_files_total", "Library files checked by the re-tag job by outcome.")
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = metrics.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_metrics_server(port=METRICS_PORT):
+    """Serves /metrics on a daemon thread. Returns the server, or None if disabled or the port is taken."""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    except OSError as e:
+        print(f"Could not start the metrics endpoint on port {port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,80 @@
+# ./src/pipeline.py
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class Stage:
+    """A worker pool with its own bounded queue and utilisation stats.
+
+    submit() blocks once `workers + queue_size` tasks are waiting or running, which
+    pushes back on whoever feeds the stage instead of letting work pile up in memory.
+    """
+
+    def __init__(self, name, workers, queue_size):
+        self.name = name
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._stopped = None
+        self.stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "busy_seconds": 0.0,
+            "wait_seconds": 0.0,
+            "blocked_seconds": 0.0,
+            "queued": 0,
+            "peak_queued": 0,
+        }
+
+    def _run(self, queued_at, fn, args, kwargs):
+        started = time.perf_counter()
+        with self._lock:
+            self.stats["wait_seconds"] += started - queued_at
+            self.stats["queued"] -= 1
+        failed = False
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            with self._lock:
+                self.stats["busy_seconds"] += time.perf_counter() - started
+                self.stats["completed"] += 1
+                if failed:
+                    self.stats["failed"] += 1
+            self._slots.release()
+
+    def submit(self, fn, *args, **kwargs):
+        blocked_at = time.perf_counter()
+        self._slots.acquire()
+        queued_at = time.perf_counter()
+        with self._lock:
+            self.stats["blocked_seconds"] += queued_at - blocked_at
+            self.stats["submitted"] += 1
+            self.stats["queued"] += 1
+            self.stats["peak_queued"] = max(self.stats["peak_queued"], self.stats["queued"])
+        return self._executor.submit(self._run, queued_at, fn, args, kwargs)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+        self._stopped = time.perf_counter()
+
+    def utilisation(self):
+        """Fraction of the stage's worker-time that was spent doing work."""
+        elapsed = (self._stopped or time.perf_counter()) - self._started
+        if elapsed <= 0:
+            return 0.0
+        with self._lock:
+            return min(1.0, self.stats["busy_seconds"] / (elapsed * self.workers))
+
+    def summary(self):
+        with self._lock:
+            stats = dict(self.stats)
+        avg_wait = stats["wait_seconds"] / stats["completed"] if stats["completed"] else 0.0
+        return (f"{self.name}: {self.workers} workers, {stats['completed']} tasks ({stats['failed']} failed), "
+                f"{self.utilisation():.0%} busy, avg queue wait {avg_wait:.1f}s, peak queue {stats['peak_queued']}, "
+                f"producers blocked {stats['blocked_seconds']:.1f}s")
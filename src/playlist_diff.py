@@ -0,0 +1,78 @@
+# ./src/playlist_diff.py
+import bisect
+from collections import Counter, deque
+
+# Playlists are diffed as [(entry_id, track_key)] in playlist order: the entry id names one slot
+# in the playlist (Plex's playlistItemID, Jellyfin's PlaylistItemId), the key names the track.
+
+def longest_increasing_run(values):
+    """Indices of a longest strictly increasing subsequence of values (patience sorting)."""
+    tails = []
+    tail_indices = []
+    previous = [None] * len(values)
+    for i, value in enumerate(values):
+        pos = bisect.bisect_left(tails, value)
+        if pos == len(tails):
+            tails.append(value)
+            tail_indices.append(i)
+        else:
+            tails[pos] = value
+            tail_indices[pos] = i
+        previous[i] = tail_indices[pos - 1] if pos else None
+    result = set()
+    i = tail_indices[-1] if tail_indices else None
+    while i is not None:
+        result.add(i)
+        i = previous[i]
+    return result
+
+def plan_membership_changes(entries, desired_keys):
+    """Returns (entry ids to remove, track keys to add) to turn entries into desired_keys."""
+    wanted = Counter(desired_keys)
+    removes = []
+    for item_id, key in entries:
+        if wanted[key] > 0:
+            wanted[key] -= 1
+        else:
+            removes.append(item_id)
+    present = Counter(key for _, key in entries)
+    adds = []
+    for key in desired_keys:
+        if present[key] > 0:
+            present[key] -= 1
+        else:
+            adds.append(key)
+    return removes, adds
+
+def plan_moves(entries, desired_keys):
+    """Returns [(entry_id, after_entry_id or None)] moves that put entries in desired order.
+
+    Items that are already in the right relative order stay where they are, so a playlist
+    that only had one song move costs a single request.
+    """
+    pools = {}
+    for item_id, key in entries:
+        pools.setdefault(key, deque()).append(item_id)
+    target = [pools[key].popleft() for key in desired_keys if pools.get(key)]
+    position = {item_id: i for i, (item_id, _) in enumerate(entries)}
+    stable = longest_increasing_run([position[item_id] for item_id in target])
+
+    moves = []
+    for i, item_id in enumerate(target):
+        if i not in stable:
+            moves.append((item_id, target[i - 1] if i else None))
+    return moves
+
+def moves_to_indices(item_ids, moves):
+    """Turns (item, after) moves into (item, new_index) moves for APIs that move by position.
+
+    The index is where the item lands once it has been taken out of the list, applied in order.
+    """
+    order = list(item_ids)
+    indexed = []
+    for item_id, after_id in moves:
+        order.remove(item_id)
+        index = order.index(after_id) + 1 if after_id else 0
+        order.insert(index, item_id)
+        indexed.append((item_id, index))
+    return indexed
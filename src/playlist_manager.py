@@ -1,22 +1,36 @@
 # ./src/playlist_manager.py
 import os
 import re
-from ytmusicapi import YTMusic
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from config import PLAYLIST_IDS, MAX_SONGS_PER_PLAYLIST
+from file_manager import playlist_snapshots
+from metrics import metrics
 
 import json
 
 AUTH_FILE = '/app/browser.json'
 COOKIES_FILE = '/app/cookies.txt'
 
+# Everything goes to music.youtube.com, so one limit covers the whole host
+PLAYLIST_FETCH_WORKERS = int(os.getenv("PLAYLIST_FETCH_WORKERS", "4"))
+FETCH_MAX_RETRIES = 4
+FETCH_BACKOFF_SECONDS = 2
+_fetch_slots = threading.BoundedSemaphore(PLAYLIST_FETCH_WORKERS)
+
 def sync_cookies_to_browser_json():
-    """Generates browser.json from cookies.txt so the user only needs one auth file."""
+    """Generates browser.json from cookies.txt so the user only needs one auth file.
+
+    Returns True if browser.json was (re)written.
+    """
     if not os.path.exists(COOKIES_FILE):
-        return
+        return False
         
     # Only update if cookies.txt is newer than browser.json, or browser.json doesn't exist
     if os.path.exists(AUTH_FILE) and os.path.getmtime(AUTH_FILE) >= os.path.getmtime(COOKIES_FILE):
-        return
+        return False
         
     print("New cookies.txt detected! Converting to browser.json automatically...")
     cookie_str = []
@@ -49,19 +63,40 @@ def sync_cookies_to_browser_json():
         with open(AUTH_FILE, "w", encoding="utf-8") as f:
             json.dump(browser_json, f, indent=4)
         print("Successfully generated browser.json from cookies.txt!")
+        return True
     except Exception as e:
         print(f"Failed to parse cookies.txt: {e}")
+        return False
 
-sync_cookies_to_browser_json()
+# YTMusic clients are built on first use (not at import) and then reused
+_clients = {}
+_clients_lock = threading.RLock()
 
-yt_unauth = YTMusic()
+def get_unauth_client():
+    with _clients_lock:
+        if "unauth" not in _clients:
+            from ytmusicapi import YTMusic
+            _clients["unauth"] = YTMusic()
+        return _clients["unauth"]
 
-if os.path.exists(AUTH_FILE):
-    print("Logged in: Using authenticated Browser session.")
-    yt = YTMusic(AUTH_FILE)
-else:
-    print("WARNING: Running unauthenticated. Private/Feed playlists will fail.")
-    yt = yt_unauth
+def get_client():
+    """The authenticated YTMusic client, or the anonymous one without browser.json.
+
+    Cookies are converted to browser.json on demand, and a newer cookies.txt replaces the
+    cached client on the next call.
+    """
+    with _clients_lock:
+        refreshed = sync_cookies_to_browser_json()
+        if "auth" in _clients and not refreshed:
+            return _clients["auth"]
+        if os.path.exists(AUTH_FILE):
+            from ytmusicapi import YTMusic
+            print("Logged in: Using authenticated Browser session.")
+            _clients["auth"] = YTMusic(AUTH_FILE)
+        else:
+            print("WARNING: Running unauthenticated. Private/Feed playlists will fail.")
+            _clients["auth"] = get_unauth_client()
+        return _clients["auth"]
 
 def extract_playlist_id(url_or_id):
     match = re.search(r"[?&]list=([^&]+)", url_or_id)
@@ -71,10 +106,11 @@ from rich.console import Console
 console = Console()
 
 def get_auto_feed_playlists():
+    """Returns {playlist_id: (title, playlist_class)}, the class being "feed" or "community"."""
     auto_playlists = {}
     try:
         console.print("[cyan]Scanning YouTube Music Home screen for Feed playlists...[/cyan]")
-        home_shelves = yt.get_home(limit=10)
+        home_shelves = call_with_backoff(get_client().get_home, limit=10)
         
         for shelf in home_shelves:
             title = shelf.get('title', '').lower()
@@ -86,7 +122,7 @@ def get_auto_feed_playlists():
                     # Only download the specific mixes the user requested
                     if mix_title.lower() in ['my supermix', 'my mix 1']:
                         if pid and pid not in auto_playlists:
-                            auto_playlists[pid] = mix_title
+                            auto_playlists[pid] = (mix_title, "feed")
                             console.print(f" [green]✓ Found:[/green] {mix_title}")
                             
             elif 'from the community' in title:
@@ -95,7 +131,7 @@ def get_auto_feed_playlists():
                     pid = item.get('playlistId', '')
                     if pid and pid not in auto_playlists:
                         mix_title = item.get('title', 'Unknown Mix')
-                        auto_playlists[pid] = mix_title
+                        auto_playlists[pid] = (mix_title, "community")
                         console.print(f" [green]✓ Found:[/green] {mix_title}")
                         count += 1
                         
@@ -109,7 +145,7 @@ def get_library_playlists():
     lib_playlists = {}
     try:
         console.print("[cyan]Fetching saved playlists from your Library...[/cyan]")
-        playlists = yt.get_library_playlists(limit=50)
+        playlists = call_with_backoff(get_client().get_library_playlists, limit=50)
         for p in playlists:
             if 'playlistId' in p:
                 lib_playlists[p['playlistId']] = p.get('title', 'Unknown Playlist')
@@ -118,76 +154,172 @@ def get_library_playlists():
         console.print(f"[red]Could not fetch library playlists: {e}[/red]")
     return lib_playlists
 
-def get_playlist_tracks():
-    tracks_to_process = []
+def call_with_backoff(fn, *args, **kwargs):
+    """Runs a ytmusicapi call under the shared concurrency limit, backing off on 429s."""
+    for attempt in range(FETCH_MAX_RETRIES + 1):
+        with _fetch_slots:
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt == FETCH_MAX_RETRIES or not ("429" in str(e) or "Too Many Requests" in str(e)):
+                    raise
+        # Sleep outside the slot so other playlists keep going while we wait
+        delay = FETCH_BACKOFF_SECONDS * (2 ** attempt) + random.uniform(0, FETCH_BACKOFF_SECONDS)
+        console.print(f"[yellow]YouTube Music rate limited us, retrying in {delay:.1f}s...[/yellow]")
+        time.sleep(delay)
+
+def fetch_playlist(pid, known_title):
+    """Fetches one playlist and returns (playlist_name, tracks) in playlist order."""
+    tracks = []
     
+    # Default to the known title if we have it!
+    playlist_name = known_title if known_title else f"Playlist_{pid}"
+
+    if pid.startswith('RD'):
+        res = call_with_backoff(get_client().get_watch_playlist, playlistId=pid, limit=MAX_SONGS_PER_PLAYLIST)
+        tracks = res.get('tracks', [])
+        
+        # Only try to grab the title from the response if we don't already have it
+        if not known_title and res.get('title'):
+            playlist_name = res.get('title')
+    else:
+        try:
+            res = call_with_backoff(get_client().get_playlist, pid, limit=MAX_SONGS_PER_PLAYLIST)
+            tracks = res.get('tracks', [])
+            if not known_title:
+                playlist_name = res.get('title', playlist_name)
+        except Exception as e:
+            if "400" in str(e) or "404" in str(e):
+                res = call_with_backoff(get_unauth_client().get_playlist, pid, limit=MAX_SONGS_PER_PLAYLIST)
+                tracks = res.get('tracks', [])
+                if not known_title:
+                    playlist_name = res.get('title', playlist_name)
+            else:
+                raise e
+
+    # Clean up YouTube's weird formatting for Supermixes
+    if playlist_name.startswith("Playlist_RD"):
+        playlist_name = "My Supermix" # Ultimate fallback
+
+    playlist_tracks = []
+    for position, track in enumerate(tracks[:MAX_SONGS_PER_PLAYLIST]):
+        title = track.get('title', 'Unknown Title')
+        artists = ", ".join([a['name'] for a in track.get('artists', []) if 'name' in a])
+        album = track.get('album', {}).get('name') if track.get('album') else 'Unknown Album'
+        # ytmusicapi lists thumbnails smallest first
+        thumbnails = track.get('thumbnails') or []
+        
+        playlist_tracks.append({
+            'video_id': track['videoId'],
+            'title': title,
+            'artist': artists,
+            'album': album,
+            'thumbnail_url': thumbnails[-1].get('url') if thumbnails else None,
+            'playlist_name': playlist_name,
+            'position': position
+        })
+    return playlist_name, playlist_tracks
+
+def timed_fetch_playlist(pid, known_title, observe=True):
+    start = time.perf_counter()
+    try:
+        playlist_name, tracks = fetch_playlist(pid, known_title)
+    except Exception as e:
+        print(f"Error fetching playlist {pid}: {e}")
+        metrics.inc("failures_total", reason="playlist_fetch")
+        return pid, [], time.perf_counter() - start
+    elapsed = time.perf_counter() - start
+    metrics.observe("playlist_fetch_seconds", elapsed)
+    if not observe:
+        console.print(f" [dim]Fetched '{playlist_name}': {len(tracks)} tracks in {elapsed:.2f}s[/dim]")
+        return playlist_name, tracks, elapsed
+    changed = playlist_snapshots.observe(playlist_name, tracks)
+    metrics.inc("cache_requests_total", cache="playlist_snapshots", result="miss" if changed else "hit")
+    status = "changed" if changed else "unchanged"
+    console.print(f" [dim]Fetched '{playlist_name}': {len(tracks)} tracks in {elapsed:.2f}s ({status})[/dim]")
+    return playlist_name, tracks, elapsed
+
+def iter_playlist_tracks(feed_only=False, journal=None, snapshots=True):
+    """Yields tracks playlist by playlist as soon as each one has been fetched.
+
+    feed_only limits the run to the Home feed mixes, skipping PLAYLIST_IDS and the Library.
+    With a JobJournal, the playlist plan and every fetched playlist are checkpointed, and a
+    resumed job replays them instead of asking YouTube Music again.
+    With snapshots=False the playlist snapshots are left alone, for jobs that only read tracks.
+    """
+    discovery_started = time.perf_counter()
+    if snapshots:
+        playlist_snapshots.begin_run()
     # Use a dictionary to map IDs to their human-readable titles
     playlists_map = {}
+    # And to their class (feed/community/library), which decides download priority
+    playlist_classes = {}
     
     def normalize_pid(pid):
         return pid[2:] if pid.startswith('VL') else pid
 
-    for raw_pid in PLAYLIST_IDS:
-        pid = extract_playlist_id(raw_pid)
-        playlists_map[normalize_pid(pid)] = None
-        
-    if os.path.exists(AUTH_FILE):
-        for pid, title in get_auto_feed_playlists().items():
-            playlists_map[normalize_pid(pid)] = title
-            
-        for pid, title in get_library_playlists().items():
-            norm_pid = normalize_pid(pid)
-            if norm_pid not in playlists_map or not playlists_map[norm_pid]:
-                playlists_map[norm_pid] = title
+    if journal and journal.resumed and journal.plan is not None:
+        playlists_map = dict(journal.plan)
+        playlist_classes = dict(journal.plan_classes)
+        console.print(f"\n[yellow]Resuming discovery: {len(journal.playlists)} of {len(playlists_map)} playlists were already fetched.[/yellow]")
+    else:
+        for raw_pid in [] if feed_only else PLAYLIST_IDS:
+            pid = extract_playlist_id(raw_pid)
+            playlists_map[normalize_pid(pid)] = None
+            playlist_classes[normalize_pid(pid)] = "library"
+
+        # First use builds the client (and browser.json from a new cookies.txt)
+        get_client()
+        if os.path.exists(AUTH_FILE) and feed_only:
+            for pid, (title, playlist_class) in get_auto_feed_playlists().items():
+                playlists_map[normalize_pid(pid)] = title
+                playlist_classes[normalize_pid(pid)] = playlist_class
+        elif os.path.exists(AUTH_FILE):
+            # Home feed and library are independent requests, so fetch them side by side
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                feed_future = executor.submit(get_auto_feed_playlists)
+                library_future = executor.submit(get_library_playlists)
+
+            for pid, (title, playlist_class) in feed_future.result().items():
+                playlists_map[normalize_pid(pid)] = title
+                playlist_classes[normalize_pid(pid)] = playlist_class
+                
+            for pid, title in library_future.result().items():
+                norm_pid = normalize_pid(pid)
+                if norm_pid not in playlists_map or not playlists_map[norm_pid]:
+                    playlists_map[norm_pid] = title
+                playlist_classes.setdefault(norm_pid, "library")
+        if journal:
+            journal.record_plan(playlists_map, playlist_classes)
 
     console.print(f"\n[bold blue]Total unique playlists to process: {len(playlists_map)}[/bold blue]\n")
+
+    # Playlists fetched before the interruption are replayed from the journal
+    fetched = journal.playlists if journal and journal.resumed else {}
+    for pid in playlists_map:
+        if pid in fetched:
+            playlist_name, tracks = fetched[pid]
+            if snapshots:
+                playlist_snapshots.observe(playlist_name, tracks)
+            yield from tracks
     
-    for pid, known_title in playlists_map.items():
-        try:
-            tracks = []
-            
-            # Default to the known title if we have it!
-            playlist_name = known_title if known_title else f"Playlist_{pid}"
+    start = time.perf_counter()
+    timings = []
+    with ThreadPoolExecutor(max_workers=PLAYLIST_FETCH_WORKERS) as executor:
+        futures = {executor.submit(timed_fetch_playlist, pid, known_title, snapshots): pid
+                   for pid, known_title in playlists_map.items() if pid not in fetched}
+        # Hand tracks on in completion order, playlist order is kept by each track's position
+        for future in as_completed(futures):
+            playlist_name, tracks, elapsed = future.result()
+            timings.append((elapsed, playlist_name))
+            for track in tracks:
+                track['playlist_class'] = playlist_classes.get(futures[future], "library")
+            # Empty means failed or empty, either way it's cheap to ask again after a restart
+            if journal and tracks:
+                journal.record_playlist(futures[future], playlist_name, tracks)
+            yield from tracks
 
-            if pid.startswith('RD'):
-                res = yt.get_watch_playlist(playlistId=pid, limit=MAX_SONGS_PER_PLAYLIST)
-                tracks = res.get('tracks', [])
-                
-                # Only try to grab the title from the response if we don't already have it
-                if not known_title and res.get('title'):
-                    playlist_name = res.get('title')
-            else:
-                try:
-                    res = yt.get_playlist(pid, limit=MAX_SONGS_PER_PLAYLIST)
-                    tracks = res.get('tracks', [])
-                    if not known_title:
-                        playlist_name = res.get('title', playlist_name)
-                except Exception as e:
-                    if "400" in str(e) or "404" in str(e):
-                        res = yt_unauth.get_playlist(pid, limit=MAX_SONGS_PER_PLAYLIST)
-                        tracks = res.get('tracks', [])
-                        if not known_title:
-                            playlist_name = res.get('title', playlist_name)
-                    else:
-                        raise e
-
-            # Clean up YouTube's weird formatting for Supermixes
-            if playlist_name.startswith("Playlist_RD"):
-                playlist_name = "My Supermix" # Ultimate fallback
-
-            for track in tracks[:MAX_SONGS_PER_PLAYLIST]:
-                title = track.get('title', 'Unknown Title')
-                artists = ", ".join([a['name'] for a in track.get('artists', []) if 'name' in a])
-                album = track.get('album', {}).get('name') if track.get('album') else 'Unknown Album'
-                
-                tracks_to_process.append({
-                    'video_id': track['videoId'],
-                    'title': title,
-                    'artist': artists,
-                    'album': album,
-                    'playlist_name': playlist_name
-                })
-        except Exception as e:
-            print(f"Error fetching playlist {pid}: {e}")
-            
-    return tracks_to_process
\ No newline at end of file
+    metrics.observe("stage_seconds", time.perf_counter() - discovery_started, stage="discovery")
+    if timings:
+        slowest_time, slowest_name = max(timings)
+        console.print(f"[dim]Fetched {len(timings)} playlists in {time.perf_counter() - start:.2f}s (slowest: '{slowest_name}' at {slowest_time:.2f}s)[/dim]")
@@ -0,0 +1,116 @@
+# ./src/playlist_snapshots.py
+import os
+import json
+import time
+import hashlib
+import threading
+from atomic_file import write_atomic
+
+SNAPSHOT_VERSION = 1
+
+def hash_tracks(tracks):
+    """Content hash of a playlist's track list (order, ids and the metadata we tag with)."""
+    digest = hashlib.sha1()
+    for track in tracks:
+        line = "\x1f".join(str(track.get(key, "")) for key in ("video_id", "title", "artist", "album"))
+        digest.update(line.encode("utf-8") + b"\n")
+    return digest.hexdigest()
+
+class PlaylistSnapshots:
+    """Remembers each playlist's last written track list so unchanged playlists can be skipped.
+
+    Every run calls observe() with the freshly fetched tracks. A playlist only counts as
+    unchanged if its hash matches the last run *and* that run wrote it completely, so a
+    playlist with failed downloads keeps being retried. Songs the failure cache skipped on
+    purpose count as dealt with, and the snapshot keeps how many songs were written, so the
+    playlist is rewritten once such a song does download.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._snapshots = {}
+        self._pending = {}
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get("version") == SNAPSHOT_VERSION:
+                return data.get("playlists", {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"Playlist snapshots are unreadable, doing a full rebuild: {e}")
+        return {}
+
+    def begin_run(self):
+        """Reloads the stored snapshots and starts collecting this run's playlists."""
+        snapshots = self._load()
+        with self._lock:
+            self._snapshots = snapshots
+            self._pending = {}
+
+    def observe(self, playlist_name, tracks):
+        """Records this run's track list for a playlist. Returns True if it changed."""
+        tracks = [track for track in tracks if track.get('video_id')]
+        entry = {"hash": hash_tracks(tracks), "track_count": len(tracks)}
+        with self._lock:
+            self._pending[playlist_name] = entry
+            previous = self._snapshots.get(playlist_name)
+        return not (previous and previous.get("complete") and previous.get("hash") == entry["hash"])
+
+    def is_unchanged(self, playlist_name, written_count=None):
+        """True if the playlist matches the last complete run (and, if given, has as many songs written)."""
+        with self._lock:
+            pending = self._pending.get(playlist_name)
+            previous = self._snapshots.get(playlist_name)
+        if not (pending and previous and previous.get("complete") and previous.get("hash") == pending["hash"]):
+            return False
+        return written_count is None or previous.get("written", previous["track_count"]) == written_count
+
+    def expected_tracks(self, playlist_name):
+        with self._lock:
+            pending = self._pending.get(playlist_name)
+        return pending["track_count"] if pending else 0
+
+    def seen_names(self):
+        with self._lock:
+            return list(self._pending)
+
+    def commit(self, playlist_name, written_count, skipped_count=0):
+        """Marks this run's version of a playlist as written to disk.
+
+        skipped_count is how many of its songs the failure cache skipped on purpose, those
+        don't keep the playlist incomplete.
+        """
+        with self._lock:
+            pending = self._pending.get(playlist_name)
+            if not pending:
+                return
+            self._snapshots[playlist_name] = {
+                "hash": pending["hash"],
+                "track_count": pending["track_count"],
+                "written": written_count,
+                "complete": written_count + skipped_count >= pending["track_count"],
+                "updated": time.time(),
+            }
+
+    def evict_missing(self):
+        """Drops snapshots of playlists that weren't seen this run. Returns their names."""
+        with self._lock:
+            if not self._pending:
+                return [] # Discovery found nothing, don't forget everything over a network blip
+            missing = [name for name in self._snapshots if name not in self._pending]
+            for name in missing:
+                del self._snapshots[name]
+        return missing
+
+    def save(self):
+        with self._lock:
+            data = {"version": SNAPSHOT_VERSION, "playlists": self._snapshots}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            write_atomic(self.path, json.dumps(data))
+        except Exception as e:
+            print(f"Could not save playlist snapshots: {e}")
@@ -1,9 +1,14 @@
 # ./src/plex_sync.py
 import os
+import json
 import time
 import glob
-import requests
+from concurrent.futures import ThreadPoolExecutor
 from config import PLAYLISTS_DIR
+from atomic_file import write_atomic
+from file_manager import get_m3u_playlist_key, read_m3u_paths, to_local_path, DOCKER_DOWNLOADS_PATH, STATE_DIR
+from media_client import MediaServerClient
+from playlist_diff import plan_membership_changes, plan_moves
 from rich.console import Console
 
 console = Console()
@@ -14,26 +19,93 @@ PLEX_LIBRARY_NAME = os.getenv("PLEX_LIBRARY", "Music")
 PLEX_MUSIC_PATH = os.getenv("PLEX_MUSIC_PATH", "/media/music")
 PLEX_M3U_PATH = f"{PLEX_MUSIC_PATH}/Playlists"
 
+# Scan-completion polling: give up after PLEX_SCAN_TIMEOUT, never sleep longer than the ceiling between polls
+PLEX_SCAN_TIMEOUT = int(os.getenv("PLEX_SCAN_TIMEOUT", "600"))
+PLEX_SCAN_POLL_CEILING = 15
+PLEX_SCAN_START_GRACE = 5
+# More changed folders than this and a single full section scan is cheaper
+PLEX_MAX_PARTIAL_SCANS = int(os.getenv("PLEX_MAX_PARTIAL_SCANS", "50"))
+
+# Playlist reconciliation: concurrent playlists, items per listing page, tracks per add request
+PLEX_SYNC_WORKERS = int(os.getenv("PLEX_SYNC_WORKERS", "4"))
+PLEX_PAGE_SIZE = 1000
+PLEX_ADD_BATCH = 100
+
+# Local paths of every saved playlist, keyed by ratingKey and invalidated by Plex's updatedAt
+PLEX_SAVED_CACHE_PATH = os.path.join(STATE_DIR, "plex_saved_playlists.json")
+
+# One keep-alive session for every Plex call, the token rides along as a query param
+plex_client = MediaServerClient(
+    "plex", PLEX_URL,
+    headers={"Accept": "application/json"},
+    params={"X-Plex-Token": PLEX_TOKEN},
+)
+
 def get_section_id():
     """Finds the internal ID of your Plex Music library."""
-    url = f"{PLEX_URL}/library/sections?X-Plex-Token={PLEX_TOKEN}"
-    headers = {"Accept": "application/json"}
-    response = requests.get(url, headers=headers).json()
+    response = plex_client.get_json("/library/sections")
     for directory in response.get("MediaContainer", {}).get("Directory", []):
         if directory.get("title") == PLEX_LIBRARY_NAME:
             return directory.get("key")
     return None
 
-def trigger_scan(section_id):
-    """Tells Plex to look for the newly downloaded MP3s."""
-    url = f"{PLEX_URL}/library/sections/{section_id}/refresh?X-Plex-Token={PLEX_TOKEN}"
-    requests.get(url)
+def trigger_scan(section_id, paths=None):
+    """Tells Plex to look for the newly downloaded songs, either in the given folders or the whole section."""
+    if not paths:
+        plex_client.get(f"/library/sections/{section_id}/refresh")
+        return
+    for path in paths:
+        plex_client.get(f"/library/sections/{section_id}/refresh", params={"path": path})
+
+def get_scan_paths(changed_dirs):
+    """Maps changed local Artist/Album folders to Plex paths. Returns None when a full scan is cheaper."""
+    if len(changed_dirs) > PLEX_MAX_PARTIAL_SCANS:
+        return None
+    paths = set()
+    for local_dir in changed_dirs:
+        # A folder the orphan cleanup removed can't be scanned, its closest surviving parent can
+        while not os.path.isdir(local_dir) and local_dir != DOCKER_DOWNLOADS_PATH and os.path.dirname(local_dir) != local_dir:
+            local_dir = os.path.dirname(local_dir)
+        paths.add(local_dir.replace(DOCKER_DOWNLOADS_PATH, PLEX_MUSIC_PATH))
+    return sorted(paths)
+
+def is_section_refreshing(section_id):
+    response = plex_client.get_json("/library/sections")
+    for directory in response.get("MediaContainer", {}).get("Directory", []):
+        if str(directory.get("key")) == str(section_id):
+            return bool(directory.get("refreshing"))
+    return False
+
+def wait_for_scan(section_id):
+    """Polls the section's refreshing flag with exponential backoff until Plex has finished scanning.
+
+    Plex can take a moment to pick up a scan request, so an idle section only counts as done
+    once the scan was seen running or the start-up grace period has passed.
+    """
+    start = time.perf_counter()
+    delay = 1
+    seen_running = False
+    while True:
+        elapsed = time.perf_counter() - start
+        try:
+            refreshing = is_section_refreshing(section_id)
+        except Exception as e:
+            console.print(f"[yellow]Could not check Plex scan status: {e}[/yellow]")
+            refreshing = True
+        if refreshing:
+            seen_running = True
+        elif seen_running or elapsed >= PLEX_SCAN_START_GRACE:
+            console.print(f"[green]Plex finished scanning after {elapsed:.0f}s.[/green]")
+            return True
+        if elapsed >= PLEX_SCAN_TIMEOUT:
+            console.print(f"[yellow]Plex is still scanning after {elapsed:.0f}s, carrying on anyway.[/yellow]")
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, PLEX_SCAN_POLL_CEILING)
 
 def get_existing_playlists():
     """Fetches a list of all current playlists in Plex."""
-    url = f"{PLEX_URL}/playlists?X-Plex-Token={PLEX_TOKEN}"
-    headers = {"Accept": "application/json"}
-    response = requests.get(url, headers=headers).json()
+    response = plex_client.get_json("/playlists")
     playlists = {}
     if "Metadata" in response.get("MediaContainer", {}):
         for pl in response["MediaContainer"]["Metadata"]:
@@ -43,43 +115,142 @@ def get_existing_playlists():
             summary = pl.get("summary", "").lower()
             playlists[title] = {
                 "ratingKey": rating_key,
+                "updatedAt": pl.get("updatedAt"),
                 "is_saved": "save" in summary
             }
     return playlists
 
-def get_playlist_items(rating_key):
-    """Fetches the internal file paths of every song inside a specific Plex playlist."""
-    url = f"{PLEX_URL}/playlists/{rating_key}/items?X-Plex-Token={PLEX_TOKEN}"
-    headers = {"Accept": "application/json"}
-    response = requests.get(url, headers=headers).json()
-    paths = []
-    if "Metadata" in response.get("MediaContainer", {}):
-        for track in response["MediaContainer"]["Metadata"]:
-            try:
-                for media in track.get("Media", []):
-                    for part in media.get("Part", []):
-                        if "file" in part:
-                            paths.append(part["file"])
-            except Exception:
-                pass
+def get_paged_metadata(path, params=None):
+    """Yields every Metadata entry of a Plex listing, fetching it a page at a time."""
+    start = 0
+    while True:
+        headers = {"X-Plex-Container-Start": str(start), "X-Plex-Container-Size": str(PLEX_PAGE_SIZE)}
+        container = plex_client.get_json(path, params=params, headers=headers).get("MediaContainer", {})
+        items = container.get("Metadata", [])
+        yield from items
+        start += len(items)
+        total = container.get("totalSize")
+        if len(items) < PLEX_PAGE_SIZE or (total is not None and start >= int(total)):
+            return
+
+def get_track_files(track):
+    files = []
+    for media in track.get("Media", []):
+        for part in media.get("Part", []):
+            if "file" in part:
+                files.append(part["file"])
+    return files
+
+def get_playlist_local_paths(rating_key):
+    """Streams a playlist's items page by page into a set of normalised local paths."""
+    paths = set()
+    for track in get_paged_metadata(f"/playlists/{rating_key}/items"):
+        for file_path in get_track_files(track):
+            paths.add(to_local_path(file_path, PLEX_MUSIC_PATH))
     return paths
 
+def get_playlist_entries(rating_key):
+    """Returns [(playlistItemID, track ratingKey)] for a playlist, in playlist order."""
+    return [
+        (str(item["playlistItemID"]), str(item["ratingKey"]))
+        for item in get_paged_metadata(f"/playlists/{rating_key}/items")
+        if "playlistItemID" in item and "ratingKey" in item
+    ]
+
+def get_section_track_keys(section_id):
+    """Maps every track file in the section (as Plex sees the path) to its ratingKey."""
+    keys = {}
+    for track in get_paged_metadata(f"/library/sections/{section_id}/all", params={"type": 10}):
+        for file_path in get_track_files(track):
+            keys[file_path] = str(track["ratingKey"])
+    return keys
+
+def get_machine_identifier():
+    return plex_client.get_json("/identity").get("MediaContainer", {}).get("machineIdentifier")
+
+def reconcile_playlist(rating_key, desired_keys, machine_id):
+    """Applies only the adds, removes and reorders needed to make a Plex playlist match desired_keys."""
+    entries = get_playlist_entries(rating_key)
+    removes, adds = plan_membership_changes(entries, desired_keys)
+
+    for item_id in removes:
+        plex_client.delete(f"/playlists/{rating_key}/items/{item_id}")
+    for i in range(0, len(adds), PLEX_ADD_BATCH):
+        uri = f"server://{machine_id}/com.plexapp.plugins.library/library/metadata/{','.join(adds[i:i + PLEX_ADD_BATCH])}"
+        plex_client.put(f"/playlists/{rating_key}/items", params={"uri": uri}).raise_for_status()
+
+    if removes or adds:
+        entries = get_playlist_entries(rating_key)
+    moves = plan_moves(entries, desired_keys)
+    for item_id, after_id in moves:
+        params = {"after": after_id} if after_id else None
+        plex_client.put(f"/playlists/{rating_key}/items/{item_id}/move", params=params)
+
+    return {"added": len(adds), "removed": len(removes), "moved": len(moves)}
+
+def load_saved_playlist_cache():
+    try:
+        with open(PLEX_SAVED_CACHE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        console.print(f"[yellow]Saved playlist cache is unreadable, fetching everything: {e}[/yellow]")
+        return {}
+
+def save_saved_playlist_cache(cache):
+    try:
+        os.makedirs(os.path.dirname(PLEX_SAVED_CACHE_PATH), exist_ok=True)
+        write_atomic(PLEX_SAVED_CACHE_PATH, json.dumps(cache))
+    except Exception as e:
+        console.print(f"[yellow]Could not save the saved playlist cache: {e}[/yellow]")
+
 def get_protected_plex_data():
-    """Finds all saved playlists and bundles their file paths to protect them from deletion."""
+    """Finds all saved playlists and bundles their local file paths to protect them from deletion.
+
+    Returns {title: {"ratingKey", "updatedAt", "paths"}} where paths is a set of normalised
+    local paths. Playlists whose updatedAt hasn't moved since the last run come from the
+    cache, the rest are fetched concurrently.
+    """
     if not PLEX_TOKEN:
         return {}
     console.print("[cyan]Checking Plex for 'saved' playlists...[/cyan]")
     try:
         playlists = get_existing_playlists()
+        cache = load_saved_playlist_cache()
         protected_data = {}
+        to_fetch = []
         for title, info in playlists.items():
-            if info["is_saved"]:
-                console.print(f" [green]✓[/green] Found saved playlist in Plex: '{title}'")
-                paths = get_playlist_items(info["ratingKey"])
-                protected_data[title] = {
-                    "ratingKey": info["ratingKey"],
-                    "paths": paths
-                }
+            if not info["is_saved"]:
+                continue
+            console.print(f" [green]✓[/green] Found saved playlist in Plex: '{title}'")
+            cached = cache.get(str(info["ratingKey"]))
+            if cached and info["updatedAt"] is not None and cached.get("updatedAt") == info["updatedAt"]:
+                protected_data[title] = {**info, "paths": set(cached["paths"])}
+            else:
+                to_fetch.append((title, info))
+
+        def fetch(item):
+            title, info = item
+            try:
+                return title, info, get_playlist_local_paths(info["ratingKey"])
+            except Exception as e:
+                cached = cache.get(str(info["ratingKey"]))
+                if not cached:
+                    raise
+                # A stale copy still protects more songs than nothing
+                console.print(f"[yellow]Could not fetch '{title}' ({e}), using its paths from the last run.[/yellow]")
+                return title, {**info, "updatedAt": cached.get("updatedAt")}, set(cached["paths"])
+
+        with ThreadPoolExecutor(max_workers=PLEX_SYNC_WORKERS) as executor:
+            for title, info, paths in executor.map(fetch, to_fetch):
+                protected_data[title] = {**info, "paths": paths}
+
+        console.print(f"[dim]Saved playlists: {len(to_fetch)} fetched, {len(protected_data) - len(to_fetch)} unchanged since the last run[/dim]")
+        save_saved_playlist_cache({
+            str(info["ratingKey"]): {"updatedAt": info["updatedAt"], "paths": sorted(info["paths"])}
+            for info in protected_data.values()
+        })
         return protected_data
     except Exception as e:
         console.print(f"[red]Could not fetch protected playlists: {e}[/red]")
@@ -87,22 +258,19 @@ def get_protected_plex_data():
 
 def delete_playlist(rating_key):
     """Deletes an old playlist from Plex."""
-    url = f"{PLEX_URL}/playlists/{rating_key}?X-Plex-Token={PLEX_TOKEN}"
-    requests.delete(url)
+    plex_client.delete(f"/playlists/{rating_key}")
 
 def upload_m3u(section_id, m3u_name):
     """Uploads the new .m3u file natively into Plex's database safely."""
     plex_path = f"{PLEX_M3U_PATH}/{m3u_name}"
-    url = f"{PLEX_URL}/playlists/upload"
     
     # Passing parameters this way is much safer for special characters
     params = {
         "sectionID": section_id,
         "path": plex_path,
-        "X-Plex-Token": PLEX_TOKEN
     }
     
-    response = requests.post(url, params=params)
+    response = plex_client.post("/playlists/upload", params=params)
     
     if response.status_code == 200:
         return True
@@ -110,7 +278,17 @@ def upload_m3u(section_id, m3u_name):
         console.print(f"    [red]Failed! Plex Error: {response.text.strip()}[/red]")
         return False
 
-def sync_to_plex(protected_data=None):
+def sync_to_plex(protected_data=None, changed_playlists=None, changed_dirs=None):
+    """Scans the library and brings Plex playlists in line with the current .m3u files.
+
+    Existing playlists are diffed and only the changed items are added, removed or moved;
+    playlists Plex doesn't have yet are uploaded from their .m3u.
+
+    changed_playlists is the set of safe playlist names whose .m3u changed this run; Plex
+    playlists for every other .m3u are left as they are. None syncs every .m3u.
+    changed_dirs is the set of local song folders that changed: only those get scanned,
+    an empty set skips the scan, and None scans the whole section.
+    """
     if not PLEX_TOKEN:
         console.print("[yellow]PLEX_TOKEN not found in .env. Skipping Plex API sync.[/yellow]")
         return
@@ -125,42 +303,92 @@ def sync_to_plex(protected_data=None):
             console.print(f"[red]Could not find a library named '{PLEX_LIBRARY_NAME}'.[/red]")
             return
 
-        console.print(f"[cyan]Triggering library scan for '{PLEX_LIBRARY_NAME}'...[/cyan]")
-        trigger_scan(section_id)
-        
-        # Give Plex time to ingest the files
-        console.print("[yellow]Waiting 30 seconds for Plex to process the new MP3 files...[/yellow]")
-        time.sleep(30)
+        if changed_dirs is None or changed_dirs:
+            scan_paths = get_scan_paths(changed_dirs) if changed_dirs else None
+            if scan_paths:
+                console.print(f"[cyan]Triggering scan of {len(scan_paths)} changed folders in '{PLEX_LIBRARY_NAME}'...[/cyan]")
+            else:
+                console.print(f"[cyan]Triggering library scan for '{PLEX_LIBRARY_NAME}'...[/cyan]")
+            trigger_scan(section_id, scan_paths)
+            
+            # Playlists can only reference files Plex has ingested, so wait for the scan to finish
+            console.print("[yellow]Waiting for Plex to finish processing the new files...[/yellow]")
+            wait_for_scan(section_id)
 
         console.print("[cyan]Fetching existing Plex playlists...[/cyan]")
         existing_playlists = get_existing_playlists()
 
-        # 1. Delete unprotected playlists
+        m3u_files = glob.glob(os.path.join(PLAYLISTS_DIR, "*.m3u"))
+        m3u_titles = {os.path.splitext(os.path.basename(m3u_file))[0] for m3u_file in m3u_files}
+
+        def is_unchanged(title):
+            return changed_playlists is not None and title in m3u_titles and get_m3u_playlist_key(title) not in changed_playlists
+
+        # 1. Delete unprotected playlists that are no longer synced
         for pl_title, info in existing_playlists.items():
             if info["is_saved"]:
                 console.print(f" -> [green]Preserving saved Plex playlist:[/green] '{pl_title}'")
-                continue
-            else:
+            elif pl_title not in m3u_titles:
                 console.print(f" -> [yellow]Deleting old Plex playlist:[/yellow] '{pl_title}'")
                 delete_playlist(info["ratingKey"])
 
-        # 2. Upload M3Us
-        m3u_files = glob.glob(os.path.join(PLAYLISTS_DIR, "*.m3u"))
+        # 2. Work out which M3Us need touching at all
+        to_sync = []
         for m3u_file in m3u_files:
             m3u_name = os.path.basename(m3u_file)
             playlist_title = os.path.splitext(m3u_name)[0]
 
             # If the user saved this playlist, do not upload a new M3U or it will duplicate/overwrite it
-            if playlist_title in protected_data:
+            if playlist_title in protected_data or existing_playlists.get(playlist_title, {}).get("is_saved"):
                 console.print(f" -> [yellow]Skipping M3U upload[/yellow] for '{playlist_title}' because it is marked as 'save' in Plex.")
                 continue
+            if is_unchanged(playlist_title) and playlist_title in existing_playlists:
+                console.print(f" -> [dim]Unchanged, keeping Plex playlist '{playlist_title}'[/dim]")
+                continue
+            to_sync.append(m3u_file)
+
+        # Existing playlists are diffed in place, which needs every track's ratingKey
+        track_keys = {}
+        machine_id = None
+        if any(os.path.splitext(os.path.basename(m3u_file))[0] in existing_playlists for m3u_file in to_sync):
+            track_keys = get_section_track_keys(section_id)
+            machine_id = get_machine_identifier()
+
+        def sync_playlist(m3u_file):
+            m3u_name = os.path.basename(m3u_file)
+            playlist_title = os.path.splitext(m3u_name)[0]
+            existing = existing_playlists.get(playlist_title)
+
+            if existing and machine_id:
+                try:
+                    paths = read_m3u_paths(m3u_file)
+                    desired_keys = [track_keys[path] for path in paths if path in track_keys]
+                    changes = reconcile_playlist(existing["ratingKey"], desired_keys, machine_id)
+                    missing = len(paths) - len(desired_keys)
+                    if any(changes.values()):
+                        console.print(f" -> [cyan]Updated Plex playlist[/cyan] '{playlist_title}': "
+                                      f"+{changes['added']} -{changes['removed']} moved {changes['moved']}")
+                    else:
+                        console.print(f" -> [dim]Plex playlist '{playlist_title}' already up to date[/dim]")
+                    if missing:
+                        console.print(f"    [yellow]{missing} songs are not in Plex yet and were left out.[/yellow]")
+                    return
+                except Exception as e:
+                    console.print(f"    [yellow]Could not update '{playlist_title}' in place ({e}), re-uploading it.[/yellow]")
+                delete_playlist(existing["ratingKey"])
 
             console.print(f" -> [cyan]Uploading new M3U to Plex:[/cyan] '{playlist_title}'")
             success = upload_m3u(section_id, m3u_name)
             if success:
                 console.print(f"    [green]Success![/green]")
 
+        # 3. Independent playlists are reconciled concurrently
+        with ThreadPoolExecutor(max_workers=PLEX_SYNC_WORKERS) as executor:
+            list(executor.map(sync_playlist, to_sync))
+
         console.print("[bold green]Plex API Sync Complete![/bold green]\n")
+        for line in plex_client.latency_summary():
+            console.print(f"[dim]{line}[/dim]")
         
     except Exception as e:
         console.print(f"[bold red]Plex sync failed:[/bold red] {e}")
@@ -0,0 +1,46 @@
+# ./src/postprocessor.py
+import os
+import subprocess
+
+FFMPEG = os.getenv("FFMPEG_PATH", "ffmpeg")
+
+# Containers YouTube's audio can be copied into without re-encoding ("native" mode)
+NATIVE_EXTENSIONS = {
+    ".webm": ".opus",
+    ".opus": ".opus",
+    ".ogg": ".ogg",
+    ".m4a": ".m4a",
+    ".mp4": ".m4a",
+}
+
+def run_ffmpeg(args):
+    subprocess.run(
+        [FFMPEG, "-y", "-loglevel", "error", "-nostdin", *args],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+
+def convert_audio(raw_path, audio_format):
+    """Turns a raw yt-dlp download into the final library file and returns its path.
+
+    Mirrors what yt-dlp's FFmpegExtractAudio did inline: 192k MP3 by default, or a plain
+    stream copy into the matching container in "native" mode.
+    """
+    base, raw_ext = os.path.splitext(raw_path)
+    raw_ext = raw_ext.lower()
+
+    if audio_format == "native" and raw_ext in NATIVE_EXTENSIONS:
+        final_path = base + NATIVE_EXTENSIONS[raw_ext]
+        if final_path == raw_path:
+            return raw_path # Already in its final container
+        run_ffmpeg(["-i", raw_path, "-vn", "-acodec", "copy", final_path])
+    else:
+        final_path = base + ".mp3"
+        run_ffmpeg(["-i", raw_path, "-vn", "-acodec", "libmp3lame", "-b:a", "192k", final_path])
+
+    os.remove(raw_path)
+    return final_path
+
+def compress_cover(image_path, jpeg_path, size):
+    """Converts any image ffmpeg can read to a JPEG no larger than size x size (never upscaled)."""
+    scale = f"scale='min({size},iw)':'min({size},ih)':force_original_aspect_ratio=decrease"
+    run_ffmpeg(["-i", image_path, "-frames:v", "1", "-vf", scale, "-q:v", "3", "-f", "image2", jpeg_path])
@@ -0,0 +1,97 @@
+# ./src/retag.py
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from file_manager import library_index
+from downloader import apply_metadata, read_tags, get_expected_tags, get_library_path
+from metrics import metrics
+
+# Mostly waiting on the share, so more workers than CPUs is fine
+RETAG_WORKERS = int(os.getenv("RETAG_WORKERS", "8"))
+
+def new_retag_stats():
+    return {
+        "checked": 0,
+        "unchanged": 0,
+        "retagged": 0,
+        "moved": 0,
+        "kept_in_place": 0,
+        "failed": 0,
+        "moved_ids": set(),
+        "changed_dirs": set(),
+    }
+
+def retag_track(track, path, stats, lock, protected_paths=()):
+    """Moves one library file to its current Artist/Album folder and fixes its tags if they drifted.
+
+    Files in protected_paths (songs of saved Plex/Jellyfin playlists) are only retagged, as
+    moving them would leave a dead entry in the saved playlist.
+    """
+    target = get_library_path(track, os.path.splitext(path)[1])
+    try:
+        drifted = read_tags(path) != get_expected_tags(track)
+        moved = os.path.normpath(target) != os.path.normpath(path)
+        kept_in_place = moved and os.path.normpath(path) in protected_paths
+        if kept_in_place:
+            moved = False
+            target = path
+        if moved:
+            if os.path.exists(target):
+                raise FileExistsError(target)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+            library_index.remove(path)
+            library_index.add(track['video_id'], target)
+        retagged = drifted and apply_metadata(target, track)
+    except Exception as e:
+        print(f"Could not re-tag {os.path.basename(path)}: {e}")
+        with lock:
+            stats["failed"] += 1
+        return
+
+    with lock:
+        stats["checked"] += 1
+        if moved:
+            stats["moved"] += 1
+            stats["moved_ids"].add(track['video_id'])
+        if kept_in_place:
+            stats["kept_in_place"] += 1
+        if retagged:
+            stats["retagged"] += 1
+            stats["changed_dirs"].add(os.path.dirname(target))
+        if not moved and not retagged and not kept_in_place:
+            stats["unchanged"] += 1
+
+def retag_library(tracks, protected_paths=None, workers=RETAG_WORKERS):
+    """Brings already downloaded songs in line with the current YouTube Music metadata.
+
+    Every indexed file of a track in tracks has its tags read (tag block only) and compared
+    with the playlist data. Files whose artist/album changed are moved to the matching
+    All_Songs/Artist/Album folder (unless they are in protected_paths, a set of normalised
+    local paths), and only files whose tags actually differ are rewritten.
+    Returns the stats, including the video_ids that moved and the folders that changed.
+    """
+    stats = new_retag_stats()
+    protected_paths = protected_paths or set()
+    lock = threading.Lock()
+    seen = set()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="retag") as executor:
+        for track in tracks:
+            video_id = track.get('video_id')
+            if not video_id or video_id in seen:
+                continue
+            seen.add(video_id)
+            path = library_index.lookup(video_id)
+            if path:
+                executor.submit(retag_track, track, path, stats, lock, protected_paths)
+
+    # Moves add and remove library index entries, which mark their folders as changed too
+    stats["changed_dirs"] |= library_index.take_changed_dirs()
+    metrics.inc("retag_files_total", stats["retagged"], result="retagged")
+    metrics.inc("retag_files_total", stats["moved"], result="moved")
+    metrics.inc("retag_files_total", stats["kept_in_place"], result="kept_in_place")
+    metrics.inc("retag_files_total", stats["unchanged"], result="unchanged")
+    metrics.inc("retag_files_total", stats["failed"], result="failed")
+    print(f"Re-tag complete: checked {stats['checked']} songs, rewrote tags of {stats['retagged']}, "
+          f"moved {stats['moved']} to new Artist/Album folders ({stats['kept_in_place']} kept in place for saved playlists), {stats['unchanged']} already up to date, {stats['failed']} failed.")
+    return stats
@@ -0,0 +1,384 @@
+# ./src/scheduler.py
+import os
+import json
+import time
+import random
+import socket
+import uuid
+import threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from atomic_file import write_atomic
+
+# A lock whose holder hasn't touched it for this long is treated as left behind by a crash
+LOCK_STALE_SECONDS = int(os.getenv("SYNC_LOCK_STALE_SECONDS", "600"))
+LOCK_HEARTBEAT_SECONDS = 60
+# How long to wait before trying again when another process holds the lock
+LOCK_RETRY_SECONDS = 60
+# How often the cookies.txt / trigger-file watcher looks for changes
+WATCH_INTERVAL_SECONDS = 5
+# Tells this process apart from an earlier one with the same host and pid (a restarted container)
+PROCESS_ID = uuid.uuid4().hex
+
+def parse_times(value):
+    """'04:00,16:00' -> [(4, 0), (16, 0)]"""
+    times = []
+    for part in value.split(","):
+        part = part.strip()
+        if part:
+            hour, minute = part.split(":")
+            times.append((int(hour), int(minute)))
+    return sorted(times)
+
+def next_slot(times, after):
+    """First time-of-day slot strictly after the datetime `after`."""
+    for day in range(2):
+        date = (after + timedelta(days=day)).date()
+        for hour, minute in times:
+            slot = datetime(date.year, date.month, date.day, hour, minute)
+            if slot > after:
+                return slot
+    return None
+
+class SyncLock:
+    """Single-flight lock file on the downloads volume, shared by every process and container.
+
+    Created with O_EXCL (which SMB honours, unlike flock), stamped with host/pid/job and a
+    per-process id, and touched every minute while held so a crashed holder's lock goes
+    stale instead of blocking syncs forever.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._heartbeat = None
+        self._stop = threading.Event()
+
+    def holder(self, path=None):
+        try:
+            with open(path or self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def _is_stale(self, holder, path=None):
+        try:
+            age = time.time() - os.path.getmtime(path or self.path)
+        except FileNotFoundError:
+            return True
+        if age > LOCK_STALE_SECONDS:
+            return True
+        if holder.get("host") == socket.gethostname() and holder.get("pid"):
+            if holder["pid"] == os.getpid():
+                # A restarted container gets the same hostname and pid 1 again, so a live pid
+                # only means the holder is alive if the lock was written by this very process
+                return holder.get("process") != PROCESS_ID
+            try:
+                os.kill(holder["pid"], 0)
+            except ProcessLookupError:
+                return True # Same machine and that process is gone
+            except PermissionError:
+                pass
+        return False
+
+    def acquire(self, job_name):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        for _ in range(2):
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                holder = self.holder()
+                if not self._is_stale(holder) or not self._break_stale(holder):
+                    return False
+                continue
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({"host": socket.gethostname(), "pid": os.getpid(), "process": PROCESS_ID, "job": job_name, "started": time.time()}, f)
+            self._stop.clear()
+            self._heartbeat = threading.Thread(target=self._beat, name="sync-lock-heartbeat", daemon=True)
+            self._heartbeat.start()
+            return True
+        return False
+
+    def _break_stale(self, holder):
+        """Moves the stale lock of `holder` out of the way. Returns False if another process beat us to it.
+
+        Removing it outright would race: two processes can both find the same lock stale, and
+        the slower one would delete the lock the faster one has just created. Renaming is
+        atomic, so only one of them moves the lock, and the moved file shows whose it was.
+        """
+        stale_path = f"{self.path}.{PROCESS_ID}.stale"
+        try:
+            os.rename(self.path, stale_path)
+        except FileNotFoundError:
+            return True # Gone already, whoever removed it still has to win the O_EXCL create
+        moved = self.holder(stale_path)
+        if moved != holder and not self._is_stale(moved, stale_path):
+            # Another process broke the stale lock first and this is its fresh one, put it back
+            os.rename(stale_path, self.path)
+            return False
+        os.remove(stale_path)
+        return True
+
+    def _beat(self):
+        while not self._stop.wait(LOCK_HEARTBEAT_SECONDS):
+            try:
+                os.utime(self.path)
+            except OSError:
+                pass
+
+    def release(self):
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+            self._heartbeat = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+class ScheduledJob:
+    def __init__(self, name, fn, times):
+        self.name = name
+        self.fn = fn
+        self.times = times
+        self.last_run = None
+        self.next_due = None
+
+class SyncService:
+    """Long-running scheduler around the sync jobs.
+
+    Jobs run one at a time in the calling thread, guarded by a SyncLock, so a slow run can
+    never overlap the next one or a run in another container. Each slot is pushed back by a
+    random jitter. Triggers (schedule, cookies.txt watcher, trigger files, HTTP) are
+    coalesced: however many arrive while a job runs, it runs once more afterwards.
+
+    missed_policy decides what happens to slots missed while the service was down or busy:
+    "coalesce" runs them once as soon as possible, "skip" drops any that are more than
+    missed_grace seconds late.
+    """
+
+    def __init__(self, lock, state_path, trigger_dir, jitter=0, missed_policy="coalesce", missed_grace=900):
+        self.lock = lock
+        self.state_path = state_path
+        self.trigger_dir = trigger_dir
+        self.jitter = jitter
+        self.missed_policy = missed_policy
+        self.missed_grace = missed_grace
+        self.jobs = {}
+        self._order = []
+        self._standalone = []
+        self._pending = []
+        self._running = None
+        self._cond = threading.Condition()
+
+    def add_job(self, name, fn, times, standalone=False):
+        """Registers a job. Earlier jobs are treated as supersets of later ones (full covers feed),
+        standalone jobs neither cover nor are covered by any other."""
+        self.jobs[name] = ScheduledJob(name, fn, times)
+        (self._standalone if standalone else self._order).append(name)
+
+    def _covered(self, name):
+        """The jobs a run of `name` counts as, itself included."""
+        return self._order[self._order.index(name):] if name in self._order else [name]
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except Exception:
+            state = {}
+        for name, job in self.jobs.items():
+            last_run = state.get(name, {}).get("last_run")
+            job.last_run = datetime.fromtimestamp(last_run) if last_run else None
+
+    def _save_state(self):
+        state = {name: {"last_run": job.last_run.timestamp() if job.last_run else None} for name, job in self.jobs.items()}
+        try:
+            write_atomic(self.state_path, json.dumps(state))
+        except Exception as e:
+            print(f"Could not save scheduler state: {e}")
+
+    def _plan(self, job, now):
+        """Works out the job's next due time (slot + jitter) from its last run."""
+        if not job.times:
+            job.next_due = None
+            return
+        slot = next_slot(job.times, job.last_run or now)
+        if self.missed_policy == "skip":
+            while slot and slot < now - timedelta(seconds=self.missed_grace):
+                slot = next_slot(job.times, slot)
+        job.next_due = slot + timedelta(seconds=random.uniform(0, self.jitter)) if slot else None
+
+    def trigger(self, name, source="manual"):
+        if name not in self.jobs:
+            return False
+        with self._cond:
+            if name not in self._pending:
+                print(f"Sync '{name}' requested ({source}).")
+                self._pending.append(name)
+            self._cond.notify_all()
+        return True
+
+    def _take_pending(self):
+        # Caller holds self._cond. A pending broader job makes narrower ones redundant.
+        for name in self._order + self._standalone:
+            if name in self._pending:
+                covered = self._covered(name)
+                self._pending = [pending for pending in self._pending if pending not in covered]
+                return name
+        return None
+
+    def watch(self, cookies_path, cookies_job):
+        """Polls cookies.txt and the trigger directory on a daemon thread."""
+        def loop():
+            last_mtime = self._mtime(cookies_path)
+            changed_mtime = None
+            while True:
+                time.sleep(WATCH_INTERVAL_SECONDS)
+                mtime = self._mtime(cookies_path)
+                # Wait for one quiet poll so a half-copied cookies.txt isn't picked up
+                if mtime != last_mtime and mtime is not None:
+                    if mtime == changed_mtime:
+                        last_mtime = mtime
+                        self.trigger(cookies_job, "cookies.txt changed")
+                    changed_mtime = mtime
+                try:
+                    names = os.listdir(self.trigger_dir)
+                except FileNotFoundError:
+                    names = []
+                for filename in names:
+                    name, ext = os.path.splitext(filename)
+                    if ext != ".trigger":
+                        continue
+                    try:
+                        os.remove(os.path.join(self.trigger_dir, filename))
+                    except FileNotFoundError:
+                        continue
+                    self.trigger(name, "trigger file")
+
+        threading.Thread(target=loop, name="sync-watcher", daemon=True).start()
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def status(self):
+        with self._cond:
+            return {
+                "running": self._running,
+                "pending": list(self._pending),
+                "jobs": {
+                    name: {
+                        "last_run": job.last_run.isoformat() if job.last_run else None,
+                        "next_due": job.next_due.isoformat() if job.next_due else None,
+                    }
+                    for name, job in self.jobs.items()
+                },
+            }
+
+    def start_control_server(self, host, port):
+        """POST /trigger/<job> queues a job, GET /status shows the schedule. Returns the server or None."""
+        if not port:
+            return None
+        service = self
+
+        class ControlHandler(BaseHTTPRequestHandler):
+            def _send_json(self, status, data):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.split("?")[0] == "/status":
+                    self._send_json(200, service.status())
+                else:
+                    self._send_json(404, {"error": "not found"})
+
+            def do_POST(self):
+                parts = self.path.split("?")[0].strip("/").split("/")
+                if len(parts) == 2 and parts[0] == "trigger" and service.trigger(parts[1], "http"):
+                    self._send_json(202, {"queued": parts[1]})
+                else:
+                    self._send_json(404, {"error": f"unknown job, use one of {sorted(service.jobs)}"})
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            server = ThreadingHTTPServer((host, port), ControlHandler)
+        except OSError as e:
+            print(f"Could not start the control endpoint on {host}:{port}: {e}")
+            return None
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="sync-control", daemon=True).start()
+        return server
+
+    def run_job(self, name):
+        """Runs one job under the lock. Returns False if another process holds it."""
+        job = self.jobs[name]
+        if not self.lock.acquire(name):
+            holder = self.lock.holder()
+            print(f"Skipping '{name}' sync, '{holder.get('job', '?')}' is already running "
+                  f"(pid {holder.get('pid', '?')} on {holder.get('host', '?')}).")
+            return False
+        started = datetime.now()
+        # Other processes (e.g. 'main.py once') may have run jobs since, the lock makes this read current
+        self._load_state()
+        with self._cond:
+            self._running = name
+        try:
+            job.fn()
+        except Exception as e:
+            print(f"Sync '{name}' failed: {e}")
+        finally:
+            # A full run also counts as a run of every narrower job
+            for covered in self._covered(name):
+                self.jobs[covered].last_run = started
+            self._save_state()
+            self.lock.release()
+            with self._cond:
+                self._running = None
+        return True
+
+    def run_forever(self, startup_job=None):
+        self._load_state()
+        now = datetime.now()
+        for job in self.jobs.values():
+            self._plan(job, now)
+            # Missed while the service was down
+            if self.missed_policy == "coalesce" and job.next_due and job.last_run and job.next_due <= now:
+                self.trigger(job.name, "missed run")
+        if startup_job:
+            self.trigger(startup_job, "startup")
+
+        while True:
+            with self._cond:
+                while True:
+                    now = datetime.now()
+                    for job in self.jobs.values():
+                        if job.next_due and job.next_due <= now:
+                            if job.name not in self._pending:
+                                self._pending.append(job.name)
+                            job.next_due = None # Re-planned after the run
+                    name = self._take_pending()
+                    if name:
+                        break
+                    due_times = [job.next_due for job in self.jobs.values() if job.next_due]
+                    timeout = max(1.0, (min(due_times) - now).total_seconds()) if due_times else None
+                    self._cond.wait(timeout)
+
+            ran = self.run_job(name)
+            now = datetime.now()
+            if not ran:
+                self.jobs[name].next_due = now + timedelta(seconds=LOCK_RETRY_SECONDS)
+            for job in self.jobs.values():
+                if job.next_due is None or (ran and job.name in self._covered(name)):
+                    self._plan(job, now)
+                    # Slots that passed during the run: coalesce into one immediate run, or drop
+                    if job.next_due and job.next_due <= now and self.missed_policy == "coalesce":
+                        self.trigger(job.name, "missed during previous run")
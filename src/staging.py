@@ -0,0 +1,126 @@
+# ./src/staging.py
+import os
+import time
+import shutil
+import threading
+
+# Big sequential writes are what SMB is good at
+COPY_BUFFER_BYTES = 4 * 1024 * 1024
+# What a track is assumed to take up in staging until one has been measured
+DEFAULT_TRACK_BYTES = 16 * 1024 * 1024
+
+def new_staging_stats():
+    return {
+        "tracks_published": 0,
+        "bytes_published": 0,
+        "peak_bytes": 0,
+        "wait_seconds": 0.0,
+    }
+
+class StagingArea:
+    """Local scratch space where a track is downloaded, transcoded and tagged before publishing.
+
+    Every track gets its own folder under root. Once it is finished, publish() copies the
+    final file onto the library share in one sequential pass under a temporary name and
+    renames it into place, so the share only ever sees one write of the finished file and
+    never a half-written song. Staged bytes are capped at max_bytes: new downloads wait
+    while the cap is reached (at least one track is always allowed through).
+
+    The cap is checked against a running counter rather than by walking the folder: claim()
+    reserves the average size of the tracks staged so far, and release() swaps that for the
+    track's measured size before freeing it.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._cond = threading.Condition()
+        self._active = {}
+        self._staged_bytes = 0
+        self._measured_tracks = 0
+        self._measured_bytes = 0
+        self.stats = new_staging_stats()
+
+    def cleanup_leftovers(self):
+        """Empties the staging area, i.e. whatever a crashed or killed run left behind. Returns bytes freed."""
+        freed = self.usage()
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+        with self._cond:
+            self._active.clear()
+            self._staged_bytes = 0
+            self.stats = new_staging_stats()
+        return freed
+
+    def usage(self, path=None):
+        total = 0
+        for dirpath, _, filenames in os.walk(path or self.root):
+            for filename in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+                except OSError:
+                    pass
+        return total
+
+    def track_dir(self, video_id):
+        return os.path.join(self.root, video_id)
+
+    def _track_estimate(self):
+        if not self._measured_tracks:
+            return DEFAULT_TRACK_BYTES
+        return self._measured_bytes // self._measured_tracks
+
+    def claim(self, video_id):
+        """Waits for room under the size cap, then returns a fresh folder for this track."""
+        start = time.perf_counter()
+        with self._cond:
+            while self._active and self.max_bytes and self._staged_bytes >= self.max_bytes:
+                self._cond.wait(timeout=1)
+            reserved = self._track_estimate()
+            self._active[video_id] = reserved
+            self._staged_bytes += reserved
+            self.stats["wait_seconds"] += time.perf_counter() - start
+        path = self.track_dir(video_id)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def release(self, video_id):
+        """Deletes the track's staging folder and lets a waiting download in."""
+        # Measured outside the lock, it only walks this one track's folder
+        size = self.usage(self.track_dir(video_id))
+        with self._cond:
+            if video_id in self._active:
+                self._staged_bytes += size - self._active[video_id]
+                self._active[video_id] = size
+            self.stats["peak_bytes"] = max(self.stats["peak_bytes"], self._staged_bytes)
+            if size:
+                self._measured_tracks += 1
+                self._measured_bytes += size
+        shutil.rmtree(self.track_dir(video_id), ignore_errors=True)
+        with self._cond:
+            self._staged_bytes -= self._active.pop(video_id, 0)
+            self._cond.notify_all()
+
+    def publish(self, staged_path, final_path):
+        """Copies a finished file onto the share in one sequential pass and renames it into place."""
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        # Not an audio extension, so a copy cut short never looks like a song
+        tmp_path = os.path.join(os.path.dirname(final_path), f".{os.path.basename(final_path)}.amps-tmp")
+        with open(staged_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, COPY_BUFFER_BYTES)
+        os.replace(tmp_path, final_path)
+        size = os.path.getsize(staged_path)
+        with self._cond:
+            self.stats["tracks_published"] += 1
+            self.stats["bytes_published"] += size
+        return size
+
+    def summary(self):
+        with self._cond:
+            stats = dict(self.stats)
+        per_track = stats["bytes_published"] / stats["tracks_published"] if stats["tracks_published"] else 0
+        cap = f"{self.max_bytes / (1024 * 1024):.0f} MB cap" if self.max_bytes else "no cap"
+        return (f"staging: {stats['tracks_published']} tracks published, {stats['bytes_published'] / (1024 * 1024):.1f} MB "
+                f"written to the library ({per_track / (1024 * 1024):.2f} MB/track), peak {stats['peak_bytes'] / (1024 * 1024):.1f} MB "
+                f"staged ({cap}), waited {stats['wait_seconds']:.0f}s for room")